@@ -1,11 +1,13 @@
-from flask import Flask, render_template, redirect, url_for, request, jsonify, session, send_from_directory, g
+from flask import Flask, render_template, redirect, url_for, request, jsonify, session, send_from_directory, g, Response
 from werkzeug.utils import secure_filename
 from config import config
 from models import db
 from flask_migrate import Migrate
+from services.unit_of_work import init_unit_of_work, stage
 import os
 import time
 import json
+import uuid
 from datetime import datetime
 from auth.decorators import require_auth, require_auth_page, require_role
 
@@ -20,11 +22,50 @@ app.config.from_object(config[env])
 db.init_app(app)
 migrate = Migrate(app, db)
 
+# 每个请求结束时统一提交一次
+init_unit_of_work(app)
+
+# 盲索引需要单独的BLIND_INDEX_KEY，缺失时拒绝启动
+from security.blind_index import init_blind_index
+init_blind_index(app)
+
+# 写入Visit时同步维护patients上的就诊汇总列、每日统计汇总并记录变更事件；写入姓名时维护查找key
+import services.visit_summary
+import services.patient_search
+import services.visit_events
+import services.visit_rollups
+
+# 初始化缓存
+from auth.auth_utils import init_token_cache
+from auth.principal import init_principal_cache
+from services.response_cache import init_response_cache
+from services.symptoms import init_symptom_cache
+from services.analysis_cache import init_analysis_cache
+init_token_cache(app)
+init_principal_cache(app)
+init_response_cache(app)
+init_symptom_cache(app)
+init_analysis_cache(app)
+
+# 初始化密码哈希线程池
+from auth.password_utils import init_password_hasher, PasswordHasherBusy
+init_password_hasher(app)
+
+# 语音分析任务的后台线程池（第一个请求时启动）
+from services.audio_jobs import init_audio_jobs
+init_audio_jobs(app)
+
 # 注册蓝图
-from routes import auth_bp, patient_bp, visit_bp
+from routes import auth_bp, patient_bp, visit_bp, audit_bp, export_bp
 app.register_blueprint(auth_bp)
 app.register_blueprint(patient_bp)
 app.register_blueprint(visit_bp)
+app.register_blueprint(audit_bp)
+app.register_blueprint(export_bp)
+
+# 注册CLI命令
+from commands import register_commands
+register_commands(app)
 
 # 确保文件夹存在
 UPLOAD_FOLDER = app.config['UPLOAD_FOLDER']
@@ -82,19 +123,18 @@ def manual_insurance():
 @require_auth
 def submit_insurance():
     """提交保险信息"""
-    from models import Patient, Insurance
+    from models import Insurance
     from security.encryption import encrypt_data
     from security.audit import log_action
     
     # 获取当前患者
-    patient = Patient.query.filter_by(user_id=g.user_id).first()
-    if not patient:
+    if not g.patient_id:
         return jsonify({'error': 'Patient not found'}), 404
     
     # 处理保险信息
-    insurance = Insurance.query.filter_by(patient_id=patient.id).first()
+    insurance = Insurance.query.filter_by(patient_id=g.patient_id).first()
     if not insurance:
-        insurance = Insurance(patient_id=patient.id)
+        insurance = Insurance(patient_id=g.patient_id)
     
     insurance.insurance_name = request.form.get('insurance_name', '')
     insurance_id = request.form.get('insurance_id', '')
@@ -104,8 +144,8 @@ def submit_insurance():
     insurance.medications = request.form.get('medications', '')
     insurance.medical_conditions = request.form.get('conditions', '')
     
-    db.session.add(insurance)
-    db.session.commit()
+    stage(insurance)
+    db.session.flush()  # 获取insurance.id
     
     # 记录审计日志
     log_action('update', 'insurance', insurance.id)
@@ -141,11 +181,18 @@ def text_input():
 @app.route('/api/process_audio', methods=['POST'])
 @require_auth
 def process_audio():
-    """处理语音文件 - AI分析"""
-    from services.ai_service import process_audio_file
-    from models import Patient, Visit
+    """
+    上传语音文件 - 转录和AI分析交给后台任务（services/audio_jobs.py）
+    返回202和任务id，客户端轮询/api/process_audio/<job_id>（或订阅其/events）
+    """
+    from services.audio_jobs import submit_job, job_status
+    from services.transcription_cache import save_and_hash
     from security.audit import log_action
     
+    # 先确认当前用户有患者记录，避免白跑AI分析
+    if not g.patient_id:
+        return jsonify({'error': 'Patient not found'}), 404
+    
     if 'audio' not in request.files:
         return jsonify({'error': 'No audio file provided'}), 400
     
@@ -153,52 +200,78 @@ def process_audio():
     if audio_file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
     
-    # 保存音频文件
-    filename = secure_filename(f"recording_{int(time.time())}.wav")
-    file_path = os.path.join(AUDIO_FOLDER, filename)
-    audio_file.save(file_path)
+    # 保存音频文件（多个终端同一秒上传时文件名不能冲突），边写边计算内容哈希（转录缓存的key）
+    filename = secure_filename(f"recording_{int(time.time())}_{uuid.uuid4().hex[:8]}.wav")
+    content_hash, _ = save_and_hash(audio_file.stream, os.path.join(AUDIO_FOLDER, filename))
     
     try:
-        # 使用AI服务处理音频
-        result = process_audio_file(file_path)
-        
-        # 获取当前患者
-        patient = Patient.query.filter_by(user_id=g.user_id).first()
-        
-        # 创建就诊记录
-        visit = Visit(
-            patient_id=patient.id,
-            visit_reason=result['text'],
-            voice_transcription=result['text'],
-            symptoms=result['analysis'].get('symptoms', []),
-            possible_causes=result['analysis'].get('possible causes', []),
-            audio_file_path=filename,
-            analysis_file_path=result['analysis_filename']
-        )
-        db.session.add(visit)
-        db.session.commit()
+        job = submit_job(g.patient_id, g.user_id, filename, content_hash)
         
-        # 记录审计日志
-        log_action('create', 'visit', visit.id, {
-            'patient_id': patient.id,
-            'has_audio': True
-        })
+        log_action('create', 'audio_job', job.id, {'patient_id': g.patient_id})
         
-        # 保存到session（用于后续页面）
-        session['current_visit_id'] = visit.id
-        session['visit_reason'] = result['text']
-        session['symptoms'] = ", ".join(result['analysis'].get('symptoms', []))
-        
-        return jsonify({
-            'success': True,
-            'text': result['text'],
-            'analysis': result['analysis'],
-            'analysis_file': result['analysis_filename']
-        })
+        status_url = url_for('audio_job_status', job_id=job.id)
+        return jsonify(dict(job_status(job), status_url=status_url)), 202, {'Location': status_url, 'Retry-After': '1'}
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def _own_audio_job(job_id):
+    """
+    读取当前患者自己的任务，返回 (job, 错误响应)
+    """
+    from models import AudioJob
+    from security.audit import log_action
+    
+    job = db.session.get(AudioJob, job_id)
+    if job is None:
+        return None, (jsonify({'error': 'Job not found'}), 404)
+    if not g.patient_id or job.patient_id != g.patient_id:
+        log_action('access_denied', 'audio_job', job_id, immediate=True)
+        return None, (jsonify({'error': 'Access denied'}), 403)
+    return job, None
+
+@app.route('/api/process_audio/<int:job_id>', methods=['GET'])
+@require_auth
+def audio_job_status(job_id):
+    """
+    语音分析任务的状态
+    成功时返回转录文本和分析结果，并把新建的就诊记录保存到session（用于后续页面）
+    """
+    from services.audio_jobs import job_status
+    
+    job, error = _own_audio_job(job_id)
+    if error:
+        return error
+    
+    data = job_status(job)
+    if job.status == 'succeeded':
+        session['current_visit_id'] = job.visit_id
+        session['visit_reason'] = data['text']
+        session['symptoms'] = ", ".join(data['analysis'].get('symptoms', []))
+        return jsonify(data), 200
+    
+    headers = {} if job.status == 'failed' else {'Retry-After': '1'}
+    return jsonify(data), 200, headers
+
+@app.route('/api/process_audio/<int:job_id>/events', methods=['GET'])
+@require_auth
+def audio_job_events(job_id):
+    """
+    语音分析任务状态的SSE流，任务结束后关闭
+    结束后仍需请求一次状态接口，把就诊记录保存到session
+    """
+    from services.audio_jobs import stream_job_status
+    
+    job, error = _own_audio_job(job_id)
+    if error:
+        return error
+    
+    return Response(
+        stream_job_status(app, job.id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/pain_assessment')
 @require_auth_page
 def pain_assessment():
@@ -221,7 +294,6 @@ def submit_pain_assessment():
         if visit:
             visit.pain_level = int(pain_level)
             visit.pain_duration = duration
-            db.session.commit()
     
     session['pain_level'] = pain_level
     session['duration'] = duration
@@ -243,14 +315,17 @@ def visit_confirmation():
 def submit_confirmation():
     """提交最终确认"""
     from models import Visit
+    from services.triage import queue_position
     
-    # 更新就诊状态
+    # 更新就诊状态，确认后的疼痛评分决定分诊队列中的位置
+    session.pop('queue_position', None)
     visit_id = session.get('current_visit_id')
     if visit_id:
-        visit = Visit.query.get(visit_id)
-        if visit:
+        visit = db.session.get(Visit, visit_id)
+        if visit and visit.patient_id == g.patient_id:
             visit.status = 'confirmed'
-            db.session.commit()
+            db.session.flush()
+            session['queue_position'] = queue_position(visit)
     
     return redirect(url_for('appointment_confirmation'))
 
@@ -258,7 +333,8 @@ def submit_confirmation():
 @require_auth_page
 def appointment_confirmation():
     """预约确认"""
-    return render_template('appointment_confirmation.html')
+    return render_template('appointment_confirmation.html',
+                          queue_position=session.get('queue_position'))
 
 # ==================== 文件访问路由 ====================
 
@@ -286,6 +362,10 @@ def forbidden(e):
 def not_found(e):
     return jsonify({'error': 'Not found'}), 404
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    return jsonify({'error': 'Server busy, please retry'}), 503, {'Retry-After': '1'}
+
 @app.errorhandler(500)
 def internal_error(e):
     return jsonify({'error': 'Internal server error'}), 500
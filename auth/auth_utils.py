@@ -1,9 +1,31 @@
 import jwt
+import time
 from datetime import datetime, timedelta
 from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession, object_session
 from models import db, Session
+from services.cache import TTLCache
+from services.unit_of_work import stage
 import hashlib
 
+# 已验证token的进程内缓存：token_hash -> payload
+# 条目TTL不超过token剩余有效期，也不超过TOKEN_CACHE_STALENESS，
+# 因此其他worker中撤销的token最多在该窗口内失效
+token_cache = TTLCache('token', max_size=10000, ttl=30)
+
+def init_token_cache(app):
+    """
+    根据配置初始化token缓存
+    """
+    token_cache.configure(
+        max_size=app.config['TOKEN_CACHE_MAX_SIZE'],
+        ttl=app.config['TOKEN_CACHE_STALENESS']
+    )
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
 def generate_token(user_id: int, role: str) -> str:
     """
     生成JWT token
@@ -22,14 +44,13 @@ def generate_token(user_id: int, role: str) -> str:
     )
     
     # 保存token到sessions表
-    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    token_hash = hash_token(token)
     session = Session(
         user_id=user_id,
         token_hash=token_hash,
         expires_at=payload['exp']
     )
-    db.session.add(session)
-    db.session.commit()
+    stage(session)
     
     return token
 
@@ -38,6 +59,13 @@ def verify_token(token: str) -> dict:
     验证JWT token
     返回payload或None
     """
+    token_hash = hash_token(token)
+    
+    # 先查缓存，命中时跳过解码和数据库查询
+    cached = token_cache.get(token_hash)
+    if cached is not None:
+        return dict(cached)
+    
     try:
         payload = jwt.decode(
             token,
@@ -46,7 +74,6 @@ def verify_token(token: str) -> dict:
         )
         
         # 检查token是否被撤销
-        token_hash = hashlib.sha256(token.encode()).hexdigest()
         session = Session.query.filter_by(
             token_hash=token_hash,
             is_revoked=False
@@ -54,8 +81,11 @@ def verify_token(token: str) -> dict:
         
         if not session:
             return None
+        
+        # 缓存时间不能超过token的exp
+        token_cache.set(token_hash, payload, ttl=payload['exp'] - time.time())
             
-        return payload
+        return dict(payload)
         
     except jwt.ExpiredSignatureError:
         return None
@@ -66,11 +96,33 @@ def revoke_token(token: str) -> bool:
     """
     撤销token（登出时使用）
     """
-    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    token_hash = hash_token(token)
+    # 本进程内立即失效
+    token_cache.pop(token_hash)
+    
     session = Session.query.filter_by(token_hash=token_hash).first()
     
     if session:
         session.is_revoked = True
-        db.session.commit()
+        stage(session)
         return True
-    return False
\ No newline at end of file
+    return False
+
+# ============ 自动失效 ============
+# 和principal缓存一样：flush时失效，提交后再失效一次，
+# 防止提交前有并发请求把还没撤销的token重新写入缓存
+
+@event.listens_for(Session, 'after_update')
+def _session_updated(mapper, connection, target):
+    if db.inspect(target).attrs.is_revoked.history.has_changes():
+        token_cache.pop(target.token_hash)
+        object_session(target).info.setdefault('token_invalidations', set()).add(target.token_hash)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _invalidate_after_commit(session):
+    for token_hash in session.info.pop('token_invalidations', ()):
+        token_cache.pop(token_hash)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('token_invalidations', None)
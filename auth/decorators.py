@@ -1,7 +1,18 @@
 from functools import wraps
 from flask import request, jsonify, g
+from werkzeug.local import LocalProxy
 from auth.auth_utils import verify_token
-from models import User
+from auth.principal import load_principal
+from models import db, User
+
+def get_current_user():
+    """
+    按需加载当前用户的ORM对象（每个请求最多查询一次）
+    只有真正需要完整User行的handler才调用
+    """
+    if '_current_user' not in g:
+        g._current_user = db.session.get(User, g.user_id)
+    return g._current_user
 
 # ============ 第1个：用于API的装饰器（保留原来的）============
 def require_auth(f):
@@ -29,15 +40,17 @@ def require_auth(f):
         if not payload:
             return jsonify({'error': 'Invalid or expired token'}), 401
         
-        # 获取用户信息
-        user = User.query.get(payload['user_id'])
-        if not user or not user.is_active:
+        # 获取用户主体（缓存，不加载完整User行）
+        principal = load_principal(payload['user_id'])
+        if not principal or not principal.is_active:
             return jsonify({'error': 'User not found or inactive'}), 401
         
-        # 将用户信息存储到g对象中
-        g.current_user = user
-        g.user_id = user.id
-        g.user_role = user.role
+        # 将用户信息存储到g对象中，current_user延迟加载
+        g.principal = principal
+        g.user_id = principal.user_id
+        g.user_role = principal.role
+        g.patient_id = principal.patient_id
+        g.current_user = LocalProxy(get_current_user)
         
         return f(*args, **kwargs)
     
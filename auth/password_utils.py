@@ -1,18 +1,132 @@
 import bcrypt
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# bcrypt是CPU密集型的，放在独立的有界线程池里执行，
+# 避免登录高峰时占满所有web worker
+_executor = None
+_slots = None
+_rounds = 12
+_calibration = None  # (target_ms, min_rounds)，首次哈希时才校准
+_lock = threading.Lock()
+
+class PasswordHasherBusy(Exception):
+    """
+    密码哈希队列已满，调用方应返回503
+    """
+    pass
+
+def configure_password_hasher(rounds: int = 12, workers: int = None, max_queue: int = 32):
+    """
+    配置bcrypt cost和线程池
+
+    Args:
+        rounds: bcrypt cost
+        workers: 并发执行的哈希数
+        max_queue: 允许排队等待的请求数，超过则直接拒绝
+    """
+    global _executor, _slots, _rounds
+    workers = workers or os.cpu_count() or 2
+
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        _slots = threading.BoundedSemaphore(workers + max_queue)
+        _rounds = rounds
+
+def init_password_hasher(app):
+    """
+    根据配置初始化；BCRYPT_ROUNDS为0时按目标延迟校准cost
+    校准推迟到第一次哈希，CLI命令和导入app时不会跑bcrypt
+    """
+    global _calibration
+    rounds = app.config['BCRYPT_ROUNDS']
+    configure_password_hasher(
+        rounds=rounds or _rounds,
+        workers=app.config['BCRYPT_WORKERS'],
+        max_queue=app.config['BCRYPT_MAX_QUEUE']
+    )
+    if rounds:
+        _calibration = None
+        app.logger.info(f"bcrypt cost set to {rounds}")
+    else:
+        _calibration = (app.config['BCRYPT_TARGET_MS'], app.config['BCRYPT_MIN_ROUNDS'])
+
+def _current_rounds() -> int:
+    """
+    返回当前cost，需要时先完成校准
+    """
+    global _rounds, _calibration
+    if _calibration is not None:
+        with _lock:
+            if _calibration is not None:
+                target_ms, min_rounds = _calibration
+                _rounds = calibrate_rounds(target_ms, min_rounds=min_rounds)
+                _calibration = None
+    return _rounds
+
+def calibrate_rounds(target_ms: float, min_rounds: int = 10, max_rounds: int = 16) -> int:
+    """
+    选择耗时不超过target_ms的最大cost
+    cost每加1耗时翻倍，所以只需在min_rounds测一次
+    """
+    start = time.perf_counter()
+    bcrypt.hashpw(b'calibration', bcrypt.gensalt(min_rounds))
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    rounds = min_rounds
+    while rounds < max_rounds and elapsed_ms * 2 <= target_ms:
+        rounds += 1
+        elapsed_ms *= 2
+    return rounds
+
+def _run(fn, *args):
+    """
+    在哈希线程池中执行，队列满时立即抛出PasswordHasherBusy
+    """
+    if _executor is None:
+        configure_password_hasher(rounds=_rounds)
+
+    slots = _slots
+    if not slots.acquire(blocking=False):
+        raise PasswordHasherBusy()
+
+    try:
+        future = _executor.submit(fn, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future.result()
 
 def hash_password(password: str) -> str:
     """
     使用bcrypt加密密码
     """
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
+    salt = bcrypt.gensalt(_current_rounds())
+    hashed = _run(bcrypt.hashpw, password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
 def verify_password(password: str, password_hash: str) -> bool:
     """
     验证密码
     """
-    return bcrypt.checkpw(
-        password.encode('utf-8'), 
+    return _run(
+        bcrypt.checkpw,
+        password.encode('utf-8'),
         password_hash.encode('utf-8')
-    )
\ No newline at end of file
+    )
+
+def needs_rehash(password_hash: str) -> bool:
+    """
+    已存储的hash使用的cost低于当前cost时需要重新哈希
+    格式: $2b$<cost>$<salt+hash>
+    """
+    try:
+        cost = int(password_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return cost < _current_rounds()
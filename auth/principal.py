@@ -0,0 +1,104 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession, object_session
+from models import db, User, Patient
+from services.cache import TTLCache
+
+# 用户主体缓存：user_id -> Principal
+# 只保存鉴权需要的字段，避免每个请求都加载完整的User行
+principal_cache = TTLCache('principal', max_size=10000, ttl=30)
+
+
+class Principal:
+    """
+    已认证用户的精简信息
+    """
+    __slots__ = ('user_id', 'role', 'is_active', 'patient_id')
+
+    def __init__(self, user_id: int, role: str, is_active: bool, patient_id: int = None):
+        self.user_id = user_id
+        self.role = role
+        self.is_active = is_active
+        self.patient_id = patient_id
+
+    def __repr__(self):
+        return f'<Principal {self.user_id} {self.role}>'
+
+
+def init_principal_cache(app):
+    """
+    根据配置初始化主体缓存
+    """
+    principal_cache.configure(
+        max_size=app.config['PRINCIPAL_CACHE_MAX_SIZE'],
+        ttl=app.config['PRINCIPAL_CACHE_TTL']
+    )
+
+
+def load_principal(user_id: int) -> Principal:
+    """
+    获取用户主体，缓存未命中时只查询需要的列
+    返回Principal或None
+    """
+    principal = principal_cache.get(user_id)
+    if principal is not None:
+        return principal
+
+    # 同一次查询里解析patient_id，路由不必再查Patient表
+    row = db.session.query(User.id, User.role, User.is_active, Patient.id.label('patient_id'))\
+        .outerjoin(Patient, Patient.user_id == User.id)\
+        .filter(User.id == user_id).first()
+    if not row:
+        return None
+
+    principal = Principal(row.id, row.role, bool(row.is_active), row.patient_id)
+    principal_cache.set(user_id, principal)
+    return principal
+
+
+def invalidate_principal(user_id: int):
+    """
+    用户停用或角色变化时使缓存失效
+    """
+    principal_cache.pop(user_id)
+
+
+# ============ 自动失效 ============
+# flush时立即失效，提交后再失效一次，
+# 防止提交前有并发请求把旧值重新写入缓存
+
+def _mark_changed(target, user_id: int = None):
+    user_id = user_id if user_id is not None else target.id
+    invalidate_principal(user_id)
+    session = object_session(target)
+    session.info.setdefault('principal_invalidations', set()).add(user_id)
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    state = db.inspect(target)
+    if state.attrs.role.history.has_changes() or state.attrs.is_active.history.has_changes():
+        _mark_changed(target)
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    _mark_changed(target)
+
+
+@event.listens_for(Patient, 'after_insert')
+@event.listens_for(Patient, 'after_delete')
+def _patient_changed(mapper, connection, target):
+    # 患者记录的增删会改变principal.patient_id
+    if target.user_id is not None:
+        _mark_changed(target, target.user_id)
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def _invalidate_after_commit(session):
+    for user_id in session.info.pop('principal_invalidations', ()):
+        invalidate_principal(user_id)
+
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('principal_invalidations', None)
@@ -0,0 +1,242 @@
+"""
+Flask CLI命令
+运行: flask --app app <group> <command>
+"""
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from models import db
+
+# ==================== 审计日志 ====================
+
+audit_cli = AppGroup('audit', help='审计日志分区、归档和恢复')
+
+@audit_cli.command('ensure-partitions')
+@click.option('--months-ahead', type=int, default=None, help='提前创建几个月的分区')
+def ensure_partitions_command(months_ahead):
+    """创建默认分区和未来几个月的分区"""
+    from security.audit_archive import ensure_partitions
+    
+    months_ahead = months_ahead if months_ahead is not None else current_app.config['AUDIT_PARTITIONS_AHEAD']
+    with db.engine.begin() as connection:
+        created = ensure_partitions(connection, months_ahead)
+    click.echo(f"Created partitions: {', '.join(created) or 'none'}")
+
+@audit_cli.command('archive')
+@click.option('--retain-months', type=int, default=None, help='热表保留的月数')
+@click.option('--out-dir', default=None, help='归档目录')
+@click.option('--include-restored', is_flag=True, help='同时重新归档之前恢复过的月份')
+def archive_command(retain_months, out_dir, include_restored):
+    """归档并删除超过保留期的分区"""
+    from security.audit_archive import archive_partitions
+    
+    archived = archive_partitions(
+        out_dir or current_app.config['AUDIT_ARCHIVE_DIR'],
+        retain_months if retain_months is not None else current_app.config['AUDIT_RETENTION_MONTHS'],
+        include_restored=include_restored,
+        log=click.echo
+    )
+    click.echo(f"Archived {len(archived)} partition(s)")
+
+@audit_cli.command('restore')
+@click.option('--from', 'start', required=True, help='起始月份 YYYY-MM')
+@click.option('--to', 'end', required=True, help='结束月份 YYYY-MM')
+@click.option('--out-dir', default=None, help='归档目录')
+def restore_command(start, end, out_dir):
+    """把归档的月份重新导入热表"""
+    from security.audit_archive import restore_partitions, parse_month
+    
+    restored = restore_partitions(
+        out_dir or current_app.config['AUDIT_ARCHIVE_DIR'],
+        parse_month(start),
+        parse_month(end),
+        log=click.echo
+    )
+    click.echo(f"Restored {len(restored)} partition(s)")
+
+@audit_cli.command('query')
+@click.option('--user-id', type=int, default=None)
+@click.option('--resource-type', default=None)
+@click.option('--resource-id', type=int, default=None)
+@click.option('--action', default=None)
+@click.option('--since', type=click.DateTime(), default=None, help='起始时间（包含）')
+@click.option('--until', type=click.DateTime(), default=None, help='结束时间（不包含）')
+@click.option('--output', type=click.File('w'), default='-', help='输出文件，默认stdout')
+def query_command(user_id, resource_type, resource_id, action, since, until, output):
+    """按条件导出审计日志（NDJSON，最新的在前）"""
+    import json
+    from security.audit_query import iter_audit_logs, serialize_audit_log
+    
+    filters = {
+        'user_id': user_id,
+        'resource_type': resource_type,
+        'resource_id': resource_id,
+        'action': action,
+        'since': since,
+        'until': until
+    }
+    for row in iter_audit_logs(filters, current_app.config['AUDIT_QUERY_MAX_PAGE_SIZE']):
+        output.write(json.dumps(serialize_audit_log(row)) + '\n')
+
+# ==================== 加密key轮换 ====================
+
+crypto_cli = AppGroup('crypto', help='加密字段维护')
+
+@crypto_cli.command('reencrypt')
+@click.option('--batch-size', type=int, default=None, help='每批处理的行数')
+@click.option('--restart', is_flag=True, help='忽略之前的进度，从头开始')
+def reencrypt_command(batch_size, restart):
+    """用当前ENCRYPTION_KEY重新加密所有加密字段（可中断后继续）"""
+    from security.key_rotation import reencrypt_all
+    
+    processed = reencrypt_all(
+        current_app.config['ENCRYPTION_KEY'],
+        current_app.config['ENCRYPTION_REENCRYPT_STATE_PATH'],
+        batch_size=batch_size or current_app.config['ENCRYPTION_REENCRYPT_BATCH_SIZE'],
+        restart=restart,
+        log=click.echo
+    )
+    click.echo(f"Re-encrypted {sum(processed.values())} value(s)")
+
+@crypto_cli.command('backfill-blind-index')
+@click.option('--batch-size', type=int, default=None, help='每批处理的行数')
+@click.option('--recompute-all', is_flag=True, help='重算所有行（更换BLIND_INDEX_KEY之后）')
+def backfill_blind_index_command(batch_size, recompute_all):
+    """为已有的SSN/保险ID计算盲索引"""
+    from security.blind_index import backfill_blind_indexes
+    
+    processed = backfill_blind_indexes(
+        batch_size=batch_size or current_app.config['ENCRYPTION_REENCRYPT_BATCH_SIZE'],
+        recompute_all=recompute_all,
+        log=click.echo
+    )
+    click.echo(f"Indexed {sum(processed.values())} value(s)")
+
+# ==================== 患者数据维护 ====================
+
+patients_cli = AppGroup('patients', help='患者数据维护')
+
+@patients_cli.command('repair-summaries')
+@click.option('--batch-size', type=int, default=1000, help='每批处理的患者数')
+def repair_summaries_command(batch_size):
+    """按visits重新计算patients.last_visit_at和visit_count"""
+    from services.visit_summary import repair_summaries
+    
+    done = repair_summaries(batch_size=batch_size, log=click.echo)
+    click.echo(f"Repaired {done} patient(s)")
+
+@patients_cli.command('reindex-search')
+@click.option('--batch-size', type=int, default=1000, help='每批处理的患者数')
+def reindex_search_command(batch_size):
+    """重新计算姓名查找用的search_name/name_keys"""
+    from services.patient_search import reindex_search_names
+    
+    done = reindex_search_names(batch_size=batch_size, log=click.echo)
+    click.echo(f"Reindexed {done} patient(s)")
+
+# ==================== 就诊记录 ====================
+
+visits_cli = AppGroup('visits', help='就诊记录维护')
+
+@visits_cli.command('prune-events')
+@click.option('--retain-days', type=int, default=None, help='保留最近几天的变更事件')
+def prune_events_command(retain_days):
+    """删除超过保留期的visit_events（SSE断线续传只需要最近的事件）"""
+    from services.visit_events import prune_events
+    
+    retain_days = retain_days if retain_days is not None else current_app.config['VISIT_EVENTS_RETENTION_DAYS']
+    click.echo(f"Deleted {prune_events(retain_days)} event(s)")
+
+@visits_cli.command('rebuild-rollups')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), default=None, help='起始日期（包含），默认最早的就诊')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), default=None, help='结束日期（不包含），默认最后一次就诊的次日')
+@click.option('--batch-days', type=int, default=31, help='每个事务重算的天数')
+def rebuild_rollups_command(since, until, batch_days):
+    """按visits重算每日统计汇总（visit_daily_counts / visit_daily_waits），也用于首次回填"""
+    from services.visit_rollups import rebuild_rollups
+    
+    done = rebuild_rollups(since.date() if since else None, until.date() if until else None,
+                           batch_days=batch_days, log=click.echo)
+    click.echo(f"Rebuilt {done} day(s)")
+
+# ==================== 数据导出 ====================
+
+export_cli = AppGroup('export', help='患者/就诊/症状数据导出')
+
+@export_cli.command('run')
+@click.argument('dataset', type=click.Choice(['patients', 'visits', 'symptoms']))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default='csv')
+@click.option('--gzip', is_flag=True, help='gzip压缩输出')
+@click.option('--decrypt', is_flag=True, help='包含解密后的SSN/保险ID')
+@click.option('--since', type=click.DateTime(), default=None, help='起始时间（包含）')
+@click.option('--until', type=click.DateTime(), default=None, help='结束时间（不包含）')
+@click.option('--output', '-o', required=True, help='输出文件，- 表示标准输出')
+def export_command(dataset, fmt, gzip, decrypt, since, until, output):
+    """流式导出一个数据集（服务端游标，内存占用与表大小无关）"""
+    from services.export import export_stream
+    from models import AuditLog
+    from datetime import datetime
+    
+    stream = export_stream(dataset, fmt, gzip, decrypt, since, until, current_app.config['EXPORT_BATCH_SIZE'])
+    with click.open_file(output, 'wb') as f:
+        for chunk in stream:
+            f.write(chunk)
+    
+    # 命令行没有请求上下文，直接写审计记录
+    with db.engine.begin() as connection:
+        connection.execute(db.insert(AuditLog), [{
+            'action': 'export',
+            'resource_type': dataset,
+            'user_agent': 'flask export run',
+            'timestamp': datetime.utcnow(),
+            'details': {'format': fmt, 'gzip': gzip, 'decrypt': decrypt, 'output': output}
+        }])
+
+# ==================== 语音分析任务 ====================
+
+audio_jobs_cli = AppGroup('audio-jobs', help='语音转录和症状分析任务')
+
+@audio_jobs_cli.command('work')
+@click.option('--workers', type=int, default=None, help='线程数，默认AUDIO_JOB_WORKERS')
+def audio_jobs_work_command(workers):
+    """在前台执行排队的语音分析任务（独立的worker进程，Ctrl-C退出）"""
+    from services.audio_jobs import audio_workers
+    
+    workers = workers or current_app.config['AUDIO_JOB_WORKERS'] or 1
+    audio_workers.start(current_app._get_current_object(), workers=workers)
+    click.echo(f"Processing audio jobs with {workers} worker(s)")
+    try:
+        audio_workers.join()
+    except KeyboardInterrupt:
+        click.echo("Finishing running jobs...")
+        audio_workers.stop()
+
+@audio_jobs_cli.command('prune-transcriptions')
+@click.option('--retain-days', type=int, default=None, help='保留最近几天用过的转录缓存')
+def prune_transcriptions_command(retain_days):
+    """删除长时间没有命中的转录缓存"""
+    from services.transcription_cache import prune_transcriptions
+    
+    retain_days = retain_days if retain_days is not None else current_app.config['TRANSCRIPTION_CACHE_RETENTION_DAYS']
+    click.echo(f"Deleted {prune_transcriptions(retain_days)} transcription(s)")
+
+@audio_jobs_cli.command('prune-analyses')
+@click.option('--max-entries', type=int, default=None, help='最多保留的条目数，默认ANALYSIS_CACHE_DB_MAX_ENTRIES')
+def prune_analyses_command(max_entries):
+    """删除过期的、旧提示词版本的症状分析缓存，并按最后使用时间淘汰多余的条目"""
+    from services.analysis_cache import prune_analyses
+    from services.ai_service import ANALYSIS_PROMPT_VERSION
+    
+    max_entries = max_entries if max_entries is not None else current_app.config['ANALYSIS_CACHE_DB_MAX_ENTRIES']
+    click.echo(f"Deleted {prune_analyses(ANALYSIS_PROMPT_VERSION, max_entries)} cached analysis result(s)")
+
+def register_commands(app):
+    """
+    注册所有CLI命令
+    """
+    app.cli.add_command(audit_cli)
+    app.cli.add_command(crypto_cli)
+    app.cli.add_command(patients_cli)
+    app.cli.add_command(visits_cli)
+    app.cli.add_command(export_cli)
+    app.cli.add_command(audio_jobs_cli)
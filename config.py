@@ -20,12 +20,117 @@ class Config:
         seconds=int(os.getenv('JWT_ACCESS_TOKEN_EXPIRES', 3600))
     )
     
-    # Encryption
+    # Token缓存（其他worker撤销的token最多STALENESS秒后失效）
+    TOKEN_CACHE_MAX_SIZE = int(os.getenv('TOKEN_CACHE_MAX_SIZE', 10000))
+    TOKEN_CACHE_STALENESS = int(os.getenv('TOKEN_CACHE_STALENESS', 30))
+    
+    # 用户主体缓存（id/role/is_active）
+    PRINCIPAL_CACHE_MAX_SIZE = int(os.getenv('PRINCIPAL_CACHE_MAX_SIZE', 10000))
+    PRINCIPAL_CACHE_TTL = int(os.getenv('PRINCIPAL_CACHE_TTL', 30))
+    
+    # 密码哈希（BCRYPT_ROUNDS=0时启动时按目标延迟校准）
+    BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 0))
+    BCRYPT_TARGET_MS = int(os.getenv('BCRYPT_TARGET_MS', 250))
+    BCRYPT_MIN_ROUNDS = int(os.getenv('BCRYPT_MIN_ROUNDS', 10))
+    BCRYPT_WORKERS = int(os.getenv('BCRYPT_WORKERS', 0)) or None
+    BCRYPT_MAX_QUEUE = int(os.getenv('BCRYPT_MAX_QUEUE', 32))
+    
+    # Encryption（ENCRYPTION_OLD_KEYS: 逗号分隔的旧key，只用于解密）
     ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY')
+    ENCRYPTION_OLD_KEYS = [k for k in os.getenv('ENCRYPTION_OLD_KEYS', '').split(',') if k]
+    ENCRYPTION_REENCRYPT_BATCH_SIZE = int(os.getenv('ENCRYPTION_REENCRYPT_BATCH_SIZE', 500))
+    ENCRYPTION_REENCRYPT_STATE_PATH = os.getenv('ENCRYPTION_REENCRYPT_STATE_PATH', 'reencrypt_state.json')
+    
+    # 盲索引HMAC key（必须配置；不随ENCRYPTION_KEY轮换，更换后需要重算索引）
+    BLIND_INDEX_KEY = os.getenv('BLIND_INDEX_KEY')
+    
+    # 审计日志（异步批量写入，数据库不可用时写spool文件）
+    AUDIT_ASYNC = os.getenv('AUDIT_ASYNC', 'true').lower() == 'true'
+    AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', 200))
+    AUDIT_MAX_LATENCY_MS = int(os.getenv('AUDIT_MAX_LATENCY_MS', 500))
+    AUDIT_QUEUE_MAX = int(os.getenv('AUDIT_QUEUE_MAX', 10000))
+    AUDIT_SPOOL_PATH = os.getenv('AUDIT_SPOOL_PATH', 'audit_spool.jsonl')
+    
+    # 审计日志分区和归档
+    AUDIT_PARTITIONS_AHEAD = int(os.getenv('AUDIT_PARTITIONS_AHEAD', 3))
+    AUDIT_RETENTION_MONTHS = int(os.getenv('AUDIT_RETENTION_MONTHS', 12))
+    AUDIT_ARCHIVE_DIR = os.getenv('AUDIT_ARCHIVE_DIR', 'audit_archive')
+    
+    # 审计日志查询（keyset分页）
+    AUDIT_QUERY_PAGE_SIZE = int(os.getenv('AUDIT_QUERY_PAGE_SIZE', 100))
+    AUDIT_QUERY_MAX_PAGE_SIZE = int(os.getenv('AUDIT_QUERY_MAX_PAGE_SIZE', 1000))
+    
+    # 列表分页
+    PATIENT_LIST_PAGE_SIZE = int(os.getenv('PATIENT_LIST_PAGE_SIZE', 50))
+    PATIENT_LIST_MAX_PAGE_SIZE = int(os.getenv('PATIENT_LIST_MAX_PAGE_SIZE', 200))
+    VISIT_RECENT_PAGE_SIZE = int(os.getenv('VISIT_RECENT_PAGE_SIZE', 10))
+    VISIT_RECENT_MAX_PAGE_SIZE = int(os.getenv('VISIT_RECENT_MAX_PAGE_SIZE', 100))
+    TRIAGE_QUEUE_SIZE = int(os.getenv('TRIAGE_QUEUE_SIZE', 20))
+    TRIAGE_QUEUE_MAX_SIZE = int(os.getenv('TRIAGE_QUEUE_MAX_SIZE', 100))
+    BULK_STATUS_MAX_VISITS = int(os.getenv('BULK_STATUS_MAX_VISITS', 1000))
+    SYMPTOM_SEARCH_PAGE_SIZE = int(os.getenv('SYMPTOM_SEARCH_PAGE_SIZE', 20))
+    SYMPTOM_SEARCH_MAX_PAGE_SIZE = int(os.getenv('SYMPTOM_SEARCH_MAX_PAGE_SIZE', 100))
+    
+    # 每日就诊统计（只读汇总表）
+    VISIT_STATS_DAYS = int(os.getenv('VISIT_STATS_DAYS', 90))
+    VISIT_STATS_MAX_DAYS = int(os.getenv('VISIT_STATS_MAX_DAYS', 366))
+    
+    # 症状统计（按时间桶缓存，已结束的桶缓存TTL秒）
+    SYMPTOM_STATS_MAX_BUCKETS = int(os.getenv('SYMPTOM_STATS_MAX_BUCKETS', 366))
+    SYMPTOM_STATS_LIMIT = int(os.getenv('SYMPTOM_STATS_LIMIT', 10))
+    SYMPTOM_STATS_MAX_LIMIT = int(os.getenv('SYMPTOM_STATS_MAX_LIMIT', 100))
+    SYMPTOM_STATS_CACHE_SIZE = int(os.getenv('SYMPTOM_STATS_CACHE_SIZE', 4096))
+    SYMPTOM_STATS_CACHE_TTL = int(os.getenv('SYMPTOM_STATS_CACHE_TTL', 3600))
+    
+    # staff看板读接口的响应缓存（每个接口的条目数、TTL、单条大小上限）
+    RESPONSE_CACHE_MAX_SIZE = int(os.getenv('RESPONSE_CACHE_MAX_SIZE', 256))
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 30))
+    RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRY_BYTES', 256 * 1024))
+    
+    # 就诊变更推送（SSE）
+    VISIT_EVENTS_BUFFER = int(os.getenv('VISIT_EVENTS_BUFFER', 1000))  # 进程内缓冲的最近事件数
+    VISIT_EVENTS_RESUME_MAX = int(os.getenv('VISIT_EVENTS_RESUME_MAX', 1000))  # 重连时最多从表里补读的事件数
+    VISIT_EVENTS_POLL_INTERVAL = float(os.getenv('VISIT_EVENTS_POLL_INTERVAL', 1))
+    VISIT_EVENTS_HEARTBEAT = int(os.getenv('VISIT_EVENTS_HEARTBEAT', 15))
+    VISIT_EVENTS_STREAM_SECONDS = int(os.getenv('VISIT_EVENTS_STREAM_SECONDS', 300))  # 到时断开，客户端带Last-Event-ID重连
+    VISIT_EVENTS_RETRY_MS = int(os.getenv('VISIT_EVENTS_RETRY_MS', 2000))
+    VISIT_EVENTS_RETENTION_DAYS = int(os.getenv('VISIT_EVENTS_RETENTION_DAYS', 7))
+    
+    # 数据导出（每批行数；允许导出解密字段的角色，逗号分隔，默认没有）
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+    EXPORT_DECRYPT_ROLES = [role for role in os.getenv('EXPORT_DECRYPT_ROLES', '').split(',') if role]
+    
+    # 患者详情里内嵌的就诊记录分页
+    PATIENT_DETAIL_VISITS_PAGE_SIZE = int(os.getenv('PATIENT_DETAIL_VISITS_PAGE_SIZE', 20))
+    PATIENT_DETAIL_VISITS_MAX_PAGE_SIZE = int(os.getenv('PATIENT_DETAIL_VISITS_MAX_PAGE_SIZE', 100))
+    
+    # 回诊患者查找（结果数硬上限，参与排序的候选数上限）
+    PATIENT_SEARCH_MAX_RESULTS = int(os.getenv('PATIENT_SEARCH_MAX_RESULTS', 20))
+    PATIENT_SEARCH_CANDIDATES = int(os.getenv('PATIENT_SEARCH_CANDIDATES', 200))
     
     # API Keys
     ASSEMBLYAI_API_KEY = os.getenv('ASSEMBLYAI_API_KEY')
     PERPLEXITY_API_KEY = os.getenv('PERPLEXITY_API_KEY')
+    # 转录语言（空表示使用AssemblyAI的默认设置），属于转录缓存key的一部分
+    ASSEMBLYAI_LANGUAGE_CODE = os.getenv('ASSEMBLYAI_LANGUAGE_CODE') or None
+    TRANSCRIPTION_CACHE_ENABLED = os.getenv('TRANSCRIPTION_CACHE_ENABLED', 'true').lower() == 'true'
+    TRANSCRIPTION_CACHE_RETENTION_DAYS = int(os.getenv('TRANSCRIPTION_CACHE_RETENTION_DAYS', 90))
+    # 症状分析结果缓存：进程内（条目数、TTL秒） + 数据库（保留天数、条目数上限）
+    ANALYSIS_CACHE_ENABLED = os.getenv('ANALYSIS_CACHE_ENABLED', 'true').lower() == 'true'
+    ANALYSIS_CACHE_SIZE = int(os.getenv('ANALYSIS_CACHE_SIZE', 1024))
+    ANALYSIS_CACHE_TTL = int(os.getenv('ANALYSIS_CACHE_TTL', 3600))
+    ANALYSIS_CACHE_DB_TTL_DAYS = int(os.getenv('ANALYSIS_CACHE_DB_TTL_DAYS', 30))
+    ANALYSIS_CACHE_DB_MAX_ENTRIES = int(os.getenv('ANALYSIS_CACHE_DB_MAX_ENTRIES', 100000))
+    
+    # 语音分析任务（services/audio_jobs.py）
+    # AUDIO_JOB_WORKERS: 每个web进程的后台线程数，0表示只由`flask audio-jobs work`执行
+    AUDIO_JOB_WORKERS = int(os.getenv('AUDIO_JOB_WORKERS', 2))
+    AUDIO_JOB_MAX_ATTEMPTS = int(os.getenv('AUDIO_JOB_MAX_ATTEMPTS', 4))
+    AUDIO_JOB_RETRY_BASE_SECONDS = float(os.getenv('AUDIO_JOB_RETRY_BASE_SECONDS', 5))
+    AUDIO_JOB_RETRY_MAX_SECONDS = float(os.getenv('AUDIO_JOB_RETRY_MAX_SECONDS', 300))
+    AUDIO_JOB_LEASE_SECONDS = int(os.getenv('AUDIO_JOB_LEASE_SECONDS', 300))
+    AUDIO_JOB_POLL_INTERVAL = float(os.getenv('AUDIO_JOB_POLL_INTERVAL', 1.0))
+    AUDIO_JOB_STREAM_SECONDS = int(os.getenv('AUDIO_JOB_STREAM_SECONDS', 120))
     
     # File Upload
     UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'uploads')
@@ -5,6 +5,8 @@
 from app import app, db
 from models import User, Patient, Insurance, Visit, AuditLog, Session
 from auth.password_utils import hash_password
+from security.audit_archive import ensure_partitions
+from flask_migrate import stamp
 from datetime import datetime
 
 def init_database():
@@ -18,6 +20,13 @@ def init_database():
         print("Creating all tables...")
         db.create_all()
         
+        # audit_logs是分区表，需要先建分区才能写入
+        with db.engine.begin() as connection:
+            ensure_partitions(connection, app.config['AUDIT_PARTITIONS_AHEAD'])
+        
+        # 标记为最新的migration版本，之后用`flask db upgrade`升级
+        stamp()
+        
         # 创建测试用户
         print("Creating test users...")
         
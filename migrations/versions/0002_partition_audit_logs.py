@@ -0,0 +1,98 @@
+"""partition audit_logs by month
+
+Rebuilds audit_logs as a table partitioned by RANGE (timestamp):
+the old table is renamed, a partitioned parent with primary key
+(id, timestamp) is created, monthly partitions are created to cover the
+existing rows plus the next three months, rows are copied across and the
+old table is dropped. The id sequence is reused so ids keep increasing.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:20:00.000000
+
+"""
+from datetime import date, datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+MONTHS_AHEAD = 3
+
+COLUMNS = 'id, user_id, action, resource_type, resource_id, ip_address, user_agent, timestamp, details'
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def upgrade():
+    op.execute("ALTER TABLE audit_logs RENAME TO audit_logs_legacy")
+    op.execute("ALTER INDEX audit_logs_pkey RENAME TO audit_logs_legacy_pkey")
+    op.execute("""
+        CREATE TABLE audit_logs (
+            id INTEGER NOT NULL DEFAULT nextval('audit_logs_id_seq'),
+            user_id INTEGER REFERENCES users (id),
+            action VARCHAR(100) NOT NULL,
+            resource_type VARCHAR(50) NOT NULL,
+            resource_id INTEGER,
+            ip_address VARCHAR(45),
+            user_agent TEXT,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            details JSONB,
+            CONSTRAINT audit_logs_pkey PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """)
+    op.execute("ALTER SEQUENCE audit_logs_id_seq OWNED BY audit_logs.id")
+    op.execute("CREATE TABLE audit_logs_default PARTITION OF audit_logs DEFAULT")
+
+    # 覆盖已有数据的最早月份到未来几个月
+    connection = op.get_bind()
+    oldest = connection.execute(sa.text("SELECT min(timestamp) FROM audit_logs_legacy")).scalar()
+    current = date(datetime.utcnow().year, datetime.utcnow().month, 1)
+    month = date(oldest.year, oldest.month, 1) if oldest and oldest < datetime.utcnow() else current
+    last = _add_months(current, MONTHS_AHEAD)
+    while month <= last:
+        end = _add_months(month, 1)
+        op.execute(
+            f"CREATE TABLE audit_logs_y{month.year:04d}m{month.month:02d} PARTITION OF audit_logs "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{end.isoformat()}')"
+        )
+        month = end
+
+    op.execute(f"""
+        INSERT INTO audit_logs ({COLUMNS})
+        SELECT id, user_id, action, resource_type, resource_id, ip_address, user_agent,
+               coalesce(timestamp, now() AT TIME ZONE 'utc'), details
+        FROM audit_logs_legacy
+    """)
+    op.execute("DROP TABLE audit_logs_legacy")
+
+
+def downgrade():
+    op.execute("ALTER TABLE audit_logs RENAME TO audit_logs_partitioned")
+    op.execute("ALTER INDEX audit_logs_pkey RENAME TO audit_logs_partitioned_pkey")
+    op.execute("""
+        CREATE TABLE audit_logs (
+            id INTEGER NOT NULL DEFAULT nextval('audit_logs_id_seq'),
+            user_id INTEGER REFERENCES users (id),
+            action VARCHAR(100) NOT NULL,
+            resource_type VARCHAR(50) NOT NULL,
+            resource_id INTEGER,
+            ip_address VARCHAR(45),
+            user_agent TEXT,
+            timestamp TIMESTAMP WITHOUT TIME ZONE,
+            details JSONB,
+            CONSTRAINT audit_logs_pkey PRIMARY KEY (id)
+        )
+    """)
+    op.execute("ALTER SEQUENCE audit_logs_id_seq OWNED BY audit_logs.id")
+    op.execute(f"INSERT INTO audit_logs ({COLUMNS}) SELECT {COLUMNS} FROM audit_logs_partitioned")
+    # 删除父表会同时删除所有分区
+    op.execute("DROP TABLE audit_logs_partitioned")
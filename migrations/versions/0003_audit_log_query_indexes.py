@@ -0,0 +1,35 @@
+"""audit_logs query indexes
+
+Composite indexes ending in (timestamp, id) for the keyset-paginated audit
+query API. Indexes created on the partitioned parent are created on every
+existing partition and on partitions created later.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 11:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_audit_logs_timestamp_id', 'audit_logs', ['timestamp', 'id'])
+    op.create_index('ix_audit_logs_user_timestamp', 'audit_logs', ['user_id', 'timestamp', 'id'])
+    op.create_index('ix_audit_logs_resource_timestamp', 'audit_logs',
+                    ['resource_type', 'resource_id', 'timestamp', 'id'])
+    op.create_index('ix_audit_logs_action_timestamp', 'audit_logs', ['action', 'timestamp', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_audit_logs_action_timestamp', table_name='audit_logs')
+    op.drop_index('ix_audit_logs_resource_timestamp', table_name='audit_logs')
+    op.drop_index('ix_audit_logs_user_timestamp', table_name='audit_logs')
+    op.drop_index('ix_audit_logs_timestamp_id', table_name='audit_logs')
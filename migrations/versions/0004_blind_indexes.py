@@ -0,0 +1,34 @@
+"""blind index columns for encrypted SSN and insurance ID
+
+Adds keyed HMAC columns next to the Fernet-encrypted values so exact-match
+lookups can use a btree index. Existing rows are populated with
+`flask crypto backfill-blind-index`.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 11:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('patients', sa.Column('ssn_bidx', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_patients_ssn_bidx'), 'patients', ['ssn_bidx'], unique=False)
+    op.add_column('insurance', sa.Column('insurance_id_bidx', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_insurance_insurance_id_bidx'), 'insurance', ['insurance_id_bidx'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_insurance_insurance_id_bidx'), table_name='insurance')
+    op.drop_column('insurance', 'insurance_id_bidx')
+    op.drop_index(op.f('ix_patients_ssn_bidx'), table_name='patients')
+    op.drop_column('patients', 'ssn_bidx')
@@ -0,0 +1,26 @@
+"""visits (patient_id, visit_date) index
+
+Serves the per-patient "last visit" lookup in the patient list.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 12:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_visits_patient_id_visit_date', 'visits', ['patient_id', 'visit_date'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_visits_patient_id_visit_date', table_name='visits')
@@ -0,0 +1,41 @@
+"""patients.last_visit_at and visit_count
+
+Denormalized visit summary maintained on every Visit write (see
+services/visit_summary.py). Existing rows are populated from visits.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 12:45:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('patients', sa.Column('last_visit_at', sa.DateTime(), nullable=True))
+    op.add_column('patients', sa.Column('visit_count', sa.Integer(), server_default='0', nullable=False))
+    op.execute("""
+        UPDATE patients p
+        SET visit_count = s.visit_count, last_visit_at = s.last_visit_at
+        FROM (
+            SELECT patient_id, count(*) AS visit_count, max(visit_date) AS last_visit_at
+            FROM visits GROUP BY patient_id
+        ) s
+        WHERE p.id = s.patient_id
+    """)
+    op.create_index('ix_patients_last_visit_at_id', 'patients',
+                    [sa.text('last_visit_at DESC NULLS LAST'), sa.text('id DESC')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_patients_last_visit_at_id', table_name='patients')
+    op.drop_column('patients', 'visit_count')
+    op.drop_column('patients', 'last_visit_at')
@@ -0,0 +1,67 @@
+"""patient name search columns
+
+Adds patients.search_name (normalized name, prefix index) and
+patients.name_keys (per-token lookup keys, GIN index) for the
+returning-patient search, plus an index on date_of_birth. Existing rows are
+filled in batches using the same normalization as the application.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 13:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    from services.patient_search import normalize_name, name_keys
+
+    op.add_column('patients', sa.Column('search_name', sa.String(length=255), nullable=True))
+    op.add_column('patients', sa.Column('name_keys', postgresql.ARRAY(sa.String(length=64)), nullable=True))
+
+    connection = op.get_bind()
+    patients = sa.table('patients', sa.column('id', sa.Integer), sa.column('full_name', sa.String),
+                        sa.column('search_name', sa.String),
+                        sa.column('name_keys', postgresql.ARRAY(sa.String)))
+    statement = patients.update()\
+        .where(patients.c.id == sa.bindparam('row_id'))\
+        .values(search_name=sa.bindparam('normalized'), name_keys=sa.bindparam('keys'))
+
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(patients.c.id, patients.c.full_name)
+            .where(patients.c.id > last_id).order_by(patients.c.id).limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        params = []
+        for row_id, full_name in rows:
+            normalized = normalize_name(full_name)
+            params.append({'row_id': row_id, 'normalized': normalized, 'keys': name_keys(normalized)})
+        connection.execute(statement, params)
+        last_id = rows[-1][0]
+
+    op.create_index('ix_patients_search_name', 'patients', ['search_name'], unique=False,
+                    postgresql_ops={'search_name': 'varchar_pattern_ops'})
+    op.create_index('ix_patients_name_keys', 'patients', ['name_keys'], unique=False, postgresql_using='gin')
+    op.create_index(op.f('ix_patients_date_of_birth'), 'patients', ['date_of_birth'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_patients_date_of_birth'), table_name='patients')
+    op.drop_index('ix_patients_name_keys', table_name='patients', postgresql_using='gin')
+    op.drop_index('ix_patients_search_name', table_name='patients')
+    op.drop_column('patients', 'name_keys')
+    op.drop_column('patients', 'search_name')
@@ -0,0 +1,41 @@
+"""visit_events table
+
+Change feed behind the staff dashboard SSE stream (see
+services/visit_events.py). Rows are written in the same transaction as the
+visit change and read in (txid, id) order.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 14:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('visit_events',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('txid', sa.BigInteger(), server_default=sa.text('(pg_current_xact_id()::text)::bigint'), nullable=False),
+        sa.Column('visit_id', sa.Integer(), nullable=False),
+        sa.Column('patient_id', sa.Integer(), nullable=False),
+        sa.Column('event', sa.String(length=20), nullable=False),
+        sa.Column('status', sa.String(length=50), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_visit_events_txid_id', 'visit_events', ['txid', 'id'], unique=False)
+    op.create_index(op.f('ix_visit_events_created_at'), 'visit_events', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_visit_events_created_at'), table_name='visit_events')
+    op.drop_index('ix_visit_events_txid_id', table_name='visit_events')
+    op.drop_table('visit_events')
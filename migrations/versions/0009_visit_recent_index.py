@@ -0,0 +1,27 @@
+"""visits (visit_date DESC, id DESC) index
+
+Backs keyset pagination of /api/visit/recent.
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 15:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_visits_visit_date_id', 'visits',
+                    [sa.text('visit_date DESC'), sa.text('id DESC')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_visits_visit_date_id', table_name='visits')
@@ -0,0 +1,28 @@
+"""partial index for the triage queue
+
+Waiting visits ordered by pain level and arrival (see services/triage.py).
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18 15:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_visits_triage_queue', 'visits',
+                    [sa.text('pain_level DESC NULLS LAST'), 'visit_date', 'id'], unique=False,
+                    postgresql_where=sa.text("status IN ('pending', 'confirmed')"))
+
+
+def downgrade():
+    op.drop_index('ix_visits_triage_queue', table_name='visits')
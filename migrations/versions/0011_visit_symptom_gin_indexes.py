@@ -0,0 +1,33 @@
+"""GIN indexes for symptom containment search
+
+Expression indexes on the lower-cased symptoms / possible_causes arrays
+(see services/symptoms.py).
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-18 16:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0011'
+down_revision = '0010'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_visits_symptoms_lower', 'visits',
+                    [sa.text('(lower(symptoms::text)::jsonb) jsonb_path_ops')], unique=False,
+                    postgresql_using='gin')
+    op.create_index('ix_visits_possible_causes_lower', 'visits',
+                    [sa.text('(lower(possible_causes::text)::jsonb) jsonb_path_ops')], unique=False,
+                    postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_visits_possible_causes_lower', table_name='visits')
+    op.drop_index('ix_visits_symptoms_lower', table_name='visits')
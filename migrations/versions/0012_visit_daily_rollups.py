@@ -0,0 +1,75 @@
+"""daily visit rollups and visits.confirmed_at
+
+Per-day counts by status / pain level / duration and confirmation waits,
+maintained incrementally on every Visit write (see services/visit_rollups.py).
+confirmed_at is backfilled from visit_events where still available, and the
+rollups are populated from visits.
+
+Revision ID: 0012
+Revises: 0011
+Create Date: 2026-10-18 17:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0012'
+down_revision = '0011'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('visits', sa.Column('confirmed_at', sa.DateTime(), nullable=True))
+    op.execute("""
+        UPDATE visits v
+        SET confirmed_at = e.confirmed_at
+        FROM (
+            SELECT visit_id, min(created_at) AS confirmed_at
+            FROM visit_events WHERE status = 'confirmed' GROUP BY visit_id
+        ) e
+        WHERE v.id = e.visit_id
+    """)
+
+    op.create_table('visit_daily_counts',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('status', sa.String(length=50), nullable=True),
+        sa.Column('pain_level', sa.Integer(), nullable=True),
+        sa.Column('duration', sa.String(length=20), nullable=True),
+        sa.Column('visits', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('day', 'status', 'pain_level', 'duration', name='uq_visit_daily_counts_key',
+                            postgresql_nulls_not_distinct=True)
+    )
+    op.create_table('visit_daily_waits',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('confirmed', sa.Integer(), nullable=False),
+        sa.Column('wait_seconds', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('day')
+    )
+
+    op.execute("""
+        INSERT INTO visit_daily_counts (day, status, pain_level, duration, visits)
+        SELECT visit_date::date, status, pain_level,
+               CASE WHEN pain_duration IS NULL THEN NULL
+                    WHEN pain_duration IN ('hours', 'day', 'days', 'weeks', 'months') THEN pain_duration
+                    ELSE 'other' END AS duration,
+               count(*)
+        FROM visits WHERE visit_date IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+    """)
+    op.execute("""
+        INSERT INTO visit_daily_waits (day, confirmed, wait_seconds)
+        SELECT visit_date::date, count(*), sum(trunc(extract(epoch FROM confirmed_at - visit_date))::bigint)
+        FROM visits WHERE visit_date IS NOT NULL AND confirmed_at IS NOT NULL
+        GROUP BY 1
+    """)
+
+
+def downgrade():
+    op.drop_table('visit_daily_waits')
+    op.drop_table('visit_daily_counts')
+    op.drop_column('visits', 'confirmed_at')
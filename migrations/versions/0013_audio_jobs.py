@@ -0,0 +1,51 @@
+"""audio_jobs for asynchronous /api/process_audio
+
+Persisted transcription/analysis jobs claimed by background workers
+(see services/audio_jobs.py).
+
+Revision ID: 0013
+Revises: 0012
+Create Date: 2026-10-18 17:50:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '0013'
+down_revision = '0012'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('audio_jobs',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('patient_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('audio_file_path', sa.String(length=255), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('result', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+        sa.Column('visit_id', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['patient_id'], ['patients.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.ForeignKeyConstraint(['visit_id'], ['visits.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_audio_jobs_patient_id', 'audio_jobs', ['patient_id'], unique=False)
+    op.create_index('ix_audio_jobs_claim', 'audio_jobs', ['next_attempt_at'], unique=False,
+                    postgresql_where=sa.text("status IN ('queued', 'running')"))
+
+
+def downgrade():
+    op.drop_index('ix_audio_jobs_claim', table_name='audio_jobs')
+    op.drop_index('ix_audio_jobs_patient_id', table_name='audio_jobs')
+    op.drop_table('audio_jobs')
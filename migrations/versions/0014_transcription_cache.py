@@ -0,0 +1,41 @@
+"""transcription cache keyed by audio content hash
+
+transcriptions stores AssemblyAI results by (audio SHA-256, settings
+fingerprint); audio_jobs.audio_sha256 is computed while the upload is
+saved (see services/transcription_cache.py).
+
+Revision ID: 0014
+Revises: 0013
+Create Date: 2026-10-18 18:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0014'
+down_revision = '0013'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('audio_jobs', sa.Column('audio_sha256', sa.String(length=64), nullable=True))
+    op.create_table('transcriptions',
+        sa.Column('content_hash', sa.String(length=64), nullable=False),
+        sa.Column('settings_hash', sa.String(length=64), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.Column('audio_bytes', sa.BigInteger(), nullable=True),
+        sa.Column('hits', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('last_used_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('content_hash', 'settings_hash')
+    )
+    op.create_index('ix_transcriptions_last_used_at', 'transcriptions', ['last_used_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_transcriptions_last_used_at', table_name='transcriptions')
+    op.drop_table('transcriptions')
+    op.drop_column('audio_jobs', 'audio_sha256')
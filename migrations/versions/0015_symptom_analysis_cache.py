@@ -0,0 +1,41 @@
+"""symptom analysis cache
+
+analyze_symptoms results keyed by (normalized transcript, model, prompt
+version), shared by all processes behind the in-process cache (see
+services/analysis_cache.py).
+
+Revision ID: 0015
+Revises: 0014
+Create Date: 2026-10-18 18:50:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '0015'
+down_revision = '0014'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('symptom_analyses',
+        sa.Column('cache_key', sa.String(length=64), nullable=False),
+        sa.Column('model', sa.String(length=50), nullable=False),
+        sa.Column('prompt_version', sa.Integer(), nullable=False),
+        sa.Column('analysis', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column('hits', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('last_used_at', sa.DateTime(), nullable=True),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('cache_key')
+    )
+    op.create_index('ix_symptom_analyses_last_used_at', 'symptom_analyses', ['last_used_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_symptom_analyses_last_used_at', table_name='symptom_analyses')
+    op.drop_table('symptom_analyses')
@@ -0,0 +1,29 @@
+"""patient name_keys statistics target
+
+Most name lookup keys are rare, so with the default statistics target the
+planner overestimates `name_keys && ...` by one to two orders of magnitude
+and picks a parallel plan for the returning-patient search. A larger target
+keeps enough element frequencies for realistic estimates.
+
+Revision ID: 0016
+Revises: 0015
+Create Date: 2026-10-18 19:40:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0016'
+down_revision = '0015'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TABLE patients ALTER COLUMN name_keys SET STATISTICS 1000")
+    op.execute("ANALYZE patients")
+
+
+def downgrade():
+    op.execute("ALTER TABLE patients ALTER COLUMN name_keys SET STATISTICS -1")
@@ -1,6 +1,7 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import event, DDL
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY
 
 db = SQLAlchemy()
 
@@ -30,13 +31,26 @@ class Patient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True)
     full_name = db.Column(db.String(255), nullable=False)
-    date_of_birth = db.Column(db.Date, nullable=False)
+    date_of_birth = db.Column(db.Date, nullable=False, index=True)
+    # 姓名查找用，写入full_name时自动维护（services/patient_search.py）
+    search_name = db.Column(db.String(255))
+    name_keys = db.Column(ARRAY(db.String(64)))
     encrypted_ssn = db.Column(db.String(255))
+    ssn_bidx = db.Column(db.String(64), index=True)  # 盲索引，见security/blind_index.py
     phone = db.Column(db.String(20))
     address = db.Column(db.Text)
+    # 就诊汇总，写入Visit时同步维护（services/visit_summary.py）
+    last_visit_at = db.Column(db.DateTime)
+    visit_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_patients_last_visit_at_id', db.text('last_visit_at DESC NULLS LAST'), db.text('id DESC')),
+        db.Index('ix_patients_search_name', 'search_name', postgresql_ops={'search_name': 'varchar_pattern_ops'}),
+        db.Index('ix_patients_name_keys', 'name_keys', postgresql_using='gin'),
+    )
+    
     # Relationships
     insurance = db.relationship('Insurance', backref='patient', uselist=False, cascade='all, delete-orphan')
     visits = db.relationship('Visit', backref='patient', cascade='all, delete-orphan')
@@ -44,6 +58,11 @@ class Patient(db.Model):
     def __repr__(self):
         return f'<Patient {self.full_name}>'
 
+# name_keys里的key很多且大多很少见，默认统计目标下&&的行数估算偏大几十倍，
+# 查找会选并行计划；提高统计目标（和migration 0016一致）
+event.listen(Patient.__table__, 'after_create',
+             DDL('ALTER TABLE patients ALTER COLUMN name_keys SET STATISTICS 1000'))
+
 class Insurance(db.Model):
     __tablename__ = 'insurance'
     
@@ -51,6 +70,7 @@ class Insurance(db.Model):
     patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), unique=True)
     insurance_name = db.Column(db.String(255))
     encrypted_insurance_id = db.Column(db.String(255))
+    insurance_id_bidx = db.Column(db.String(64), index=True)  # 盲索引
     medications = db.Column(db.Text)
     medical_conditions = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -60,6 +80,20 @@ class Insurance(db.Model):
 
 class Visit(db.Model):
     __tablename__ = 'visits'
+    __table_args__ = (
+        # 每个患者的最近就诊
+        db.Index('ix_visits_patient_id_visit_date', 'patient_id', 'visit_date'),
+        # 最近就诊列表的keyset分页
+        db.Index('ix_visits_visit_date_id', db.text('visit_date DESC'), db.text('id DESC')),
+        # 分诊队列（services/triage.py），只包含等待中的就诊
+        db.Index('ix_visits_triage_queue', db.text('pain_level DESC NULLS LAST'), 'visit_date', 'id',
+                 postgresql_where=db.text("status IN ('pending', 'confirmed')")),
+        # 症状检索（services/symptoms.py），小写后的数组做包含查询
+        db.Index('ix_visits_symptoms_lower', db.text('(lower(symptoms::text)::jsonb) jsonb_path_ops'),
+                 postgresql_using='gin'),
+        db.Index('ix_visits_possible_causes_lower', db.text('(lower(possible_causes::text)::jsonb) jsonb_path_ops'),
+                 postgresql_using='gin'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False)
@@ -73,22 +107,142 @@ class Visit(db.Model):
     audio_file_path = db.Column(db.String(255))
     analysis_file_path = db.Column(db.String(255))
     status = db.Column(db.String(50), default='pending')
+    # 第一次变为confirmed的时间（services/visit_rollups.py计算等待时间）
+    confirmed_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def __repr__(self):
         return f'<Visit {self.id} for Patient {self.patient_id}>'
 
+class VisitEvent(db.Model):
+    __tablename__ = 'visit_events'
+    __table_args__ = (
+        # 按(写入事务id, id)顺序读取
+        db.Index('ix_visit_events_txid_id', 'txid', 'id'),
+    )
+    
+    id = db.Column(db.BigInteger, primary_key=True)
+    # 写入事件的事务id（xid8），只读取已结束事务的事件，晚提交的事件不会被跳过
+    txid = db.Column(db.BigInteger, nullable=False, server_default=db.text('(pg_current_xact_id()::text)::bigint'))
+    visit_id = db.Column(db.Integer, nullable=False)
+    patient_id = db.Column(db.Integer, nullable=False)
+    event = db.Column(db.String(20), nullable=False)  # created, status_changed
+    status = db.Column(db.String(50))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<VisitEvent {self.id} {self.event} visit={self.visit_id}>'
+
+class VisitDailyCount(db.Model):
+    __tablename__ = 'visit_daily_counts'
+    # 每天（按visit_date）各(状态, 疼痛评分, 持续时间分组)的就诊数
+    # 写入Visit时增量维护，`flask visits rebuild-rollups`重算（services/visit_rollups.py）
+    __table_args__ = (
+        # 疼痛评分/持续时间未填写（NULL）的也要合并成一行
+        db.UniqueConstraint('day', 'status', 'pain_level', 'duration', name='uq_visit_daily_counts_key',
+                            postgresql_nulls_not_distinct=True),
+    )
+    
+    id = db.Column(db.BigInteger, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    status = db.Column(db.String(50))
+    pain_level = db.Column(db.Integer)
+    duration = db.Column(db.String(20))
+    visits = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<VisitDailyCount {self.day} {self.status} {self.pain_level} {self.duration}: {self.visits}>'
+
+class VisitDailyWait(db.Model):
+    __tablename__ = 'visit_daily_waits'
+    # 每天（按visit_date）已确认就诊的数量和等待时间（visit_date到confirmed_at，秒）之和
+    
+    day = db.Column(db.Date, primary_key=True)
+    confirmed = db.Column(db.Integer, nullable=False, default=0)
+    wait_seconds = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<VisitDailyWait {self.day}: {self.confirmed}>'
+
+class AudioJob(db.Model):
+    __tablename__ = 'audio_jobs'
+    # 语音转录+症状分析任务（services/audio_jobs.py），成功后创建Visit
+    # status: queued -> running -> succeeded / failed，失败的尝试按退避重新排队
+    # next_attempt_at: queued时为下次执行时间，running时为租约到期时间（worker崩溃后由其他worker接手）
+    __table_args__ = (
+        db.Index('ix_audio_jobs_claim', 'next_attempt_at', postgresql_where=db.text("status IN ('queued', 'running')")),
+    )
+    
+    id = db.Column(db.BigInteger, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    audio_file_path = db.Column(db.String(255), nullable=False)
+    audio_sha256 = db.Column(db.String(64))  # 上传时计算，转录缓存的key
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    result = db.Column(JSONB)  # {'text', 'analysis', 'analysis_filename'}
+    visit_id = db.Column(db.Integer, db.ForeignKey('visits.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<AudioJob {self.id} {self.status}>'
+
+class Transcription(db.Model):
+    __tablename__ = 'transcriptions'
+    # 语音转录缓存，按(音频内容哈希, 转录设置指纹)查找（services/transcription_cache.py）
+    
+    content_hash = db.Column(db.String(64), primary_key=True)
+    settings_hash = db.Column(db.String(64), primary_key=True)
+    text = db.Column(db.Text, nullable=False)
+    audio_bytes = db.Column(db.BigInteger)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<Transcription {self.content_hash[:12]}>'
+
+class SymptomAnalysis(db.Model):
+    __tablename__ = 'symptom_analyses'
+    # 症状分析结果缓存，key = (规范化转录文本, 模型, 提示词版本)的哈希（services/analysis_cache.py）
+    
+    cache_key = db.Column(db.String(64), primary_key=True)
+    model = db.Column(db.String(50), nullable=False)
+    prompt_version = db.Column(db.Integer, nullable=False)
+    analysis = db.Column(JSONB, nullable=False)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f'<SymptomAnalysis {self.cache_key[:12]} v{self.prompt_version}>'
+
 class AuditLog(db.Model):
     __tablename__ = 'audit_logs'
+    # 按timestamp每月一个分区，分区键必须包含在主键里
+    # 分区由migrations/versions/0002和`flask audit ensure-partitions`管理
+    # 查询索引都以(timestamp, id)结尾，支持按过滤条件做keyset分页（security/audit_query.py）
+    __table_args__ = (
+        db.Index('ix_audit_logs_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_audit_logs_user_timestamp', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_audit_logs_resource_timestamp', 'resource_type', 'resource_id', 'timestamp', 'id'),
+        db.Index('ix_audit_logs_action_timestamp', 'action', 'timestamp', 'id'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'}
+    )
     
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     action = db.Column(db.String(100), nullable=False)  # 'view', 'create', 'update', 'delete'
     resource_type = db.Column(db.String(50), nullable=False)  # 'patient', 'visit', 'insurance'
     resource_id = db.Column(db.Integer)
     ip_address = db.Column(db.String(45))
     user_agent = db.Column(db.Text)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, primary_key=True, default=datetime.utcnow)
     details = db.Column(JSONB)
     
     def __repr__(self):
@@ -4,6 +4,8 @@ from flask import Blueprint
 auth_bp = Blueprint('auth', __name__, url_prefix='/api/auth')
 patient_bp = Blueprint('patient', __name__, url_prefix='/api/patient')
 visit_bp = Blueprint('visit', __name__, url_prefix='/api/visit')
+audit_bp = Blueprint('audit', __name__, url_prefix='/api/audit')
+export_bp = Blueprint('export', __name__, url_prefix='/api/export')
 
 # 导入路由
-from routes import auth_routes, patient_routes, visit_routes
\ No newline at end of file
+from routes import auth_routes, patient_routes, visit_routes, audit_routes, export_routes
\ No newline at end of file
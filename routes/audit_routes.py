@@ -0,0 +1,76 @@
+from flask import request, jsonify, Response, stream_with_context, current_app
+from routes import audit_bp
+from auth.decorators import require_auth, require_role
+from security.audit import log_action
+from security.audit_query import fetch_audit_page, iter_audit_logs, serialize_audit_log
+from services.pagination import page_size, parse_datetime_arg, parse_int_arg
+import json
+
+def _parse_filters() -> dict:
+    """
+    从查询参数解析过滤条件，格式不对时抛出ValueError
+    """
+    return {
+        'user_id': parse_int_arg('user_id'),
+        'resource_type': request.args.get('resource_type') or None,
+        'resource_id': parse_int_arg('resource_id'),
+        'action': request.args.get('action') or None,
+        'since': parse_datetime_arg('since'),
+        'until': parse_datetime_arg('until')
+    }
+
+def _details(filters: dict) -> dict:
+    return {k: (v.isoformat() if hasattr(v, 'isoformat') else v) for k, v in filters.items() if v is not None}
+
+@audit_bp.route('/logs', methods=['GET'])
+@require_auth
+@require_role('staff', 'auditor')
+def get_audit_logs():
+    """
+    查询审计日志 - 仅staff/auditor可访问
+    
+    Query:
+        user_id, resource_type, resource_id, action: 过滤条件
+        since, until: ISO时间，since包含、until不包含
+        limit: 每页条数
+        cursor: 上一页返回的next_cursor
+    """
+    try:
+        filters = _parse_filters()
+        rows, next_cursor = fetch_audit_page(
+            filters,
+            cursor=request.args.get('cursor'),
+            limit=page_size(current_app.config['AUDIT_QUERY_PAGE_SIZE'], current_app.config['AUDIT_QUERY_MAX_PAGE_SIZE'])
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # 查看审计日志本身也要留痕
+    log_action('view', 'audit_log', details=_details(filters))
+    
+    return jsonify({
+        'logs': [serialize_audit_log(row) for row in rows],
+        'next_cursor': next_cursor
+    }), 200
+
+@audit_bp.route('/logs/export', methods=['GET'])
+@require_auth
+@require_role('staff', 'auditor')
+def export_audit_logs():
+    """
+    以NDJSON流式导出所有匹配的审计日志 - 仅staff/auditor可访问
+    过滤参数同 /logs，按页读取，内存占用与结果大小无关
+    """
+    try:
+        filters = _parse_filters()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    log_action('export', 'audit_log', details=_details(filters))
+    batch_size = current_app.config['AUDIT_QUERY_MAX_PAGE_SIZE']
+    
+    def generate():
+        for row in iter_audit_logs(filters, batch_size):
+            yield json.dumps(serialize_audit_log(row)) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
@@ -1,9 +1,13 @@
 from flask import request, jsonify, render_template
 from routes import auth_bp
 from models import db, User, Patient
-from auth.password_utils import hash_password, verify_password
+from auth.password_utils import hash_password, verify_password, needs_rehash, PasswordHasherBusy
 from auth.auth_utils import generate_token, revoke_token
+from auth.decorators import require_auth, require_role
+from auth import decorators
 from security.audit import log_action
+from services.cache import cache_stats
+from services.analysis_cache import analysis_cache_stats
 from datetime import datetime
 
 @auth_bp.route('/register', methods=['POST'])
@@ -60,8 +64,6 @@ def register():
             )
             db.session.add(patient)
         
-        db.session.commit()
-        
         # 生成JWT token
         token = generate_token(user.id, user.role)
         
@@ -79,6 +81,9 @@ def register():
             }
         }), 201
         
+    except PasswordHasherBusy:
+        db.session.rollback()
+        return jsonify({'error': 'Server busy, please retry'}), 503, {'Retry-After': '1'}
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -105,19 +110,24 @@ def login():
         user = User.query.filter_by(username=data['username']).first()
         
         if not user:
+            log_action('login_failed', 'user', details={'username': data['username']}, immediate=True)
             return jsonify({'error': 'Invalid credentials'}), 401
         
         # 验证密码
         if not verify_password(data['password'], user.password_hash):
+            log_action('login_failed', 'user', user.id, {'username': user.username}, immediate=True)
             return jsonify({'error': 'Invalid credentials'}), 401
         
         # 检查账户是否激活
         if not user.is_active:
             return jsonify({'error': 'Account is deactivated'}), 403
         
+        # cost过时的hash在登录时透明升级
+        if needs_rehash(user.password_hash):
+            user.password_hash = hash_password(data['password'])
+        
         # 更新最后登录时间
         user.last_login = datetime.utcnow()
-        db.session.commit()
         
         # 生成JWT token
         token = generate_token(user.id, user.role)
@@ -136,6 +146,8 @@ def login():
             }
         }), 200
         
+    except PasswordHasherBusy:
+        return jsonify({'error': 'Server busy, please retry'}), 503, {'Retry-After': '1'}
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -173,12 +185,9 @@ def get_current_user():
     Headers:
         Authorization: Bearer <token>
     """
-    from auth.decorators import require_auth
-    from flask import g
-    
     @require_auth
     def _get_user():
-        user = g.current_user
+        user = decorators.get_current_user()
         
         response = {
             'id': user.id,
@@ -198,4 +207,14 @@ def get_current_user():
         
         return jsonify(response), 200
     
-    return _get_user()
\ No newline at end of file
+    return _get_user()
+
+@auth_bp.route('/cache-stats', methods=['GET'])
+@require_auth
+@require_role('staff')
+def get_cache_stats():
+    """
+    查看进程内缓存的命中/未命中统计 - 仅staff可访问
+    symptom_analysis: 症状分析缓存两层（进程内 + 数据库）合计的命中率
+    """
+    return jsonify({'caches': cache_stats(), 'symptom_analysis': analysis_cache_stats()}), 200
@@ -0,0 +1,56 @@
+from flask import request, jsonify, g, Response, stream_with_context, current_app
+from routes import export_bp
+from auth.decorators import require_auth
+from security.rbac import require_permission
+from security.audit import log_action
+from services.export import DATASETS, FORMATS, export_stream
+from services.pagination import parse_datetime_arg
+
+_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+@export_bp.route('/<dataset>', methods=['GET'])
+@require_auth
+@require_permission('export', 'view')
+def export_dataset(dataset):
+    """
+    流式导出患者/就诊/症状 - 仅有导出权限的角色可访问
+    
+    Query:
+        format: csv（默认）或ndjson
+        gzip: true时边导出边压缩
+        since, until: ISO时间（patients按updated_at，visits/symptoms按visit_date）
+        decrypt: true时包含解密后的SSN/保险ID，需要角色在EXPORT_DECRYPT_ROLES里
+    """
+    if dataset not in DATASETS:
+        return jsonify({'error': f"dataset must be one of {', '.join(DATASETS)}"}), 404
+    
+    fmt = request.args.get('format', 'csv')
+    if fmt not in FORMATS:
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    
+    try:
+        since, until = parse_datetime_arg('since'), parse_datetime_arg('until')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    gzip = request.args.get('gzip', '').lower() == 'true'
+    decrypt = request.args.get('decrypt', '').lower() == 'true'
+    if decrypt and g.user_role not in current_app.config['EXPORT_DECRYPT_ROLES']:
+        log_action('access_denied', 'export', details={'dataset': dataset, 'decrypt': True}, immediate=True)
+        return jsonify({'error': 'Insufficient permissions to export decrypted fields'}), 403
+    
+    log_action('export', dataset, details={
+        'format': fmt,
+        'gzip': gzip,
+        'decrypt': decrypt,
+        'since': since.isoformat() if since else None,
+        'until': until.isoformat() if until else None
+    })
+    
+    filename = f'{dataset}.{fmt}' + ('.gz' if gzip else '')
+    stream = export_stream(dataset, fmt, gzip, decrypt, since, until, current_app.config['EXPORT_BATCH_SIZE'])
+    return Response(
+        stream_with_context(stream),
+        mimetype='application/gzip' if gzip else _MIMETYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
@@ -1,9 +1,17 @@
-from flask import request, jsonify, g
+from flask import request, jsonify, g, current_app
+from sqlalchemy import func
 from routes import patient_bp
-from models import db, Patient, User, Visit, Insurance
+from models import db, Patient, Visit
 from auth.decorators import require_auth, require_role
 from security.audit import log_action, audit_decorator
 from security.encryption import decrypt_data
+from security.blind_index import find_patients
+from services.patient_search import search_patients
+from services.response_cache import cached_result, patient_list_cache
+from services.patient_detail import parse_fields, detail_version, load_patient, load_visit_page
+from services.pagination import encode_cursor, decode_cursor, page_size, parse_datetime_arg
+from datetime import datetime
+import hashlib
 
 @patient_bp.route('/all', methods=['GET'])
 @require_auth
@@ -11,26 +19,135 @@ from security.encryption import decrypt_data
 @audit_decorator('view', 'patient_list')
 def get_all_patients():
     """
-    获取所有患者列表 - 仅staff可访问
+    获取患者列表 - 仅staff可访问
+    最后就诊时间和就诊次数直接读patients上维护的汇总列
+    结果按查询参数缓存，患者/就诊/保险有写入时失效
+    
+    Query:
+        sort: id（默认）或last_visit（最近就诊的在前）
+        visited_since: ISO时间，只返回此后有就诊的患者
+        limit: 每页条数（有上限）
+        cursor: 上一页返回的next_cursor
+        count: true时同时返回符合条件的患者总数
     """
     try:
-        patients = Patient.query.all()
-        
-        result = []
-        for patient in patients:
-            # 获取最后一次就诊时间
-            last_visit = Visit.query.filter_by(patient_id=patient.id)\
-                .order_by(Visit.visit_date.desc()).first()
-            
-            result.append({
-                'id': patient.id,
-                'full_name': patient.full_name,
-                'date_of_birth': patient.date_of_birth.isoformat(),
-                'phone': patient.phone,
-                'last_visit': last_visit.visit_date.isoformat() if last_visit else None
-            })
+        sort = request.args.get('sort', 'id')
+        if sort not in ('id', 'last_visit'):
+            return jsonify({'error': 'sort must be id or last_visit'}), 400
+        
+        limit = page_size(current_app.config['PATIENT_LIST_PAGE_SIZE'], current_app.config['PATIENT_LIST_MAX_PAGE_SIZE'])
+        visited_since = parse_datetime_arg('visited_since')
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor, datetime, int) if cursor and sort == 'last_visit' else \
+            decode_cursor(cursor, int) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    def build():
+        query = db.select(Patient.id, Patient.full_name, Patient.date_of_birth, Patient.phone,
+                          Patient.last_visit_at, Patient.visit_count)
+        if visited_since is not None:
+            query = query.where(Patient.last_visit_at >= visited_since)
+        total_query = query
+        
+        if sort == 'last_visit':
+            # ix_patients_last_visit_at_id: (last_visit_at DESC NULLS LAST, id DESC)
+            if after:
+                last_visit_at, after_id = after
+                if last_visit_at is None:
+                    query = query.where(Patient.last_visit_at.is_(None), Patient.id < after_id)
+                else:
+                    query = query.where(db.or_(
+                        Patient.last_visit_at < last_visit_at,
+                        db.and_(Patient.last_visit_at == last_visit_at, Patient.id < after_id),
+                        Patient.last_visit_at.is_(None)
+                    ))
+            query = query.order_by(Patient.last_visit_at.desc().nulls_last(), Patient.id.desc())
+        else:
+            if after:
+                query = query.where(Patient.id > after[0])
+            query = query.order_by(Patient.id)
+        
+        rows = db.session.execute(query.limit(limit + 1)).all()
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_cursor(last.last_visit_at, last.id) if sort == 'last_visit' else encode_cursor(last.id)
+        
+        result = {
+            'patients': [
+                {
+                    'id': row.id,
+                    'full_name': row.full_name,
+                    'date_of_birth': row.date_of_birth.isoformat(),
+                    'phone': row.phone,
+                    'last_visit': row.last_visit_at.isoformat() if row.last_visit_at else None,
+                    'visit_count': row.visit_count
+                }
+                for row in rows
+            ],
+            'next_cursor': next_cursor
+        }
+        
+        if request.args.get('count', '').lower() == 'true':
+            result['total'] = db.session.execute(
+                db.select(func.count()).select_from(total_query.subquery())
+            ).scalar()
+        return result
+    
+    try:
+        return jsonify(cached_result(patient_list_cache, build)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@patient_bp.route('/search', methods=['GET'])
+@require_auth
+@require_role('staff')
+def search_returning_patients():
+    """
+    回诊患者查找 - 仅staff可访问
+    姓名容忍常见拼写错误；给出生日期时按出生日期精确过滤
+    
+    Query:
+        name: 姓名（可以只输入开头部分）
+        dob: 出生日期 YYYY-MM-DD
+        limit: 返回条数（有硬上限）
+    """
+    name = request.args.get('name', '').strip()
+    dob = request.args.get('dob')
+    if not name and not dob:
+        return jsonify({'error': 'name or dob is required'}), 400
+    
+    try:
+        date_of_birth = datetime.strptime(dob, '%Y-%m-%d').date() if dob else None
+    except ValueError:
+        return jsonify({'error': 'dob must be YYYY-MM-DD'}), 400
+    
+    limit = page_size(10, current_app.config['PATIENT_SEARCH_MAX_RESULTS'])
+    
+    try:
+        matches = search_patients(
+            name=name,
+            date_of_birth=date_of_birth,
+            limit=limit,
+            candidate_limit=current_app.config['PATIENT_SEARCH_CANDIDATES']
+        )
+        
+        log_action('search', 'patient', details={'matches': [row.id for row, _ in matches]})
         
-        return jsonify({'patients': result}), 200
+        return jsonify({'patients': [
+            {
+                'id': row.id,
+                'full_name': row.full_name,
+                'date_of_birth': row.date_of_birth.isoformat(),
+                'phone': row.phone,
+                'last_visit': row.last_visit_at.isoformat() if row.last_visit_at else None,
+                'score': round(score, 3)
+            }
+            for row, score in matches
+        ]}), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -42,60 +159,97 @@ def get_patient(patient_id):
     获取患者详情
     - 患者只能查看自己
     - Staff可以查看所有
+    
+    Query:
+        fields: 逗号分隔的返回字段（默认不含last_visit/visit_count）
+        visits_limit: 内嵌就诊记录每页条数（有上限）
+        visits_cursor: 上一次返回的visits_next_cursor
+    
+    返回ETag（基于行版本），带If-None-Match且没有变化时返回304
     """
+    # 权限检查（患者只能看自己，不需要先查库）
+    if g.user_role == 'patient' and g.patient_id != patient_id:
+        log_action('access_denied', 'patient', patient_id, immediate=True)
+        return jsonify({'error': 'Access denied'}), 403
+    
     try:
-        patient = Patient.query.get(patient_id)
-        if not patient:
+        fields = parse_fields(request.args.get('fields', ''))
+        visits_limit = page_size(current_app.config['PATIENT_DETAIL_VISITS_PAGE_SIZE'],
+                                 current_app.config['PATIENT_DETAIL_VISITS_MAX_PAGE_SIZE'], 'visits_limit')
+        visits_cursor = request.args.get('visits_cursor')
+        if visits_cursor:
+            decode_cursor(visits_cursor, datetime, int)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        version = detail_version(patient_id, fields, visits_cursor, visits_limit)
+        if version is None:
             return jsonify({'error': 'Patient not found'}), 404
         
-        # 权限检查
-        if g.user_role == 'patient' and patient.user_id != g.user_id:
-            return jsonify({'error': 'Access denied'}), 403
-        
-        # 获取就诊记录
-        visits = Visit.query.filter_by(patient_id=patient.id)\
-            .order_by(Visit.visit_date.desc()).all()
-        
-        # 获取保险信息
-        insurance = Insurance.query.filter_by(patient_id=patient.id).first()
+        # 保险ID只对staff可见，角色也是表示的一部分
+        etag = hashlib.sha1(
+            f'{g.user_role}|{",".join(fields)}|{visits_cursor}|{visits_limit}|{version}'.encode()
+        ).hexdigest()
         
-        result = {
-            'id': patient.id,
-            'full_name': patient.full_name,
-            'date_of_birth': patient.date_of_birth.isoformat(),
-            'phone': patient.phone,
-            'address': patient.address,
-            'email': patient.user.email,
-            'visits': [
-                {
-                    'id': visit.id,
-                    'visit_date': visit.visit_date.isoformat(),
-                    'visit_reason': visit.visit_reason,
-                    'symptoms': visit.symptoms,
-                    'status': visit.status
-                }
-                for visit in visits
-            ]
-        }
-        
-        if insurance:
-            result['insurance'] = {
-                'insurance_name': insurance.insurance_name,
-                'medications': insurance.medications,
-                'medical_conditions': insurance.medical_conditions
-            }
-            # 只有staff可以看保险ID
-            if g.user_role == 'staff' and insurance.encrypted_insurance_id:
-                result['insurance']['insurance_id'] = decrypt_data(insurance.encrypted_insurance_id)
-        
-        # 记录审计日志
+        # 记录审计日志（304也是一次查看）
         log_action('view', 'patient', patient_id)
         
-        return jsonify(result), 200
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = jsonify(_patient_detail(patient_id, fields, visits_cursor, visits_limit))
+        
+        response.set_etag(etag)
+        # 浏览器可以缓存，但每次都要带If-None-Match重新验证
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def _patient_detail(patient_id: int, fields: tuple, visits_cursor: str, visits_limit: int) -> dict:
+    patient = load_patient(patient_id, fields)
+    
+    values = {
+        'id': lambda: patient.id,
+        'full_name': lambda: patient.full_name,
+        'date_of_birth': lambda: patient.date_of_birth.isoformat(),
+        'phone': lambda: patient.phone,
+        'address': lambda: patient.address,
+        'email': lambda: patient.user.email,
+        'last_visit': lambda: patient.last_visit_at.isoformat() if patient.last_visit_at else None,
+        'visit_count': lambda: patient.visit_count,
+    }
+    result = {field: values[field]() for field in fields if field in values}
+    
+    if 'visits' in fields:
+        visits, next_cursor = load_visit_page(patient_id, visits_cursor, visits_limit)
+        result['visits'] = [
+            {
+                'id': visit.id,
+                'visit_date': visit.visit_date.isoformat(),
+                'visit_reason': visit.visit_reason,
+                'symptoms': visit.symptoms,
+                'status': visit.status
+            }
+            for visit in visits
+        ]
+        result['visits_next_cursor'] = next_cursor
+    
+    insurance = patient.insurance if 'insurance' in fields else None
+    if insurance:
+        result['insurance'] = {
+            'insurance_name': insurance.insurance_name,
+            'medications': insurance.medications,
+            'medical_conditions': insurance.medical_conditions
+        }
+        # 只有staff可以看保险ID
+        if g.user_role == 'staff' and insurance.encrypted_insurance_id:
+            result['insurance']['insurance_id'] = decrypt_data(insurance.encrypted_insurance_id)
+    
+    return result
+
 @patient_bp.route('/me', methods=['GET'])
 @require_auth
 @require_role('patient')
@@ -104,7 +258,7 @@ def get_my_info():
     获取当前登录患者的信息
     """
     try:
-        patient = Patient.query.filter_by(user_id=g.user_id).first()
+        patient = db.session.get(Patient, g.patient_id) if g.patient_id else None
         if not patient:
             return jsonify({'error': 'Patient record not found'}), 404
         
@@ -129,4 +283,45 @@ def get_my_info():
         return jsonify(result), 200
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+@patient_bp.route('/lookup', methods=['POST'])
+@require_auth
+@require_role('staff')
+def lookup_patient():
+    """
+    按SSN或保险ID精确查找患者 - 仅staff可访问
+    用POST，避免敏感值出现在URL和访问日志里
+    
+    Body:
+    {
+        "ssn": "123-45-6789",       // 二选一
+        "insurance_id": "INS123"
+    }
+    """
+    data = request.get_json() or {}
+    ssn, insurance_id = data.get('ssn'), data.get('insurance_id')
+    if not ssn and not insurance_id:
+        return jsonify({'error': 'ssn or insurance_id is required'}), 400
+    
+    try:
+        patients = find_patients(ssn=ssn, insurance_id=insurance_id)
+        
+        # 审计日志不记录查询值本身
+        log_action('lookup', 'patient', details={
+            'by': 'ssn' if ssn else 'insurance_id',
+            'matches': [patient.id for patient in patients]
+        })
+        
+        return jsonify({'patients': [
+            {
+                'id': patient.id,
+                'full_name': patient.full_name,
+                'date_of_birth': patient.date_of_birth.isoformat(),
+                'phone': patient.phone
+            }
+            for patient in patients
+        ]}), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
@@ -1,8 +1,16 @@
-from flask import request, jsonify, g
+from flask import request, jsonify, g, current_app, Response
 from routes import visit_bp
 from models import db, Visit, Patient
 from auth.decorators import require_auth, require_role
 from security.audit import log_action
+from services.response_cache import cached_result, recent_visits_cache, symptom_search_cache
+from services.visit_events import stream_events, parse_position
+from services.triage import top_of_queue, queue_length
+from services.visit_status import TARGET_STATUSES, bulk_transition
+from services.visit_rollups import daily_stats
+from services.symptoms import FIELDS, BUCKETS, normalize_terms, search_visits, bucket_starts, top_symptoms
+from services.pagination import encode_cursor, decode_cursor, page_size, parse_datetime_arg
+from datetime import date, datetime, timedelta
 
 @visit_bp.route('/recent', methods=['GET'])
 @require_auth
@@ -10,35 +18,316 @@ from security.audit import log_action
 def get_recent_visits():
     """
     获取最近的就诊记录 - 仅staff可访问
+    按(visit_date, id)倒序keyset分页，患者姓名来自同一个join查询
+    结果按查询参数缓存，患者/就诊/保险有写入时失效
+    
+    Query:
+        status: 只返回该状态（可用逗号分隔多个）
+        since, until: ISO时间，按visit_date过滤，since包含、until不包含
+        limit: 每页条数（有上限）
+        cursor: 上一页返回的next_cursor
     """
     try:
-        limit = request.args.get('limit', 10, type=int)
+        limit = page_size(current_app.config['VISIT_RECENT_PAGE_SIZE'], current_app.config['VISIT_RECENT_MAX_PAGE_SIZE'])
+        statuses = [status for status in request.args.get('status', '').split(',') if status]
+        since, until = parse_datetime_arg('since'), parse_datetime_arg('until')
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor, datetime, int) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    def build():
+        # ix_visits_visit_date_id: (visit_date DESC, id DESC)
+        query = db.select(Visit.id, Visit.patient_id, Patient.full_name, Visit.visit_date,
+                          Visit.visit_reason, Visit.symptoms, Visit.status)\
+            .join(Patient, Patient.id == Visit.patient_id)
+        if statuses:
+            query = query.where(Visit.status.in_(statuses))
+        if since is not None:
+            query = query.where(Visit.visit_date >= since)
+        if until is not None:
+            query = query.where(Visit.visit_date < until)
+        if after:
+            query = query.where(db.tuple_(Visit.visit_date, Visit.id) < db.tuple_(*after))
         
-        visits = Visit.query\
-            .join(Patient)\
-            .order_by(Visit.visit_date.desc())\
-            .limit(limit)\
-            .all()
+        rows = db.session.execute(
+            query.order_by(Visit.visit_date.desc(), Visit.id.desc()).limit(limit + 1)
+        ).all()
         
-        result = []
-        for visit in visits:
-            result.append({
-                'id': visit.id,
-                'patient_id': visit.patient_id,
-                'patient_name': visit.patient.full_name,
-                'visit_date': visit.visit_date.isoformat(),
-                'visit_reason': visit.visit_reason,
-                'symptoms': visit.symptoms,
-                'status': visit.status
-            })
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].visit_date, rows[-1].id)
         
-        log_action('view', 'visit_list', details={'count': len(result)})
+        return {
+            'visits': [
+                {
+                    'id': row.id,
+                    'patient_id': row.patient_id,
+                    'patient_name': row.full_name,
+                    'visit_date': row.visit_date.isoformat(),
+                    'visit_reason': row.visit_reason,
+                    'symptoms': row.symptoms,
+                    'status': row.status
+                }
+                for row in rows
+            ],
+            'next_cursor': next_cursor
+        }
+    
+    try:
+        result = cached_result(recent_visits_cache, build)
         
-        return jsonify({'visits': result}), 200
+        log_action('view', 'visit_list', details={'count': len(result['visits'])})
+        
+        return jsonify(result), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@visit_bp.route('/triage', methods=['GET'])
+@require_auth
+@require_role('staff')
+def get_triage_queue():
+    """
+    分诊队列 - 仅staff可访问
+    等待中的就诊按疼痛程度（高的在前）、到达时间（早的在前）排序，返回前limit个
+    """
+    limit = page_size(current_app.config['TRIAGE_QUEUE_SIZE'], current_app.config['TRIAGE_QUEUE_MAX_SIZE'])
+    
+    try:
+        rows = top_of_queue(limit)
+        now = datetime.utcnow()
+        
+        log_action('view', 'triage_queue', details={'count': len(rows)})
+        
+        return jsonify({
+            'queue': [
+                {
+                    'position': position,
+                    'id': row.id,
+                    'patient_id': row.patient_id,
+                    'patient_name': row.full_name,
+                    'pain_level': row.pain_level,
+                    'pain_duration': row.pain_duration,
+                    'visit_reason': row.visit_reason,
+                    'visit_date': row.visit_date.isoformat(),
+                    'wait_minutes': int((now - row.visit_date).total_seconds() // 60),
+                    'status': row.status
+                }
+                for position, row in enumerate(rows, start=1)
+            ],
+            'waiting': queue_length()
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@visit_bp.route('/status', methods=['POST'])
+@require_auth
+@require_role('staff')
+def bulk_update_status():
+    """
+    批量修改就诊状态 - 仅staff可访问
+    一条UPDATE完成，不允许的状态流转跳过并在skipped里返回，整个操作只记一条审计日志
+    
+    Body:
+    {
+        "visit_ids": [1, 2, 3],
+        "status": "completed"
+    }
+    """
+    data = request.get_json() or {}
+    visit_ids, status = data.get('visit_ids'), data.get('status')
+    
+    if not isinstance(status, str) or status not in TARGET_STATUSES:
+        return jsonify({'error': f"status must be one of {', '.join(TARGET_STATUSES)}"}), 400
+    if not isinstance(visit_ids, list) or not visit_ids or \
+            not all(isinstance(visit_id, int) and not isinstance(visit_id, bool) for visit_id in visit_ids):
+        return jsonify({'error': 'visit_ids must be a non-empty list of integers'}), 400
+    if len(visit_ids) > current_app.config['BULK_STATUS_MAX_VISITS']:
+        return jsonify({'error': f"At most {current_app.config['BULK_STATUS_MAX_VISITS']} visits per request"}), 400
+    
+    try:
+        updated, skipped = bulk_transition(visit_ids, status)
+        
+        log_action('bulk_update', 'visit', details={
+            'status': status,
+            'updated': [item['id'] for item in updated],
+            'skipped': [item['id'] for item in skipped]
+        })
+        
+        return jsonify({'status': status, 'updated': updated, 'skipped': skipped}), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@visit_bp.route('/symptoms/search', methods=['GET'])
+@require_auth
+@require_role('staff')
+def search_symptoms():
+    """
+    按症状检索就诊记录 - 仅staff可访问
+    返回包含全部给定症状的就诊（不区分大小写，整项匹配），按(visit_date, id)倒序keyset分页
+    
+    Query:
+        symptom: 症状（可重复，多个时要求全部包含）
+        field: symptoms（默认）或possible_causes
+        since, until: ISO时间，按visit_date过滤
+        limit, cursor: 分页
+    """
+    terms = normalize_terms(request.args.getlist('symptom'))
+    field = request.args.get('field', 'symptoms')
+    if not terms:
+        return jsonify({'error': 'At least one symptom is required'}), 400
+    if field not in FIELDS:
+        return jsonify({'error': f"field must be one of {', '.join(FIELDS)}"}), 400
+    try:
+        limit = page_size(current_app.config['SYMPTOM_SEARCH_PAGE_SIZE'], current_app.config['SYMPTOM_SEARCH_MAX_PAGE_SIZE'])
+        since, until = parse_datetime_arg('since'), parse_datetime_arg('until')
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor, datetime, int) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    def build():
+        rows = search_visits(terms, field, since, until, after, limit)
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].visit_date, rows[-1].id)
+        
+        return {
+            'visits': [
+                {
+                    'id': row.id,
+                    'patient_id': row.patient_id,
+                    'patient_name': row.full_name,
+                    'visit_date': row.visit_date.isoformat(),
+                    'visit_reason': row.visit_reason,
+                    'symptoms': row.symptoms,
+                    'possible_causes': row.possible_causes,
+                    'status': row.status
+                }
+                for row in rows
+            ],
+            'next_cursor': next_cursor
+        }
+    
+    try:
+        result = cached_result(symptom_search_cache, build)
+        
+        log_action('search', 'visit_symptoms', details={'field': field, 'count': len(result['visits'])})
+        
+        return jsonify(result), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@visit_bp.route('/symptoms/top', methods=['GET'])
+@require_auth
+@require_role('staff')
+def get_top_symptoms():
+    """
+    症状频次统计 - 仅staff可访问
+    每个时间桶（day/week）里出现在最多就诊记录中的症状，在数据库里聚合，已结束的桶有缓存
+    
+    Query:
+        since: ISO时间，默认7天前；until: 默认现在（按桶的边界取整）
+        bucket: day（默认）或week
+        field: symptoms（默认）或possible_causes
+        limit: 每个桶返回的症状数
+    """
+    field = request.args.get('field', 'symptoms')
+    bucket = request.args.get('bucket', 'day')
+    if field not in FIELDS:
+        return jsonify({'error': f"field must be one of {', '.join(FIELDS)}"}), 400
+    if bucket not in BUCKETS:
+        return jsonify({'error': f"bucket must be one of {', '.join(BUCKETS)}"}), 400
+    try:
+        limit = page_size(current_app.config['SYMPTOM_STATS_LIMIT'], current_app.config['SYMPTOM_STATS_MAX_LIMIT'])
+        now = datetime.utcnow()
+        since = parse_datetime_arg('since') or now - timedelta(days=7)
+        until = parse_datetime_arg('until') or now
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if since >= until:
+        return jsonify({'error': 'since must be earlier than until'}), 400
+    if len(bucket_starts(since, until, bucket)) > current_app.config['SYMPTOM_STATS_MAX_BUCKETS']:
+        return jsonify({'error': f"At most {current_app.config['SYMPTOM_STATS_MAX_BUCKETS']} buckets per request"}), 400
+    
+    try:
+        buckets = top_symptoms(since, until, field, bucket, limit, now)
+        
+        log_action('view', 'symptom_stats', details={'field': field, 'bucket': bucket, 'buckets': len(buckets)})
+        
+        return jsonify({
+            'field': field,
+            'bucket': bucket,
+            'buckets': [
+                {'start': item['bucket'].isoformat(), 'symptoms': item['symptoms']}
+                for item in buckets
+            ]
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@visit_bp.route('/stats/daily', methods=['GET'])
+@require_auth
+@require_role('staff')
+def get_daily_stats():
+    """
+    每日就诊统计 - 仅staff可访问
+    每天按状态、疼痛评分、持续时间分组的就诊数和平均等待确认时间，只读每日汇总表
+    
+    Query:
+        days: 天数（默认90，有上限）
+        until: 截止日期（不包含，ISO日期），默认明天（包含今天）
+    """
+    try:
+        days = page_size(current_app.config['VISIT_STATS_DAYS'], current_app.config['VISIT_STATS_MAX_DAYS'], name='days')
+        until = request.args.get('until')
+        end = date.fromisoformat(until) if until else datetime.utcnow().date() + timedelta(days=1)
+    except ValueError:
+        return jsonify({'error': 'until must be an ISO 8601 date'}), 400
+    
+    try:
+        stats = daily_stats(end - timedelta(days=days), end)
+        
+        log_action('view', 'visit_stats', details={'days': days})
+        
+        return jsonify({'days': stats}), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@visit_bp.route('/events', methods=['GET'])
+@require_auth
+@require_role('staff')
+def stream_visit_events():
+    """
+    就诊记录变更的SSE流 - 仅staff可访问
+    事件: 新建就诊（created）和状态变化（status_changed），data里带就诊记录当前的内容
+    
+    重连时带Last-Event-ID头（或?last_event_id=），只补发错过的事件；
+    错过太多时收到reset事件，客户端应重新加载/api/visit/recent
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        after = parse_position(last_event_id) if last_event_id else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    log_action('subscribe', 'visit_events', details={'resume': bool(after)})
+    
+    return Response(
+        stream_events(current_app._get_current_object(), after),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @visit_bp.route('/<int:visit_id>', methods=['GET'])
 @require_auth
 def get_visit(visit_id):
@@ -54,8 +343,8 @@ def get_visit(visit_id):
         
         # 权限检查
         if g.user_role == 'patient':
-            patient = Patient.query.filter_by(user_id=g.user_id).first()
-            if not patient or visit.patient_id != patient.id:
+            if not g.patient_id or visit.patient_id != g.patient_id:
+                log_action('access_denied', 'visit', visit_id, immediate=True)
                 return jsonify({'error': 'Access denied'}), 403
         
         result = {
@@ -88,11 +377,10 @@ def get_my_visits():
     获取当前患者的所有就诊记录
     """
     try:
-        patient = Patient.query.filter_by(user_id=g.user_id).first()
-        if not patient:
+        if not g.patient_id:
             return jsonify({'error': 'Patient not found'}), 404
         
-        visits = Visit.query.filter_by(patient_id=patient.id)\
+        visits = Visit.query.filter_by(patient_id=g.patient_id)\
             .order_by(Visit.visit_date.desc())\
             .all()
         
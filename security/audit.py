@@ -1,34 +1,280 @@
-from flask import request, g
+from flask import request, g, current_app
+from sqlalchemy import insert, event
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.orm import Session as OrmSession
 from models import db, AuditLog
+from services.unit_of_work import stage, PENDING_AUDIT_KEY
+from contextlib import contextmanager
 from datetime import datetime
+import atexit
+import fcntl
+import glob
+import json
+import os
+import queue
+import threading
+import time
 
-def log_action(action: str, resource_type: str, resource_id: int = None, details: dict = None):
+_STOP = object()
+PENDING_AUDIT_APP_KEY = 'pending_audit_app'
+
+class AuditWriter:
+    """
+    异步批量审计日志写入器
+    - 请求线程只把记录放进队列
+    - 后台线程按批（AUDIT_BATCH_SIZE）或最大延迟（AUDIT_MAX_LATENCY_MS）批量INSERT
+    - 数据库不可用时写入本地spool文件，恢复后自动补写
+    - 进程退出时清空队列
+    """
+    
+    def __init__(self):
+        self._app = None
+        self._queue = None
+        self._thread = None
+        self._spool_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+    
+    def start(self, app):
+        """
+        启动后台写入线程（首次入队时自动调用，保证在gunicorn fork之后）
+        """
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._app = app
+            self.batch_size = app.config['AUDIT_BATCH_SIZE']
+            self.max_latency = app.config['AUDIT_MAX_LATENCY_MS'] / 1000
+            self.spool_path = app.config['AUDIT_SPOOL_PATH']
+            self._queue = queue.Queue(maxsize=app.config['AUDIT_QUEUE_MAX'])
+            self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+    
+    def enqueue(self, app, row: dict):
+        """
+        放入一条审计记录
+        """
+        if self._thread is None:
+            self.start(app)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            # 队列满时直接落到spool，不丢记录
+            self._spool([row])
+    
+    def flush(self):
+        """
+        阻塞直到队列中已有的记录全部写出
+        """
+        if self._queue is not None:
+            self._queue.join()
+    
+    def stop(self):
+        """
+        停止后台线程，先写完队列中剩余的记录
+        """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+    
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_latency
+            
+            if batch:
+                self._write(batch)
+                for _ in batch:
+                    self._queue.task_done()
+    
+    def _write(self, rows: list):
+        with self._app.app_context():
+            try:
+                self._replay_spool()
+                # 多行INSERT（executemany会被合并成批量VALUES）
+                db.session.execute(insert(AuditLog), rows)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self._app.logger.error(f"Audit write failed, spooling {len(rows)} records: {e}")
+                self._spool(rows)
+            finally:
+                db.session.remove()
+    
+    # ============ spool文件 ============
+    # 所有gunicorn worker共用同一个spool路径：
+    # - 追加和改名都在<spool>.lock的flock保护下进行
+    # - 补写前先把spool改名为<spool>.replaying.<pid>.<n>，只有改名的进程会读它
+    # - 已退出进程留下的replaying文件由存活的进程接管
+    
+    @contextmanager
+    def _spool_file_lock(self):
+        with self._spool_lock:
+            with open(self.spool_path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def _spool(self, rows: list):
+        with self._spool_file_lock():
+            with open(self.spool_path, 'a', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(row, default=lambda v: v.isoformat()) + '\n')
+    
+    def _claim_spool_files(self) -> list:
+        """
+        认领需要补写的文件，返回本进程拥有的replaying文件
+        """
+        pid = os.getpid()
+        with self._spool_file_lock():
+            if os.path.exists(self.spool_path):
+                os.rename(self.spool_path, f'{self.spool_path}.replaying.{pid}.{time.time_ns()}')
+        
+        claimed = []
+        for path in sorted(glob.glob(glob.escape(self.spool_path) + '.replaying.*')):
+            owner = int(path.rsplit('.', 2)[1])
+            if owner != pid:
+                if _process_alive(owner):
+                    continue
+                target = f'{self.spool_path}.replaying.{pid}.{time.time_ns()}'
+                try:
+                    os.rename(path, target)
+                except FileNotFoundError:
+                    continue  # 被其他进程抢先接管
+                path = target
+            claimed.append(path)
+        return claimed
+    
+    def _replay_spool(self):
+        """
+        把spool文件里的记录补写进数据库
+        数据库连接错误会抛出（文件保留，下次再试）；
+        数据库拒绝的单条记录移到<spool>.quarantine，不阻塞后续写入
+        """
+        for path in self._claim_spool_files():
+            with open(path, encoding='utf-8') as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            for row in rows:
+                row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+            
+            try:
+                for i in range(0, len(rows), self.batch_size):
+                    db.session.execute(insert(AuditLog), rows[i:i + self.batch_size])
+                db.session.commit()
+            except OperationalError:
+                db.session.rollback()
+                raise
+            except SQLAlchemyError:
+                db.session.rollback()
+                self._replay_row_by_row(rows)
+            os.remove(path)
+    
+    def _replay_row_by_row(self, rows: list):
+        rejected = []
+        for row in rows:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert(AuditLog), [row])
+            except OperationalError:
+                db.session.rollback()
+                raise
+            except SQLAlchemyError as e:
+                rejected.append({'row': row, 'error': str(e.orig or e)})
+        db.session.commit()
+        
+        if rejected:
+            self._app.logger.error(f"Quarantined {len(rejected)} audit records rejected by the database")
+            with self._spool_file_lock():
+                with open(self.spool_path + '.quarantine', 'a', encoding='utf-8') as f:
+                    for item in rejected:
+                        f.write(json.dumps(item, default=lambda v: v.isoformat()) + '\n')
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+audit_writer = AuditWriter()
+
+# ============ 异步模式下跟随事务 ============
+
+@event.listens_for(OrmSession, 'after_commit')
+def _hand_off_after_commit(session):
+    rows = session.info.pop(PENDING_AUDIT_KEY, None)
+    app = session.info.pop(PENDING_AUDIT_APP_KEY, None)
+    for row in rows or ():
+        audit_writer.enqueue(app, row)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop(PENDING_AUDIT_KEY, None)
+    session.info.pop(PENDING_AUDIT_APP_KEY, None)
+
+def log_action(action: str, resource_type: str, resource_id: int = None, details: dict = None,
+               immediate: bool = False):
     """
     记录审计日志
+    AUDIT_ASYNC开启时在事务提交后交给后台批量写入，否则和业务数据在同一个事务里提交
     
     Args:
         action: 'view', 'create', 'update', 'delete'
         resource_type: 'patient', 'visit', 'insurance', 'user'
         resource_id: 资源ID
         details: 额外信息（dict）
+        immediate: 不跟随请求事务，立即写出（用于拒绝访问等错误响应，
+                   这些请求的事务会被回滚）
     """
     user_id = getattr(g, 'user_id', None)
     
-    audit_log = AuditLog(
-        user_id=user_id,
-        action=action,
-        resource_type=resource_type,
-        resource_id=resource_id,
-        ip_address=request.remote_addr,
-        user_agent=request.headers.get('User-Agent'),
-        timestamp=datetime.utcnow(),
-        details=details
-    )
-    
-    db.session.add(audit_log)
-    db.session.commit()
-    
-    print(f"[AUDIT] User {user_id} performed {action} on {resource_type} {resource_id}")
+    row = {
+        'user_id': user_id,
+        'action': action,
+        'resource_type': resource_type,
+        'resource_id': resource_id,
+        'ip_address': request.remote_addr,
+        'user_agent': request.headers.get('User-Agent'),
+        'timestamp': datetime.utcnow(),
+        'details': details
+    }
+    
+    if immediate:
+        if current_app.config['AUDIT_ASYNC']:
+            audit_writer.enqueue(current_app._get_current_object(), row)
+        else:
+            # 独立连接和事务，不受unit-of-work回滚影响
+            with db.engine.begin() as connection:
+                connection.execute(insert(AuditLog), [row])
+    elif current_app.config['AUDIT_ASYNC']:
+        # 先挂在session上，事务提交后才交给写入器；回滚时丢弃
+        session = db.session()
+        session.info.setdefault(PENDING_AUDIT_KEY, []).append(row)
+        session.info[PENDING_AUDIT_APP_KEY] = current_app._get_current_object()
+    else:
+        stage(AuditLog(**row))
+    
+    current_app.logger.debug(f"[AUDIT] User {user_id} performed {action} on {resource_type} {resource_id}")
 
 def audit_decorator(action: str, resource_type: str):
     """
@@ -0,0 +1,277 @@
+"""
+audit_logs按月分区的管理、归档和恢复
+
+- 每个月一个分区: audit_logs_yYYYYmMM，另有audit_logs_default兜底
+- 归档: 超过保留期的分区导出为gzip压缩的JSONL，
+  记录到manifest.json（含sha256校验和行数），然后DETACH并DROP
+- 恢复: 校验后重新创建分区并导入，manifest里标记为restored
+"""
+from datetime import date, datetime
+from sqlalchemy import text
+from models import db
+import gzip
+import hashlib
+import json
+import os
+import re
+
+PARENT_TABLE = 'audit_logs'
+DEFAULT_PARTITION = 'audit_logs_default'
+MANIFEST_NAME = 'manifest.json'
+_PARTITION_RE = re.compile(r'^audit_logs_y(\d{4})m(\d{2})$')
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+def parse_month(value: str) -> date:
+    """
+    解析'YYYY-MM'
+    """
+    return datetime.strptime(value, '%Y-%m').date()
+
+def partition_name(month: date) -> str:
+    return f'{PARENT_TABLE}_y{month.year:04d}m{month.month:02d}'
+
+def list_partitions(connection) -> dict:
+    """
+    返回 {月份: 分区表名}（不含默认分区）
+    """
+    rows = connection.execute(text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = :parent
+    """), {'parent': PARENT_TABLE}).scalars()
+
+    partitions = {}
+    for name in rows:
+        match = _PARTITION_RE.match(name)
+        if match:
+            partitions[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return partitions
+
+def create_partition(connection, month: date):
+    """
+    创建某个月的分区
+    如果默认分区里已经有这个月的数据，先把它们移过去
+    """
+    name = partition_name(month)
+    start, end = month, add_months(month, 1)
+    bounds = {'start': start, 'end': end}
+
+    stray = connection.execute(text(
+        f"SELECT count(*) FROM {DEFAULT_PARTITION} WHERE timestamp >= :start AND timestamp < :end"
+    ), bounds).scalar()
+
+    if stray:
+        connection.execute(text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {DEFAULT_PARTITION}"))
+
+    connection.execute(text(
+        f"CREATE TABLE {name} PARTITION OF {PARENT_TABLE} "
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    ))
+
+    if stray:
+        connection.execute(text(
+            f"INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} "
+            f"WHERE timestamp >= :start AND timestamp < :end"
+        ), bounds)
+        connection.execute(text(
+            f"DELETE FROM {DEFAULT_PARTITION} WHERE timestamp >= :start AND timestamp < :end"
+        ), bounds)
+        connection.execute(text(f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+
+def ensure_partitions(connection, months_ahead: int = 3, today: date = None) -> list:
+    """
+    确保默认分区以及本月到未来months_ahead个月的分区存在
+    返回新建的分区名
+    """
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {PARENT_TABLE} DEFAULT"
+    ))
+
+    existing = list_partitions(connection)
+    current = month_start(today or datetime.utcnow())
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if month not in existing:
+            create_partition(connection, month)
+            created.append(partition_name(month))
+    return created
+
+# ==================== 归档 ====================
+
+def _load_manifest(out_dir: str) -> dict:
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {'segments': []}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def _save_manifest(out_dir: str, manifest: dict):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _export_table(connection, table: str, path: str, batch_size: int) -> int:
+    """
+    用服务端游标流式导出为gzip JSONL，内存占用与表大小无关
+    """
+    result = connection.execute(
+        text(f"SELECT * FROM {table} ORDER BY timestamp, id")
+        .execution_options(stream_results=True, yield_per=batch_size)
+    )
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for row in result.mappings():
+            f.write(json.dumps(dict(row), default=lambda v: v.isoformat()) + '\n')
+            count += 1
+    return count
+
+def list_orphaned_partitions(connection) -> dict:
+    """
+    返回已经从父表分离但还没有删除的月分区表 {月份: 表名}
+    （例如手工DETACH，或者旧版本归档中途失败留下的表）
+    """
+    rows = connection.execute(text("""
+        SELECT c.relname
+        FROM pg_class c
+        WHERE c.relkind = 'r'
+          AND c.relname ~ '^audit_logs_y[0-9]{4}m[0-9]{2}$'
+          AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = c.oid)
+    """)).scalars()
+
+    orphaned = {}
+    for name in rows:
+        match = _PARTITION_RE.match(name)
+        orphaned[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return orphaned
+
+def _default_months_before(connection, cutoff: date) -> list:
+    """
+    默认分区里早于cutoff的数据所在的月份
+    """
+    return connection.execute(text(
+        f"SELECT DISTINCT date_trunc('month', timestamp)::date FROM {DEFAULT_PARTITION} "
+        f"WHERE timestamp < :cutoff"
+    ), {'cutoff': cutoff}).scalars().all()
+
+def archive_partitions(out_dir: str, retain_months: int, batch_size: int = 5000,
+                       today: date = None, include_restored: bool = False, log=print) -> list:
+    """
+    归档早于保留期的分区，返回归档的月份列表
+
+    - 默认分区里过期月份的数据先移到对应的月分区，再一起归档
+    - 每个分区在一个事务里完成: 加锁 -> 导出 -> 写manifest -> DETACH -> DROP，
+      任何一步失败都会回滚，分区仍然挂在父表上，下次重新归档
+    - 用`audit restore`恢复的月份默认跳过，避免下一次定时归档立刻把它删掉；
+      查完之后用include_restored=True重新归档
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    cutoff = add_months(month_start(today or datetime.utcnow()), -retain_months)
+    manifest = _load_manifest(out_dir)
+    restored = {s['partition'] for s in manifest['segments'] if s.get('restored')}
+
+    with db.engine.begin() as connection:
+        for month in _default_months_before(connection, cutoff):
+            create_partition(connection, month)
+        attached = list_partitions(connection)
+        orphaned = list_orphaned_partitions(connection)
+
+    candidates = {month: (table, False) for month, table in orphaned.items()}
+    candidates.update({month: (table, True) for month, table in attached.items()})
+
+    archived = []
+    for month in sorted(m for m in candidates if m < cutoff):
+        table, is_attached = candidates[month]
+        if table in restored and not include_restored:
+            log(f"Skipping {table}: restored on demand (use --include-restored to re-archive)")
+            continue
+
+        filename = f'{table}.jsonl.gz'
+        path = os.path.join(out_dir, filename)
+
+        with db.engine.begin() as connection:
+            # 归档期间阻止写入这个月的分区
+            connection.execute(text(f"LOCK TABLE {table} IN SHARE MODE"))
+            rows = _export_table(connection, table, path, batch_size)
+
+            segment = {
+                'partition': table,
+                'month': month.strftime('%Y-%m'),
+                'file': filename,
+                'rows': rows,
+                'sha256': _file_sha256(path),
+                'archived_at': datetime.utcnow().isoformat()
+            }
+            manifest['segments'] = [s for s in manifest['segments'] if s['partition'] != table] + [segment]
+            _save_manifest(out_dir, manifest)
+
+            # manifest写好之后才分离并删除
+            if is_attached:
+                connection.execute(text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {table}"))
+            connection.execute(text(f"DROP TABLE {table}"))
+
+        log(f"Archived {table}: {rows} rows -> {filename}")
+        archived.append(month)
+    return archived
+
+def restore_partitions(out_dir: str, start: date, end: date, batch_size: int = 5000, log=print) -> list:
+    """
+    把[start, end]范围内的归档月份重新导入热表
+    返回恢复的月份列表
+    """
+    from models import AuditLog
+
+    manifest = _load_manifest(out_dir)
+    restored = []
+    for segment in sorted(manifest['segments'], key=lambda s: s['month']):
+        month = parse_month(segment['month'])
+        if month < start or month > end:
+            continue
+
+        path = os.path.join(out_dir, segment['file'])
+        if _file_sha256(path) != segment['sha256']:
+            raise ValueError(f"Checksum mismatch for {segment['file']}")
+
+        with db.engine.begin() as connection:
+            if month in list_partitions(connection):
+                log(f"Skipping {segment['month']}: partition already present")
+                continue
+            create_partition(connection, month)
+
+            batch = []
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    row = json.loads(line)
+                    row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        connection.execute(AuditLog.__table__.insert(), batch)
+                        batch = []
+            if batch:
+                connection.execute(AuditLog.__table__.insert(), batch)
+
+        # 标记为已恢复，之后的定时归档不会马上把它删掉
+        segment['restored'] = True
+        segment['restored_at'] = datetime.utcnow().isoformat()
+        _save_manifest(out_dir, manifest)
+
+        log(f"Restored {segment['partition']}: {segment['rows']} rows")
+        restored.append(month)
+    return restored
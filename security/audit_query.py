@@ -0,0 +1,83 @@
+"""
+审计日志查询（合规审查用）
+
+- 按user_id、resource_type/resource_id、action和时间范围过滤
+- 按(timestamp, id)倒序做keyset分页，每个过滤组合都有以(timestamp, id)结尾的复合索引，
+  翻页只是一次索引范围扫描，和表大小、页码无关
+"""
+from datetime import datetime
+from sqlalchemy import select, tuple_
+from models import db, AuditLog
+from services.pagination import encode_cursor, decode_cursor
+
+FILTER_FIELDS = ('user_id', 'resource_type', 'resource_id', 'action')
+
+_table = AuditLog.__table__
+
+def build_audit_query(user_id: int = None, resource_type: str = None, resource_id: int = None,
+                      action: str = None, since: datetime = None, until: datetime = None):
+    """
+    构造过滤后的查询（不含排序和分页）
+    since包含，until不包含
+    """
+    query = select(_table)
+    if user_id is not None:
+        query = query.where(_table.c.user_id == user_id)
+    if resource_type is not None:
+        query = query.where(_table.c.resource_type == resource_type)
+    if resource_id is not None:
+        query = query.where(_table.c.resource_id == resource_id)
+    if action is not None:
+        query = query.where(_table.c.action == action)
+    if since is not None:
+        query = query.where(_table.c.timestamp >= since)
+    if until is not None:
+        query = query.where(_table.c.timestamp < until)
+    return query
+
+def _after(query, cursor: str):
+    timestamp, row_id = decode_cursor(cursor, datetime, int)
+    return query.where(tuple_(_table.c.timestamp, _table.c.id) < tuple_(timestamp, row_id))
+
+def fetch_audit_page(filters: dict, cursor: str = None, limit: int = 100):
+    """
+    取一页审计日志（最新的在前）
+    返回 (rows, next_cursor)，没有下一页时next_cursor为None
+    """
+    query = build_audit_query(**filters)
+    if cursor:
+        query = _after(query, cursor)
+
+    # 多取一行判断是否还有下一页
+    query = query.order_by(_table.c.timestamp.desc(), _table.c.id.desc()).limit(limit + 1)
+    rows = db.session.execute(query).mappings().all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+    return rows, next_cursor
+
+def iter_audit_logs(filters: dict, batch_size: int = 1000):
+    """
+    逐页遍历所有匹配的日志，每页一次独立的keyset查询，内存只占一页
+    """
+    cursor = None
+    while True:
+        rows, cursor = fetch_audit_page(filters, cursor, batch_size)
+        yield from rows
+        if cursor is None:
+            return
+
+def serialize_audit_log(row) -> dict:
+    return {
+        'id': row['id'],
+        'timestamp': row['timestamp'].isoformat(),
+        'user_id': row['user_id'],
+        'action': row['action'],
+        'resource_type': row['resource_type'],
+        'resource_id': row['resource_id'],
+        'ip_address': row['ip_address'],
+        'user_agent': row['user_agent'],
+        'details': row['details']
+    }
@@ -0,0 +1,130 @@
+"""
+加密字段的盲索引（blind index）
+
+Fernet密文每次都不同，无法按值查询。这里对规范化后的明文做keyed HMAC，
+存到单独的btree索引列，按SSN/保险ID精确查找只需一次索引查询。
+
+- 每个字段用不同的前缀，同一个值在不同字段的索引不同
+- 加密列被赋值时自动更新索引列（attribute set事件），任何写入路径都不用额外处理
+- HMAC key是单独的BLIND_INDEX_KEY（启动时必须配置，且不能和ENCRYPTION_KEY相同），
+  轮换ENCRYPTION_KEY（重新加密）时索引列保持不变；
+  BLIND_INDEX_KEY本身更换后需要运行`flask crypto backfill-blind-index --recompute-all`
+"""
+from flask import current_app
+from sqlalchemy import event, select, update, bindparam
+from functools import lru_cache
+from models import db, Patient, Insurance
+from security.encryption import decrypt_data
+import hashlib
+import hmac
+import re
+
+def _normalize_ssn(value: str) -> str:
+    return re.sub(r'\D', '', value)
+
+def _normalize_insurance_id(value: str) -> str:
+    return re.sub(r'[^0-9A-Z]', '', value.upper())
+
+_NORMALIZERS = {
+    'ssn': _normalize_ssn,
+    'insurance_id': _normalize_insurance_id,
+}
+
+# 字段 -> (表, 加密列, 索引列)
+INDEXED_COLUMNS = {
+    'ssn': (Patient.__table__, 'encrypted_ssn', 'ssn_bidx'),
+    'insurance_id': (Insurance.__table__, 'encrypted_insurance_id', 'insurance_id_bidx'),
+}
+
+def init_blind_index(app):
+    """
+    启动时检查BLIND_INDEX_KEY：缺失时按值查找会全部落空，所以直接拒绝启动
+    """
+    key = app.config.get('BLIND_INDEX_KEY')
+    if not key:
+        raise RuntimeError('BLIND_INDEX_KEY must be set (a dedicated key that is not rotated with ENCRYPTION_KEY)')
+    if key == app.config.get('ENCRYPTION_KEY'):
+        raise RuntimeError('BLIND_INDEX_KEY must differ from ENCRYPTION_KEY')
+
+@lru_cache(maxsize=8)
+def _derive_key(secret: str) -> bytes:
+    return hmac.new(secret.encode(), b'blind-index', hashlib.sha256).digest()
+
+def blind_index(field: str, plain_text: str) -> str:
+    """
+    计算字段值的盲索引，空值返回None
+    """
+    if not plain_text:
+        return None
+
+    normalized = _NORMALIZERS[field](plain_text)
+    if not normalized:
+        return None
+
+    message = f'{field}:{normalized}'.encode()
+    return hmac.new(_derive_key(current_app.config['BLIND_INDEX_KEY']), message, hashlib.sha256).hexdigest()
+
+# ============ 自动维护 ============
+
+@event.listens_for(Patient.encrypted_ssn, 'set')
+def _ssn_set(target, value, oldvalue, initiator):
+    target.ssn_bidx = blind_index('ssn', decrypt_data(value)) if value else None
+
+@event.listens_for(Insurance.encrypted_insurance_id, 'set')
+def _insurance_id_set(target, value, oldvalue, initiator):
+    target.insurance_id_bidx = blind_index('insurance_id', decrypt_data(value)) if value else None
+
+# ============ 查询 ============
+
+def find_patients(ssn: str = None, insurance_id: str = None) -> list:
+    """
+    按SSN或保险ID精确查找患者
+    """
+    query = Patient.query
+    if ssn:
+        query = query.filter(Patient.ssn_bidx == blind_index('ssn', ssn))
+    if insurance_id:
+        query = query.join(Insurance, Insurance.patient_id == Patient.id)\
+            .filter(Insurance.insurance_id_bidx == blind_index('insurance_id', insurance_id))
+    return query.order_by(Patient.id).all()
+
+# ============ 回填 ============
+
+def backfill_blind_indexes(batch_size: int = 500, recompute_all: bool = False, log=print) -> dict:
+    """
+    为已有数据计算盲索引（默认只处理索引列为空的行，可以重复运行）
+    recompute_all=True时重算所有行（更换BLIND_INDEX_KEY之后）
+    返回 {字段: 处理的行数}
+    """
+    processed = {}
+    for field, (table, encrypted_name, index_name) in INDEXED_COLUMNS.items():
+        encrypted, index = table.c[encrypted_name], table.c[index_name]
+        statement = update(table)\
+            .where(table.c.id == bindparam('row_id'))\
+            .values({index_name: bindparam('value')})
+
+        pending = [encrypted.isnot(None)]
+        if not recompute_all:
+            pending.append(index.is_(None))
+
+        last_id, done = 0, 0
+        while True:
+            rows = db.session.execute(
+                select(table.c.id, encrypted)
+                .where(*pending, table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+
+            db.session.execute(statement, [
+                {'row_id': row_id, 'value': blind_index(field, decrypt_data(value))}
+                for row_id, value in rows
+            ])
+            db.session.commit()
+            last_id, done = rows[-1][0], done + len(rows)
+            log(f"{table.name}.{index_name}: {done} rows")
+
+        processed[field] = done
+    return processed
@@ -1,12 +1,13 @@
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet
 from flask import current_app
+from functools import lru_cache
 import base64
 
-def get_cipher():
+def _derive_key(key: str) -> bytes:
     """
-    获取加密cipher
+    把配置里的key转换为Fernet key
     """
-    key = current_app.config['ENCRYPTION_KEY'].encode()
+    key = key.encode()
     # 确保key是32字节
     if len(key) < 32:
         key = key.ljust(32, b'0')
@@ -14,8 +15,21 @@ def get_cipher():
         key = key[:32]
     
     # Fernet需要base64编码的32字节key
-    key = base64.urlsafe_b64encode(key)
-    return Fernet(key)
+    return base64.urlsafe_b64encode(key)
+
+@lru_cache(maxsize=8)
+def _build_cipher(keys: tuple) -> MultiFernet:
+    return MultiFernet([Fernet(_derive_key(key)) for key in keys])
+
+def get_cipher() -> MultiFernet:
+    """
+    获取加密cipher（按key缓存，不再每次调用都重新构造）
+    
+    ENCRYPTION_KEY用于加密；ENCRYPTION_OLD_KEYS里的旧key只用于解密，
+    轮换key时把旧key移到ENCRYPTION_OLD_KEYS，再运行`flask crypto reencrypt`
+    """
+    keys = (current_app.config['ENCRYPTION_KEY'], *current_app.config['ENCRYPTION_OLD_KEYS'])
+    return _build_cipher(keys)
 
 def encrypt_data(plain_text: str) -> str:
     """
@@ -37,4 +51,13 @@ def decrypt_data(encrypted_text: str) -> str:
     
     cipher = get_cipher()
     decrypted = cipher.decrypt(encrypted_text.encode())
-    return decrypted.decode()
\ No newline at end of file
+    return decrypted.decode()
+
+def rotate_data(encrypted_text: str) -> str:
+    """
+    用当前ENCRYPTION_KEY重新加密（密文可以是任何已配置key加密的）
+    """
+    if not encrypted_text:
+        return encrypted_text
+    
+    return get_cipher().rotate(encrypted_text.encode()).decode()
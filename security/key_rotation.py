@@ -0,0 +1,103 @@
+"""
+加密字段的批量重新加密（key轮换）
+
+- 按主键顺序分批读取，每批一次UPDATE并提交，内存只占一批
+- 每批提交后把进度写入状态文件，中断后再运行会从上次的位置继续
+- 进度按当前key的指纹区分，换了新key会自动从头开始
+- UPDATE带上旧密文作为条件，期间被应用改写过的行不会被覆盖
+"""
+from sqlalchemy import select, update, bindparam, func
+from models import db, Patient, Insurance
+from security.encryption import rotate_data
+import hashlib
+import json
+import os
+
+# 需要重新加密的列
+ENCRYPTED_COLUMNS = (
+    (Patient.__table__, 'encrypted_ssn'),
+    (Insurance.__table__, 'encrypted_insurance_id'),
+)
+
+def key_fingerprint(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def _load_state(path: str, fingerprint: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        state = json.load(f)
+    if state.get('key') != fingerprint:
+        return {}
+    return state.get('progress', {})
+
+def _save_state(path: str, fingerprint: str, progress: dict):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'key': fingerprint, 'progress': progress}, f)
+    os.replace(tmp_path, path)
+
+def reencrypt_column(table, column_name: str, start_after: int = 0, batch_size: int = 500,
+                     on_batch=None) -> int:
+    """
+    重新加密一列，返回处理的行数
+    on_batch(last_id, done, total) 在每批提交后调用
+    """
+    column = table.c[column_name]
+    total = db.session.execute(
+        select(func.count()).select_from(table).where(column.isnot(None), table.c.id > start_after)
+    ).scalar()
+
+    statement = update(table)\
+        .where(table.c.id == bindparam('row_id'), column == bindparam('old_value'))\
+        .values({column_name: bindparam('new_value')})
+
+    last_id, done = start_after, 0
+    while True:
+        rows = db.session.execute(
+            select(table.c.id, column)
+            .where(column.isnot(None), table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return done
+
+        params = [
+            {'row_id': row_id, 'old_value': value, 'new_value': rotate_data(value)}
+            for row_id, value in rows
+        ]
+        db.session.execute(statement, params)
+        db.session.commit()
+
+        last_id, done = rows[-1][0], done + len(rows)
+        if on_batch:
+            on_batch(last_id, done, total)
+
+def reencrypt_all(key: str, state_path: str, batch_size: int = 500, restart: bool = False, log=print) -> dict:
+    """
+    用当前key重新加密所有加密列，可中断后继续
+    返回 {表.列: 本次处理的行数}
+    """
+    fingerprint = key_fingerprint(key)
+    progress = {} if restart else _load_state(state_path, fingerprint)
+
+    processed = {}
+    for table, column_name in ENCRYPTED_COLUMNS:
+        name = f'{table.name}.{column_name}'
+        if progress.get(name, {}).get('complete'):
+            log(f"{name}: already re-encrypted")
+            continue
+
+        def checkpoint(last_id, done, total, name=name):
+            progress[name] = {'last_id': last_id}
+            _save_state(state_path, fingerprint, progress)
+            log(f"{name}: {done}/{total} rows")
+
+        start_after = progress.get(name, {}).get('last_id', 0)
+        processed[name] = reencrypt_column(table, column_name, start_after, batch_size, checkpoint)
+
+        progress[name] = {'last_id': progress.get(name, {}).get('last_id', start_after), 'complete': True}
+        _save_state(state_path, fingerprint, progress)
+        log(f"{name}: done ({processed[name]} rows)")
+    return processed
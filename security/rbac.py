@@ -17,7 +17,8 @@ def check_permission(resource_type: str, action: str):
             'patient': ['view', 'create', 'update'],
             'visit': ['view', 'create', 'update'],
             'insurance': ['view', 'update'],
-            'user': ['view']
+            'user': ['view'],
+            'export': ['view']  # 解密字段另见EXPORT_DECRYPT_ROLES
         },
         'patient': {
             'patient': ['view'],  # 只能查看自己
@@ -1,13 +1,16 @@
 import assemblyai as aai
 from openai import OpenAI
 from flask import current_app
+from services.transcription_cache import hash_file, settings_fingerprint, get_cached, store
+from services.analysis_cache import normalize_transcript, cache_key, get_analysis, store_analysis
 import json
 import os
 from datetime import datetime
 
-def process_audio_file(audio_path: str) -> dict:
+def process_audio_file(audio_path: str, content_hash: str = None) -> dict:
     """
     处理音频文件：转录 + 症状分析
+    content_hash: 上传时算好的音频SHA-256（用于转录缓存），没有时读文件计算
     
     Returns:
         {
@@ -17,7 +20,7 @@ def process_audio_file(audio_path: str) -> dict:
         }
     """
     # 1. 语音转文字（AssemblyAI）
-    text = transcribe_audio(audio_path)
+    text = transcribe_audio(audio_path, content_hash)
     
     # 2. 症状分析（Perplexity AI）
     analysis = analyze_symptoms(text)
@@ -31,28 +34,66 @@ def process_audio_file(audio_path: str) -> dict:
         'analysis_filename': filename
     }
 
-def transcribe_audio(audio_path: str) -> str:
-    """使用AssemblyAI转录音频"""
+def transcription_settings() -> dict:
+    """
+    影响转录结果的设置，作为转录缓存key的一部分
+    """
+    return {'provider': 'assemblyai', 'language_code': current_app.config['ASSEMBLYAI_LANGUAGE_CODE']}
+
+def transcribe_audio(audio_path: str, content_hash: str = None) -> str:
+    """
+    使用AssemblyAI转录音频
+    同一段录音（内容哈希相同）在相同设置下只转录一次（services/transcription_cache.py）
+    """
+    settings = transcription_settings()
+    use_cache = current_app.config['TRANSCRIPTION_CACHE_ENABLED']
+    if use_cache:
+        content_hash = content_hash or hash_file(audio_path)
+        fingerprint = settings_fingerprint(settings)
+        cached = get_cached(content_hash, fingerprint)
+        if cached is not None:
+            return cached
+    
     aai.settings.api_key = current_app.config['ASSEMBLYAI_API_KEY']
     
-    transcriber = aai.Transcriber()
+    config = aai.TranscriptionConfig(language_code=settings['language_code']) if settings['language_code'] else None
+    transcriber = aai.Transcriber(config=config)
     transcript = transcriber.transcribe(audio_path)
     
+    # 转录失败（没有文本）的结果不缓存
+    if use_cache and transcript.text is not None:
+        store(content_hash, fingerprint, transcript.text, os.path.getsize(audio_path))
+    
     return transcript.text
 
+# 修改系统提示词时把版本号加一，旧的分析结果缓存自动失效（services/analysis_cache.py）
+ANALYSIS_MODEL = "sonar-pro"
+ANALYSIS_PROMPT_VERSION = 1
+ANALYSIS_SYSTEM_PROMPT = (
+    "You are an artificial intelligence assistant for hospital patients. "
+    "You need to analyze the patient's symptoms and provide possible causes. "
+    "The response MUST be a valid JSON object with exactly this format: "
+    '{"symptoms": ["symptom 1", "symptom 2", ...], "possible causes": ["cause 1", "cause 2", ...]}. '
+    "Analyze the symptoms in detail (severity and duration). "
+    "Do not include any explanation or additional text - ONLY the JSON object."
+)
+
 def analyze_symptoms(text: str) -> dict:
-    """使用Perplexity AI分析症状"""
+    """
+    使用Perplexity AI分析症状
+    相同的转录（规范化后）、模型和提示词版本只调用一次模型，结果缓存在进程内和数据库里
+    """
+    use_cache = current_app.config['ANALYSIS_CACHE_ENABLED'] and normalize_transcript(text)
+    if use_cache:
+        key = cache_key(text, ANALYSIS_MODEL, ANALYSIS_PROMPT_VERSION)
+        cached = get_analysis(key)
+        if cached is not None:
+            return cached
+    
     messages = [
         {
             "role": "system",
-            "content": (
-                "You are an artificial intelligence assistant for hospital patients. "
-                "You need to analyze the patient's symptoms and provide possible causes. "
-                "The response MUST be a valid JSON object with exactly this format: "
-                '{"symptoms": ["symptom 1", "symptom 2", ...], "possible causes": ["cause 1", "cause 2", ...]}. '
-                "Analyze the symptoms in detail (severity and duration). "
-                "Do not include any explanation or additional text - ONLY the JSON object."
-            ),
+            "content": ANALYSIS_SYSTEM_PROMPT,
         },
         {
             "role": "user",
@@ -66,12 +107,13 @@ def analyze_symptoms(text: str) -> dict:
     )
     
     response = client.chat.completions.create(
-        model="sonar-pro",
+        model=ANALYSIS_MODEL,
         messages=messages,
     )
     
     summary = response.choices[0].message.content
     
+    result = None
     try:
         # 解析JSON响应
         start_idx = summary.find('{')
@@ -86,10 +128,15 @@ def analyze_symptoms(text: str) -> dict:
                 result['symptoms'] = []
             if 'possible causes' not in result:
                 result['possible causes'] = []
-            
-            return result
     except Exception as e:
         print(f"Error parsing AI response: {e}")
+        result = None
+    
+    if result is not None:
+        # 只缓存解析成功的结果
+        if use_cache:
+            store_analysis(key, ANALYSIS_MODEL, ANALYSIS_PROMPT_VERSION, result)
+        return result
     
     # 解析失败时返回默认结构
     return {
@@ -0,0 +1,124 @@
+"""
+症状分析结果缓存（analyze_symptoms）
+
+- key = SHA-256(规范化后的转录文本, 模型, 系统提示词版本)，
+  改了提示词（ANALYSIS_PROMPT_VERSION加一）或换模型后旧结果自然不再命中
+- 两层：进程内TTLCache（LRU + TTL）在前，共享的symptom_analyses表在后（多进程/重启后仍然命中）
+- 表里的条目有过期时间；`flask audio-jobs prune-analyses`删除过期、其他提示词版本的条目，
+  并按最后使用时间只保留ANALYSIS_CACHE_DB_MAX_ENTRIES条
+- 命中率（本进程，进程内一层和两层合计）在/api/auth/cache-stats的symptom_analysis里
+"""
+from sqlalchemy import select, update, delete, or_
+from sqlalchemy.dialects.postgresql import insert
+from models import db, SymptomAnalysis
+from services.cache import TTLCache
+from datetime import datetime, timedelta
+import copy
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+
+analysis_cache = TTLCache('symptom_analysis', max_size=1024, ttl=3600)
+_analyses = SymptomAnalysis.__table__
+
+_db_ttl_days = 30
+_stats = {'db_hits': 0, 'db_misses': 0}
+_stats_lock = threading.Lock()
+
+def init_analysis_cache(app):
+    global _db_ttl_days
+    analysis_cache.configure(
+        max_size=app.config['ANALYSIS_CACHE_SIZE'],
+        ttl=app.config['ANALYSIS_CACHE_TTL']
+    )
+    _db_ttl_days = app.config['ANALYSIS_CACHE_DB_TTL_DAYS']
+
+def normalize_transcript(text: str) -> str:
+    """
+    只去掉不影响含义的差异：大小写、全角/半角、标点、多余空白
+    "I have a headache." 和 "i have a  headache" 是同一个key
+    """
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = re.sub(r"[^\w\s']", ' ', text)
+    return ' '.join(text.split())
+
+def cache_key(text: str, model: str, prompt_version: int) -> str:
+    raw = json.dumps([normalize_transcript(text), model, prompt_version])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+def get_analysis(key: str):
+    """
+    先查进程内缓存，再查表（命中时放回进程内缓存并更新最后使用时间），都没有时返回None
+    """
+    cached = analysis_cache.get(key)
+    if cached is not None:
+        return copy.deepcopy(cached)
+
+    now = datetime.utcnow()
+    with db.engine.begin() as connection:
+        analysis = connection.execute(
+            update(_analyses)
+            .where(_analyses.c.cache_key == key, _analyses.c.expires_at > now)
+            .values(last_used_at=now, hits=_analyses.c.hits + 1)
+            .returning(_analyses.c.analysis)
+        ).scalar()
+    if analysis is None:
+        _count('db_misses')
+        return None
+
+    _count('db_hits')
+    analysis_cache.set(key, analysis)
+    return copy.deepcopy(analysis)
+
+def store_analysis(key: str, model: str, prompt_version: int, analysis: dict):
+    now = datetime.utcnow()
+    values = {
+        'analysis': analysis, 'model': model, 'prompt_version': prompt_version,
+        'created_at': now, 'last_used_at': now, 'expires_at': now + timedelta(days=_db_ttl_days)
+    }
+    statement = insert(_analyses).values(cache_key=key, hits=0, **values)
+    with db.engine.begin() as connection:
+        # 过期条目被重新计算时覆盖
+        connection.execute(statement.on_conflict_do_update(index_elements=[_analyses.c.cache_key], set_=values))
+    analysis_cache.set(key, copy.deepcopy(analysis))
+
+def prune_analyses(prompt_version: int, max_entries: int) -> int:
+    """
+    删除过期的、其他提示词版本的条目，再按最后使用时间淘汰超出max_entries的部分
+    返回删除的行数
+    """
+    result = db.session.execute(delete(SymptomAnalysis).where(or_(
+        SymptomAnalysis.expires_at <= datetime.utcnow(),
+        SymptomAnalysis.prompt_version != prompt_version
+    )))
+    deleted = result.rowcount
+
+    keep = select(_analyses.c.cache_key).order_by(_analyses.c.last_used_at.desc()).limit(max_entries)
+    result = db.session.execute(delete(SymptomAnalysis).where(SymptomAnalysis.cache_key.not_in(keep)))
+    db.session.commit()
+    return deleted + result.rowcount
+
+def analysis_cache_stats() -> dict:
+    """
+    两层合计的命中率（本进程）：provider_calls是两层都没有命中、需要调用模型的次数
+    """
+    memory = analysis_cache.stats()
+    with _stats_lock:
+        db_hits, db_misses = _stats['db_hits'], _stats['db_misses']
+    lookups = memory['hits'] + memory['misses']
+    return {
+        'memory': memory,
+        'db': {
+            'hits': db_hits,
+            'misses': db_misses,
+            'hit_ratio': round(db_hits / (db_hits + db_misses), 4) if db_hits + db_misses else 0.0
+        },
+        'provider_calls': db_misses,
+        'hit_ratio': round((memory['hits'] + db_hits) / lookups, 4) if lookups else 0.0
+    }
@@ -0,0 +1,272 @@
+"""
+语音分析任务（/api/process_audio）
+
+- 上传只保存音频、写一条audio_jobs（queued）就返回202，不在web worker里等转录和分析
+- 后台线程池领取任务：SELECT ... FOR UPDATE SKIP LOCKED，多个worker/进程不会领到同一个任务
+- 领取时设置租约（next_attempt_at = 现在 + AUDIO_JOB_LEASE_SECONDS），
+  worker或进程崩溃后租约到期，任务被重新领取；任务在表里，重启后继续执行
+- 失败按指数退避（带抖动）重新排队，超过AUDIO_JOB_MAX_ATTEMPTS次后标记为failed
+- 成功时在同一个事务里创建Visit、写审计日志、把任务标记为succeeded；
+  租约过期后被别人接手的旧尝试不会再提交结果
+"""
+from flask import current_app
+from sqlalchemy import select, update, insert, event
+from sqlalchemy.orm import Session as OrmSession
+from models import db, AudioJob, AuditLog, Visit
+from services import ai_service
+from datetime import datetime, timedelta
+import atexit
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ('queued', 'running')
+_jobs = AudioJob.__table__
+
+def submit_job(patient_id: int, user_id: int, audio_file_path: str, audio_sha256: str = None) -> AudioJob:
+    """
+    新建任务（随请求事务提交），提交后唤醒本进程的worker
+    """
+    job = AudioJob(patient_id=patient_id, user_id=user_id, audio_file_path=audio_file_path,
+                   audio_sha256=audio_sha256, status='queued', next_attempt_at=datetime.utcnow())
+    db.session.add(job)
+    db.session.flush()
+    db.session.info['audio_job_submitted'] = True
+    return job
+
+@event.listens_for(OrmSession, 'after_commit')
+def _notify_after_commit(session):
+    # 提交之后任务才对worker可见
+    if session.info.pop('audio_job_submitted', False):
+        audio_workers.notify()
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('audio_job_submitted', None)
+
+def retry_delay(attempt: int, base: float, maximum: float) -> float:
+    """
+    第attempt次失败后的等待秒数：base * 2^(attempt-1)，不超过maximum，再乘以[0.5, 1)的抖动
+    """
+    return min(base * 2 ** (attempt - 1), maximum) * (0.5 + random.random() / 2)
+
+def claim_next_job(now: datetime = None):
+    """
+    领取一个到期的任务（queued到了执行时间，或running租约已过期）
+    返回 (job_id, attempt, audio_file_path, audio_sha256)，没有时返回None
+    """
+    now = now or datetime.utcnow()
+    due = select(_jobs.c.id)\
+        .where(_jobs.c.status.in_(ACTIVE_STATUSES), _jobs.c.next_attempt_at <= now)\
+        .order_by(_jobs.c.next_attempt_at)\
+        .limit(1)\
+        .with_for_update(skip_locked=True)\
+        .scalar_subquery()
+    row = db.session.execute(
+        update(_jobs)
+        .where(_jobs.c.id == due)
+        .values(status='running', attempts=_jobs.c.attempts + 1, updated_at=now,
+                next_attempt_at=now + timedelta(seconds=current_app.config['AUDIO_JOB_LEASE_SECONDS']))
+        .returning(_jobs.c.id, _jobs.c.attempts, _jobs.c.audio_file_path, _jobs.c.audio_sha256)
+    ).first()
+    db.session.commit()
+    return tuple(row) if row else None
+
+def _lock_attempt(job_id: int, attempt: int):
+    """
+    锁定任务行；这次尝试已经被接手（租约过期后重新领取）时返回None
+    """
+    job = db.session.execute(
+        select(AudioJob).where(AudioJob.id == job_id).with_for_update()
+    ).scalar_one_or_none()
+    if job is None or job.status != 'running' or job.attempts != attempt:
+        db.session.rollback()
+        return None
+    return job
+
+def _complete(job_id: int, attempt: int, result: dict):
+    job = _lock_attempt(job_id, attempt)
+    if job is None:
+        return
+
+    visit = Visit(
+        patient_id=job.patient_id,
+        visit_reason=result['text'],
+        voice_transcription=result['text'],
+        symptoms=result['analysis'].get('symptoms', []),
+        possible_causes=result['analysis'].get('possible causes', []),
+        audio_file_path=job.audio_file_path,
+        analysis_file_path=result['analysis_filename']
+    )
+    db.session.add(visit)
+    db.session.flush()
+
+    now = datetime.utcnow()
+    job.status, job.result, job.visit_id = 'succeeded', result, visit.id
+    job.last_error, job.finished_at = None, now
+    # worker里没有请求上下文，直接写审计记录（和就诊记录同一个事务）
+    db.session.execute(insert(AuditLog), [{
+        'user_id': job.user_id,
+        'action': 'create',
+        'resource_type': 'visit',
+        'resource_id': visit.id,
+        'user_agent': 'audio-job worker',
+        'timestamp': now,
+        'details': {'patient_id': job.patient_id, 'has_audio': True, 'job_id': job.id}
+    }])
+    db.session.commit()
+
+def _fail(job_id: int, attempt: int, error: Exception):
+    job = _lock_attempt(job_id, attempt)
+    if job is None:
+        return
+
+    now = datetime.utcnow()
+    job.last_error = f'{type(error).__name__}: {error}'
+    if attempt >= current_app.config['AUDIO_JOB_MAX_ATTEMPTS']:
+        job.status, job.finished_at = 'failed', now
+    else:
+        job.status = 'queued'
+        job.next_attempt_at = now + timedelta(seconds=retry_delay(
+            attempt, current_app.config['AUDIO_JOB_RETRY_BASE_SECONDS'], current_app.config['AUDIO_JOB_RETRY_MAX_SECONDS']
+        ))
+    db.session.commit()
+
+def run_next_job() -> bool:
+    """
+    领取并执行一个任务（需要app上下文），没有到期任务时返回False
+    转录和分析在事务之外执行，不占用数据库连接
+    """
+    claimed = claim_next_job()
+    if claimed is None:
+        return False
+
+    job_id, attempt, filename, audio_sha256 = claimed
+    try:
+        result = ai_service.process_audio_file(os.path.join(current_app.config['AUDIO_FOLDER'], filename), audio_sha256)
+        _complete(job_id, attempt, result)
+    except Exception as e:
+        logger.warning(f'Audio job {job_id} attempt {attempt} failed: {e}')
+        db.session.rollback()
+        _fail(job_id, attempt, e)
+    return True
+
+def job_status(job: AudioJob) -> dict:
+    """
+    状态接口/SSE返回的内容
+    """
+    data = {'job_id': job.id, 'status': job.status, 'attempts': job.attempts}
+    if job.status == 'queued' and job.attempts:
+        data['retry_at'] = job.next_attempt_at.isoformat()
+    if job.status == 'failed':
+        data['error'] = 'Audio processing failed, please try again'
+    if job.status == 'succeeded':
+        data.update({
+            'success': True,
+            'visit_id': job.visit_id,
+            'text': job.result['text'],
+            'analysis': job.result['analysis'],
+            'analysis_file': job.result['analysis_filename']
+        })
+    return data
+
+class AudioJobWorkers:
+    """
+    进程内的任务线程池
+    - 新任务提交后notify唤醒一个线程；其他进程提交的任务、重试和过期租约靠轮询（AUDIO_JOB_POLL_INTERVAL）
+    """
+
+    def __init__(self):
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return bool(self._threads)
+
+    def start(self, app, workers: int = None):
+        """
+        启动线程（第一个请求时调用，保证在gunicorn fork之后）
+        """
+        with self._start_lock:
+            if self._threads:
+                return
+            self._app = app
+            self.poll_interval = app.config['AUDIO_JOB_POLL_INTERVAL']
+            self._stopping = False
+            for index in range(workers or app.config['AUDIO_JOB_WORKERS']):
+                thread = threading.Thread(target=self._run, name=f'audio-job-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            atexit.register(self.stop)
+
+    def notify(self):
+        with self._condition:
+            self._condition.notify()
+
+    def stop(self):
+        """
+        停止线程；正在执行的任务做完当前这一次尝试
+        """
+        if not self._threads:
+            return
+        self._stopping = True
+        with self._condition:
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                with self._app.app_context():
+                    ran = run_next_job()
+            except Exception:
+                logger.exception('Audio job worker failed')
+                ran = False
+            if not ran and not self._stopping:
+                with self._condition:
+                    self._condition.wait(self.poll_interval)
+
+audio_workers = AudioJobWorkers()
+
+def init_audio_jobs(app):
+    """
+    AUDIO_JOB_WORKERS > 0 时，在第一个请求时启动本进程的worker（包括重启前未完成的任务）
+    """
+    @app.before_request
+    def _start_audio_workers():
+        if not audio_workers.running and app.config['AUDIO_JOB_WORKERS'] > 0:
+            audio_workers.start(app)
+
+def stream_job_status(app, job_id: int, max_seconds: float = None):
+    """
+    任务状态的SSE消息生成器：状态变化时推送，到终态（succeeded/failed）后结束
+    每次短连接读一次任务行，不长时间占用数据库连接
+    """
+    poll_interval = app.config['AUDIO_JOB_POLL_INTERVAL']
+    deadline = time.monotonic() + (max_seconds or app.config['AUDIO_JOB_STREAM_SECONDS'])
+    last = None
+    while True:
+        with app.app_context():
+            data = job_status(db.session.get(AudioJob, job_id))
+        if data != last:
+            last = data
+            yield f"event: status\ndata: {json.dumps(data)}\n\n"
+        else:
+            yield ': keepalive\n\n'
+        if data['status'] in ('succeeded', 'failed') or time.monotonic() >= deadline:
+            return
+        time.sleep(poll_interval)
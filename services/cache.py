@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict
+
+# 所有命名缓存的注册表（用于统计和测试清理）
+_registry = {}
+
+
+class TTLCache:
+    """
+    线程安全的有界TTL缓存
+    - 超过max_size时按LRU淘汰
+    - 每个条目可以有自己的TTL（不超过默认TTL）
+    - 记录命中/未命中次数
+    """
+
+    def __init__(self, name: str, max_size: int = 1024, ttl: float = 60):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def configure(self, max_size: int = None, ttl: float = None):
+        """
+        根据应用配置调整大小和TTL
+        """
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if ttl is not None:
+                self.ttl = ttl
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        """
+        读取缓存，过期条目视为未命中
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """
+        写入缓存，ttl不传时使用默认TTL
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        """
+        删除单个条目（失效）
+        """
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0
+            }
+
+
+def cache_stats() -> dict:
+    """
+    返回所有命名缓存的统计信息
+    """
+    return {name: cache.stats() for name, cache in _registry.items()}
+
+
+def clear_caches():
+    """
+    清空所有缓存（测试和运维使用）
+    """
+    for cache in _registry.values():
+        cache.clear()
@@ -0,0 +1,160 @@
+"""
+患者/就诊/症状的流式导出（CSV或NDJSON，可选gzip）
+
+- 用独立连接和服务端游标（stream_results + yield_per）逐批读取，只选需要的列，不构造ORM对象
+- 每批编码完就交给调用方（HTTP响应或文件），内存只占一批，与表大小无关
+- 加密字段（SSN、保险ID）默认不导出，decrypt=True时才解密输出，权限由调用方检查
+"""
+from sqlalchemy import select, func, literal_column, and_, case
+from models import db, Patient, User, Visit, Insurance
+from security.encryption import decrypt_data
+from datetime import date, datetime
+import csv
+import io
+import json
+import zlib
+
+_patients, _users, _visits, _insurance = Patient.__table__, User.__table__, Visit.__table__, Insurance.__table__
+
+def _patients_query():
+    query = select(
+        _patients.c.id, _patients.c.full_name, _patients.c.date_of_birth, _patients.c.phone,
+        _patients.c.address, _users.c.email, _patients.c.visit_count, _patients.c.last_visit_at,
+        _insurance.c.insurance_name, _insurance.c.medications, _insurance.c.medical_conditions,
+        _patients.c.created_at, _patients.c.updated_at,
+        _patients.c.encrypted_ssn, _insurance.c.encrypted_insurance_id
+    ).select_from(_patients)\
+        .outerjoin(_users, _users.c.id == _patients.c.user_id)\
+        .outerjoin(_insurance, _insurance.c.patient_id == _patients.c.id)
+    return query, _patients.c.updated_at, _patients.c.id
+
+def _visits_query():
+    query = select(
+        _visits.c.id, _visits.c.patient_id, _visits.c.visit_date, _visits.c.visit_reason,
+        _visits.c.symptoms, _visits.c.possible_causes, _visits.c.pain_level, _visits.c.pain_duration,
+        _visits.c.status, _visits.c.created_at
+    )
+    return query, _visits.c.visit_date, _visits.c.id
+
+def _symptoms_query():
+    # 每个症状一行，symptoms不是数组的就诊记录没有行
+    symptoms = case(
+        (func.jsonb_typeof(_visits.c.symptoms) == 'array', _visits.c.symptoms),
+        else_=literal_column("'[]'::jsonb")
+    )
+    symptom = func.jsonb_array_elements_text(symptoms).table_valued('value').lateral('symptom')
+    query = select(
+        _visits.c.id.label('visit_id'), _visits.c.patient_id, _visits.c.visit_date,
+        symptom.c.value.label('symptom')
+    ).select_from(_visits).join(symptom, literal_column('true'))
+    return query, _visits.c.visit_date, _visits.c.id
+
+# 数据集 -> (查询, 输出列, 加密列 {输出列: 密文列})
+DATASETS = {
+    'patients': (
+        _patients_query,
+        ['id', 'full_name', 'date_of_birth', 'phone', 'address', 'email', 'visit_count', 'last_visit_at',
+         'insurance_name', 'medications', 'medical_conditions', 'created_at', 'updated_at'],
+        {'ssn': 'encrypted_ssn', 'insurance_id': 'encrypted_insurance_id'}
+    ),
+    'visits': (
+        _visits_query,
+        ['id', 'patient_id', 'visit_date', 'visit_reason', 'symptoms', 'possible_causes',
+         'pain_level', 'pain_duration', 'status', 'created_at'],
+        {}
+    ),
+    'symptoms': (
+        _symptoms_query,
+        ['visit_id', 'patient_id', 'visit_date', 'symptom'],
+        {}
+    ),
+}
+FORMATS = ('csv', 'ndjson')
+
+def export_columns(dataset: str, decrypt: bool = False) -> list:
+    _, columns, encrypted = DATASETS[dataset]
+    return columns + (list(encrypted) if decrypt else [])
+
+def iter_rows(dataset: str, since: datetime = None, until: datetime = None,
+              decrypt: bool = False, batch_size: int = 1000):
+    """
+    按批逐行产出导出的数据（dict）
+    since/until: patients按updated_at，visits/symptoms按visit_date过滤，since包含、until不包含
+    """
+    build, columns, encrypted = DATASETS[dataset]
+    query, time_column, id_column = build()
+    conditions = []
+    if since is not None:
+        conditions.append(time_column >= since)
+    if until is not None:
+        conditions.append(time_column < until)
+    if conditions:
+        query = query.where(and_(*conditions))
+    query = query.order_by(id_column)
+
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+        for row in result.mappings():
+            item = {column: row[column] for column in columns}
+            if decrypt:
+                for name, source in encrypted.items():
+                    item[name] = decrypt_data(row[source]) if row[source] else None
+            yield item
+
+def _plain(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+def encode_rows(rows, columns: list, fmt: str, chunk_rows: int = 1000):
+    """
+    把行编码成CSV/NDJSON文本，每chunk_rows行产出一块
+    CSV里的JSON列（symptoms等）写成JSON字符串
+    """
+    buffer = io.StringIO()
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+
+    count = 0
+    for row in rows:
+        if fmt == 'csv':
+            writer.writerow([
+                json.dumps(value) if isinstance(value, (list, dict)) else _plain(value)
+                for value in (row[column] for column in columns)
+            ])
+        else:
+            buffer.write(json.dumps({column: _plain(row[column]) for column in columns}) + '\n')
+        count += 1
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def gzip_chunks(chunks):
+    """
+    边编码边压缩（gzip格式）
+    """
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_stream(dataset: str, fmt: str = 'csv', gzip: bool = False, decrypt: bool = False,
+                  since: datetime = None, until: datetime = None, batch_size: int = 1000):
+    """
+    导出的字节流
+    """
+    chunks = encode_rows(
+        iter_rows(dataset, since, until, decrypt, batch_size),
+        export_columns(dataset, decrypt), fmt, batch_size
+    )
+    if gzip:
+        return gzip_chunks(chunks)
+    return (chunk.encode() for chunk in chunks)
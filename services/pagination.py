@@ -0,0 +1,72 @@
+import base64
+import json
+from datetime import date, datetime
+from flask import request
+
+# keyset分页的游标：上一页最后一行的排序键，编码成URL安全的字符串
+# 只是位置标记，不是安全边界，查询条件仍然照常做权限检查
+
+def encode_cursor(*values) -> str:
+    """
+    把排序键编码为游标
+    """
+    raw = json.dumps([v.isoformat() if isinstance(v, (date, datetime)) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str, *types) -> list:
+    """
+    解析游标，types依次给出每个值的类型（datetime/date/int/str）
+    格式不对时抛出ValueError
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError('Invalid cursor')
+
+    result = []
+    for value, kind in zip(values, types):
+        if value is None:
+            result.append(None)
+        elif kind is datetime:
+            result.append(datetime.fromisoformat(value))
+        elif kind is date:
+            result.append(date.fromisoformat(value))
+        else:
+            result.append(kind(value))
+    return result
+
+def page_size(default: int, maximum: int, name: str = 'limit') -> int:
+    """
+    读取?limit=（或其他参数名），限制在[1, maximum]之间
+    """
+    limit = request.args.get(name, default, type=int)
+    return max(1, min(limit, maximum))
+
+def parse_datetime_arg(name: str):
+    """
+    读取ISO格式的时间参数，没传时返回None，格式不对时抛出ValueError
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an ISO 8601 datetime')
+
+def parse_int_arg(name: str):
+    """
+    读取整数参数，没传时返回None，格式不对时抛出ValueError
+    （不用request.args.get(type=int)：它把非法值当作没传，过滤条件会被悄悄去掉）
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer')
@@ -0,0 +1,96 @@
+"""
+患者详情的加载和版本（ETag）
+
+- 版本来自Postgres的行版本xmin：患者、用户、保险行，以及当前这一页就诊记录的id和xmin，
+  任何写入路径（包括Core的批量UPDATE）都会改变它，不需要额外的版本列
+- 版本查询只读这些系统列，If-None-Match命中时不再加载和序列化详情
+- 详情本身: 患者 + 用户 + 保险一次joinedload，就诊记录按(visit_date, id)分页单独查询
+"""
+from sqlalchemy import select, cast, literal_column, func, tuple_, Text
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import joinedload
+from models import db, Patient, User, Visit, Insurance
+from services.pagination import encode_cursor, decode_cursor
+from datetime import datetime
+import hashlib
+
+PATIENT_FIELDS = ('id', 'full_name', 'date_of_birth', 'phone', 'address', 'email',
+                  'last_visit', 'visit_count', 'visits', 'insurance')
+DEFAULT_FIELDS = ('id', 'full_name', 'date_of_birth', 'phone', 'address', 'email', 'visits', 'insurance')
+
+def parse_fields(value: str) -> tuple:
+    """
+    解析?fields=，不认识的字段抛出ValueError
+    """
+    if not value:
+        return DEFAULT_FIELDS
+    fields = tuple(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in PATIENT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def _xmin(table) -> object:
+    return cast(literal_column(f'{table}.xmin'), Text)
+
+def _visit_page_query(columns, patient_id: int, cursor: str, limit: int):
+    query = select(*columns).where(Visit.patient_id == patient_id)
+    if cursor:
+        visit_date, visit_id = decode_cursor(cursor, datetime, int)
+        query = query.where(tuple_(Visit.visit_date, Visit.id) < tuple_(visit_date, visit_id))
+    return query.order_by(Visit.visit_date.desc(), Visit.id.desc()).limit(limit + 1)
+
+def detail_version(patient_id: int, fields: tuple, visits_cursor: str = None, visits_limit: int = 20):
+    """
+    返回详情当前的版本字符串，患者不存在时返回None
+    """
+    columns = [_xmin('patients'), _xmin('users')]
+    query = select(Patient.id)
+    if 'insurance' in fields:
+        columns.append(_xmin('insurance'))
+        query = query.outerjoin(Insurance, Insurance.patient_id == Patient.id)
+
+    if 'visits' in fields:
+        page = _visit_page_query(
+            [Visit.id, Visit.visit_date, _xmin('visits').label('xmin')],
+            patient_id, visits_cursor, visits_limit
+        ).subquery()
+        row_versions = func.concat(page.c.id, ':', page.c.xmin)
+        columns.append(
+            select(func.string_agg(
+                row_versions,
+                aggregate_order_by(literal_column("','"), page.c.visit_date.desc(), page.c.id.desc())
+            ))
+            .scalar_subquery()
+        )
+
+    row = db.session.execute(
+        query.add_columns(*columns)
+        .outerjoin(User, User.id == Patient.user_id)
+        .where(Patient.id == patient_id)
+    ).first()
+    if row is None:
+        return None
+    return hashlib.sha1('|'.join(str(value) for value in row).encode()).hexdigest()
+
+def load_patient(patient_id: int, fields: tuple) -> Patient:
+    """
+    一次查询加载患者、用户和（需要时）保险
+    """
+    options = [joinedload(Patient.user)]
+    if 'insurance' in fields:
+        options.append(joinedload(Patient.insurance))
+    return db.session.execute(
+        select(Patient).options(*options).where(Patient.id == patient_id)
+    ).unique().scalar_one_or_none()
+
+def load_visit_page(patient_id: int, cursor: str = None, limit: int = 20):
+    """
+    取一页就诊记录（最新的在前），返回 (visits, next_cursor)
+    """
+    visits = db.session.execute(_visit_page_query([Visit], patient_id, cursor, limit)).scalars().all()
+    next_cursor = None
+    if len(visits) > limit:
+        visits = visits[:limit]
+        next_cursor = encode_cursor(visits[-1].visit_date, visits[-1].id)
+    return visits, next_cursor
@@ -0,0 +1,185 @@
+"""
+回诊患者查找（姓名 + 出生日期）
+
+不依赖pg_trgm等扩展，只用内置索引：
+- search_name: 规范化后的姓名（小写、去重音、只保留字母数字），
+  varchar_pattern_ops btree索引支持前缀匹配
+- name_keys: 每个姓名词的 原词 / 辅音骨架 / 字母排序 三种key，GIN索引，
+  用来容忍元音拼错（jon/john）和字母颠倒（jonh/john）；
+  另外每两个词的key组合成一个pair key（不分先后），多词查询只查pair key，
+  一次GIN查找就很有选择性
+- 给了出生日期时先用date_of_birth索引缩小范围，任何拼写都能找回
+
+候选集有上限：先在SQL里按 完全相同 > 整名前缀 > 命中的key数 排序再截取，
+同名很多时完全匹配不会被截掉；排序（difflib相似度）只在候选集上做，结果数也有硬上限
+"""
+from sqlalchemy import event, select, func, or_, any_, cast
+from sqlalchemy.dialects.postgresql import ARRAY
+from difflib import SequenceMatcher
+from models import db, Patient
+import heapq
+import re
+import unicodedata
+
+# 和Soundex一样，h/w也当作元音忽略（jon/john, smith/smyth）
+_VOWELS = set('aeiouyhw')
+
+def normalize_name(name: str) -> str:
+    """
+    'José  O'Brien' -> 'jose obrien'
+    """
+    if not name:
+        return ''
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(ch for ch in name if not unicodedata.combining(ch)).lower()
+    tokens = [re.sub(r'[^0-9a-z]', '', token) for token in name.split()]
+    return ' '.join(token for token in tokens if token)
+
+def _skeleton(token: str) -> str:
+    # 首字母 + 去掉元音、合并重复字母后的辅音
+    rest = [ch for ch in token[1:] if ch not in _VOWELS]
+    collapsed = [ch for i, ch in enumerate(rest) if i == 0 or ch != rest[i - 1]]
+    return token[0] + ''.join(collapsed)
+
+def token_keys(token: str) -> list:
+    return [f'w:{token}', f's:{_skeleton(token)}', f'a:{"".join(sorted(token))}']
+
+def pair_keys(normalized: str) -> list:
+    """
+    每两个词的key两两组合（排序后拼接，和词序无关）
+    """
+    tokens = normalized.split()
+    keys = []
+    for i in range(len(tokens)):
+        for j in range(i + 1, len(tokens)):
+            for a in token_keys(tokens[i]):
+                for b in token_keys(tokens[j]):
+                    key = 'p:' + '|'.join(sorted((a, b)))
+                    if key not in keys:
+                        keys.append(key)
+    return keys
+
+def name_keys(normalized: str) -> list:
+    keys = []
+    for token in normalized.split():
+        keys.extend(key for key in token_keys(token) if key not in keys)
+    return keys + pair_keys(normalized)
+
+# ============ 自动维护 ============
+
+@event.listens_for(Patient.full_name, 'set')
+def _full_name_set(target, value, oldvalue, initiator):
+    normalized = normalize_name(value)
+    target.search_name = normalized
+    target.name_keys = name_keys(normalized)
+
+# ============ 查询 ============
+
+def _matched_keys(keys: list):
+    """
+    候选的name_keys里命中查询key的个数（相关子查询，只对已经命中索引的行计算）
+    """
+    key = func.unnest(Patient.name_keys).column_valued('key')
+    return select(func.count())\
+        .where(key == any_(cast(keys, ARRAY(db.String(64)))))\
+        .scalar_subquery()
+
+def search_patients(name: str = None, date_of_birth=None, limit: int = 10,
+                    candidate_limit: int = 200, min_score: float = 0.6) -> list:
+    """
+    查找回诊患者，返回 [(row, score)]，按相似度排序
+    row包含id/full_name/date_of_birth/phone/last_visit_at
+    至少需要name或date_of_birth之一
+    """
+    normalized = normalize_name(name)
+    # 只取需要的列，不构造ORM对象
+    query = select(Patient.id, Patient.full_name, Patient.date_of_birth, Patient.phone,
+                   Patient.last_visit_at, Patient.search_name)
+
+    if normalized:
+        # 多个词时用pair key，单个词时用词key；再加上整名前缀匹配
+        keys = pair_keys(normalized) or token_keys(normalized)
+        prefix_match = Patient.search_name.like(normalized + '%')  # 规范化后只有字母数字和空格
+
+    if date_of_birth is not None:
+        # 同一天出生的患者很少，直接全部作为候选
+        query = query.where(Patient.date_of_birth == date_of_birth)
+    elif normalized:
+        query = query.where(or_(Patient.name_keys.overlap(keys), prefix_match))
+    else:
+        return []
+
+    if normalized:
+        # 截取候选集之前先把最可能的排在前面
+        query = query.order_by(
+            (Patient.search_name == normalized).desc(),
+            prefix_match.desc(),
+            _matched_keys(keys).desc(),
+            Patient.id
+        )
+    else:
+        query = query.order_by(Patient.id)
+
+    candidates = db.session.execute(query.limit(candidate_limit)).all()
+
+    if not normalized:
+        ranked = [(row, 1.0) for row in candidates]
+    else:
+        # 和difflib.get_close_matches一样：查询串作为seq2只分析一次，
+        # 先用real_quick_ratio/quick_ratio（ratio的上界）排除不可能进入结果的候选：
+        # 门槛是min_score和目前第limit高的分数中较大的一个
+        matcher = SequenceMatcher()
+        matcher.set_seq2(normalized)
+        ranked, top_scores = [], []
+        for row in candidates:
+            search_name = row.search_name or ''
+            cutoff = max(min_score, top_scores[0]) if top_scores and len(top_scores) >= limit else min_score
+            if search_name.startswith(normalized):
+                score = 1.0
+            else:
+                matcher.set_seq1(search_name)
+                if matcher.real_quick_ratio() < cutoff or matcher.quick_ratio() < cutoff:
+                    continue
+                score = matcher.ratio()
+                if score < cutoff:
+                    continue
+            ranked.append((row, score))
+            if len(top_scores) < limit:
+                heapq.heappush(top_scores, score)
+            elif score > top_scores[0]:
+                heapq.heapreplace(top_scores, score)
+
+    ranked.sort(key=lambda item: (-item[1], item[0].full_name, item[0].id))
+    return ranked[:limit]
+
+# ============ 回填 ============
+
+def reindex_search_names(batch_size: int = 1000, log=print) -> int:
+    """
+    重新计算所有患者的search_name/name_keys（规范化规则变化后运行）
+    """
+    table = Patient.__table__
+    statement = table.update()\
+        .where(table.c.id == db.bindparam('row_id'))\
+        .values(search_name=db.bindparam('normalized'), name_keys=db.bindparam('keys'))
+
+    last_id, done = 0, 0
+    while True:
+        rows = db.session.execute(
+            select(table.c.id, table.c.full_name)
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return done
+
+        params = []
+        for row_id, full_name in rows:
+            normalized = normalize_name(full_name)
+            params.append({'row_id': row_id, 'normalized': normalized, 'keys': name_keys(normalized)})
+        db.session.execute(statement, params)
+        db.session.commit()
+
+        last_id, done = rows[-1][0], done + len(rows)
+        log(f"Reindexed {done} patients")
@@ -0,0 +1,95 @@
+"""
+staff看板读接口的响应缓存
+
+- 每个接口一个有界LRU缓存（TTLCache），命中率在/api/auth/cache-stats里按接口分开统计
+- key = (数据版本, 角色, 查询参数)；Patient/Visit/Insurance有写入并提交后版本号加一，
+  旧版本的条目不再被命中，随后被LRU淘汰
+- 版本号是进程内的，其他worker进程的写入只能靠TTL兜底（RESPONSE_CACHE_TTL）
+- 序列化后超过RESPONSE_CACHE_MAX_ENTRY_BYTES的结果不缓存，总内存 <= 条目数上限 × 单条上限
+"""
+from flask import current_app, request, g
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+from models import Patient, Visit, Insurance
+from services.cache import TTLCache
+import threading
+
+patient_list_cache = TTLCache('response:patient_list', max_size=256, ttl=30)
+recent_visits_cache = TTLCache('response:recent_visits', max_size=256, ttl=30)
+symptom_search_cache = TTLCache('response:symptom_search', max_size=256, ttl=30)
+
+_WATCHED_MODELS = (Patient, Visit, Insurance)
+_WATCHED_TABLES = {model.__table__.name for model in _WATCHED_MODELS}
+
+_version = 0
+_version_lock = threading.Lock()
+_max_entry_bytes = 256 * 1024
+
+def init_response_cache(app):
+    """
+    根据配置调整缓存大小和TTL
+    """
+    global _max_entry_bytes
+    for cache in (patient_list_cache, recent_visits_cache, symptom_search_cache):
+        cache.configure(
+            max_size=app.config['RESPONSE_CACHE_MAX_SIZE'],
+            ttl=app.config['RESPONSE_CACHE_TTL']
+        )
+    _max_entry_bytes = app.config['RESPONSE_CACHE_MAX_ENTRY_BYTES']
+
+def data_version() -> int:
+    return _version
+
+def bump_version():
+    """
+    使所有已缓存的响应失效
+    """
+    global _version
+    with _version_lock:
+        _version += 1
+
+def cached_result(cache: TTLCache, build):
+    """
+    按(数据版本, 角色, 查询参数)缓存build()的结果（可JSON序列化的dict）
+    版本号在查询之前读取，查询期间提交的写入不会被当成新数据缓存
+    """
+    key = (data_version(), g.user_role, tuple(sorted(request.args.items(multi=True))))
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    result = build()
+    if len(current_app.json.dumps(result)) <= _max_entry_bytes:
+        cache.set(key, result)
+    return result
+
+# ============ 自动失效 ============
+# 只在提交后加版本号：提交前其他请求读到的仍是旧数据，缓存在旧版本下没有问题
+
+def _mark_changed(session):
+    session.info['response_cache_stale'] = True
+
+@event.listens_for(OrmSession, 'after_flush')
+def _check_flush(session, flush_context):
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instance, _WATCHED_MODELS):
+            _mark_changed(session)
+            return
+
+@event.listens_for(OrmSession, 'do_orm_execute')
+def _check_bulk_statement(orm_execute_state):
+    # session.execute(update(...)/delete(...)/insert(...))不经过flush
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return
+    table = getattr(orm_execute_state.statement, 'table', None)
+    if table is not None and table.name in _WATCHED_TABLES:
+        _mark_changed(orm_execute_state.session)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _bump_after_commit(session):
+    if session.info.pop('response_cache_stale', False):
+        bump_version()
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('response_cache_stale', None)
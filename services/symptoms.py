@@ -0,0 +1,141 @@
+"""
+症状检索和统计（Visit.symptoms / possible_causes，JSONB字符串数组）
+
+- 检索：lower(列::text)::jsonb @> '["chest pain"]'，
+  由表达式GIN索引（jsonb_path_ops）支持，不区分大小写，也不修改原始数据
+- 统计：在数据库里展开数组、按时间桶和症状分组计数，每个桶只返回前N个
+- 统计结果按时间桶缓存：已经结束的桶缓存SYMPTOM_STATS_CACHE_TTL，
+  当前还没结束的桶每次都重新计算
+"""
+from sqlalchemy import select, func, case, cast, literal_column, tuple_, Text
+from sqlalchemy.dialects.postgresql import JSONB
+from models import db, Visit, Patient
+from services.cache import TTLCache
+from datetime import datetime, timedelta
+
+FIELDS = ('symptoms', 'possible_causes')
+BUCKETS = ('day', 'week')
+
+symptom_stats_cache = TTLCache('symptom_stats', max_size=4096, ttl=3600)
+_visits = Visit.__table__
+
+def init_symptom_cache(app):
+    symptom_stats_cache.configure(
+        max_size=app.config['SYMPTOM_STATS_CACHE_SIZE'],
+        ttl=app.config['SYMPTOM_STATS_CACHE_TTL']
+    )
+
+def normalize_terms(terms: list) -> list:
+    return list(dict.fromkeys(term.strip().lower() for term in terms if term and term.strip()))
+
+def lowered(field: str):
+    """
+    和索引表达式完全一致，规划器才会使用表达式索引
+    """
+    return cast(func.lower(cast(_visits.c[field], Text)), JSONB)
+
+# ============ 检索 ============
+
+def search_visits(terms: list, field: str = 'symptoms', since: datetime = None, until: datetime = None,
+                  after: tuple = None, limit: int = 20) -> list:
+    """
+    包含全部terms的就诊记录，按(visit_date, id)倒序，返回limit + 1行（用于判断是否还有下一页）
+    """
+    query = select(
+        _visits.c.id, _visits.c.patient_id, Patient.full_name, _visits.c.visit_date,
+        _visits.c.visit_reason, _visits.c.symptoms, _visits.c.possible_causes, _visits.c.status
+    ).join(Patient, Patient.id == _visits.c.patient_id)\
+        .where(lowered(field).op('@>')(func.jsonb_build_array(*normalize_terms(terms))))
+    if since is not None:
+        query = query.where(_visits.c.visit_date >= since)
+    if until is not None:
+        query = query.where(_visits.c.visit_date < until)
+    if after:
+        query = query.where(tuple_(_visits.c.visit_date, _visits.c.id) < tuple_(*after))
+    return db.session.execute(
+        query.order_by(_visits.c.visit_date.desc(), _visits.c.id.desc()).limit(limit + 1)
+    ).all()
+
+# ============ 统计 ============
+
+def bucket_starts(since: datetime, until: datetime, bucket: str) -> list:
+    """
+    [since, until)范围内各时间桶的开始时间（UTC，周从周一开始，和date_trunc一致）
+    """
+    start = datetime(since.year, since.month, since.day)
+    step = timedelta(days=1)
+    if bucket == 'week':
+        start -= timedelta(days=start.weekday())
+        step = timedelta(days=7)
+    starts = []
+    while start < until:
+        starts.append(start)
+        start += step
+    return starts
+
+def _top_in_range(field: str, bucket: str, start: datetime, end: datetime, limit: int) -> dict:
+    """
+    一次查询计算[start, end)内每个桶的前limit个症状
+    """
+    values = case(
+        (func.jsonb_typeof(_visits.c[field]) == 'array', _visits.c[field]),
+        else_=literal_column("'[]'::jsonb")
+    )
+    element = func.jsonb_array_elements_text(values).table_valued('value').lateral('element')
+    bucket_start = func.date_trunc(bucket, _visits.c.visit_date)
+    symptom = func.lower(func.btrim(element.c.value))
+
+    counts = select(
+        bucket_start.label('bucket'),
+        symptom.label('symptom'),
+        func.count(func.distinct(_visits.c.id)).label('visits')
+    ).select_from(_visits).join(element, literal_column('true'))\
+        .where(_visits.c.visit_date >= start, _visits.c.visit_date < end)\
+        .group_by(bucket_start, symptom)\
+        .subquery()
+    ranked = select(
+        counts,
+        func.row_number().over(
+            partition_by=counts.c.bucket,
+            order_by=(counts.c.visits.desc(), counts.c.symptom)
+        ).label('rank')
+    ).subquery()
+    rows = db.session.execute(
+        select(ranked.c.bucket, ranked.c.symptom, ranked.c.visits)
+        .where(ranked.c.rank <= limit)
+        .order_by(ranked.c.bucket, ranked.c.rank)
+    ).all()
+
+    result = {}
+    for row in rows:
+        result.setdefault(row.bucket, []).append({'symptom': row.symptom, 'visits': row.visits})
+    return result
+
+def top_symptoms(since: datetime, until: datetime, field: str = 'symptoms', bucket: str = 'day',
+                 limit: int = 20, now: datetime = None) -> list:
+    """
+    每个时间桶里出现在最多就诊记录中的前limit个症状
+    since/until按桶的边界取整，每个桶都是完整的一天/一周
+    返回 [{'bucket': 开始时间, 'symptoms': [{'symptom', 'visits'}]}]
+    """
+    now = now or datetime.utcnow()
+    step = timedelta(days=7 if bucket == 'week' else 1)
+    starts = bucket_starts(since, until, bucket)
+
+    results, missing = {}, []
+    for start in starts:
+        cached = symptom_stats_cache.get((field, bucket, limit, start))
+        if cached is None:
+            missing.append(start)
+        else:
+            results[start] = cached
+
+    if missing:
+        # 缺少的桶一次查询算完（从第一个缺少的桶到最后一个）
+        computed = _top_in_range(field, bucket, missing[0], missing[-1] + step, limit)
+        for start in missing:
+            results[start] = computed.get(start, [])
+            if start + step <= now:
+                symptom_stats_cache.set((field, bucket, limit, start), results[start])
+
+    return [{'bucket': start, 'symptoms': results[start]} for start in starts]
@@ -0,0 +1,80 @@
+"""
+语音转录缓存（transcriptions表）
+
+- key = (音频内容的SHA-256, 转录设置的指纹)，终端重传同一段录音时直接返回已有的转录，不再调用AssemblyAI
+- 哈希在保存上传文件时边写边算，不需要再读一遍文件
+- 读写都用独立的短事务，不依赖调用方的会话（后台任务在事务之外调用）
+- 按最后使用时间清理（`flask audio-jobs prune-transcriptions`）
+"""
+from sqlalchemy import update, delete
+from sqlalchemy.dialects.postgresql import insert
+from models import db, Transcription
+from datetime import datetime, timedelta
+import hashlib
+import json
+
+CHUNK_SIZE = 64 * 1024
+_transcriptions = Transcription.__table__
+
+def save_and_hash(stream, path: str) -> tuple:
+    """
+    把上传的文件流写到path，同时计算SHA-256
+    返回 (十六进制哈希, 字节数)
+    """
+    digest, size = hashlib.sha256(), 0
+    with open(path, 'wb') as f:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+            f.write(chunk)
+    return digest.hexdigest(), size
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def settings_fingerprint(settings: dict) -> str:
+    """
+    转录设置（服务商、语言等）的指纹，设置变化后旧的缓存不再命中
+    """
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+def get_cached(content_hash: str, fingerprint: str):
+    """
+    命中时返回转录文本（同时更新最后使用时间），否则返回None
+    """
+    with db.engine.begin() as connection:
+        return connection.execute(
+            update(_transcriptions)
+            .where(_transcriptions.c.content_hash == content_hash, _transcriptions.c.settings_hash == fingerprint)
+            .values(last_used_at=datetime.utcnow(), hits=_transcriptions.c.hits + 1)
+            .returning(_transcriptions.c.text)
+        ).scalar()
+
+def store(content_hash: str, fingerprint: str, text: str, audio_bytes: int = None):
+    """
+    保存转录结果；并发转录同一段录音时保留先写入的
+    """
+    now = datetime.utcnow()
+    with db.engine.begin() as connection:
+        connection.execute(
+            insert(_transcriptions)
+            .values(content_hash=content_hash, settings_hash=fingerprint, text=text,
+                    audio_bytes=audio_bytes, hits=0, created_at=now, last_used_at=now)
+            .on_conflict_do_nothing()
+        )
+
+def prune_transcriptions(retain_days: int) -> int:
+    """
+    删除超过retain_days没有使用的缓存，返回删除的行数
+    """
+    cutoff = datetime.utcnow() - timedelta(days=retain_days)
+    result = db.session.execute(delete(Transcription).where(Transcription.last_used_at < cutoff))
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,53 @@
+"""
+分诊队列：等待就诊的患者按疼痛程度（高的在前）和等待时间（早的在前）排序
+
+- 队列就是visits上的部分索引 ix_visits_triage_queue
+  (pain_level DESC NULLS LAST, visit_date, id) WHERE status IN ('pending', 'confirmed')，
+  状态变化时由Postgres维护索引（O(log n)），取前K个是一次索引扫描，不需要排序
+- 查询条件必须和索引的WHERE完全一致，规划器才会使用部分索引
+"""
+from sqlalchemy import select, func, or_, and_
+from models import db, Visit, Patient
+
+# 仍在等待的状态：pending（自助登记中）、confirmed（患者已确认）
+QUEUED_STATUSES = ('pending', 'confirmed')
+
+def _queued():
+    return Visit.status.in_(QUEUED_STATUSES)
+
+def _queue_order():
+    return Visit.pain_level.desc().nulls_last(), Visit.visit_date, Visit.id
+
+def top_of_queue(limit: int) -> list:
+    """
+    队列前limit个就诊记录（附带患者姓名）
+    """
+    return db.session.execute(
+        select(Visit.id, Visit.patient_id, Patient.full_name, Visit.pain_level, Visit.pain_duration,
+               Visit.visit_reason, Visit.visit_date, Visit.status)
+        .join(Patient, Patient.id == Visit.patient_id)
+        .where(_queued())
+        .order_by(*_queue_order())
+        .limit(limit)
+    ).all()
+
+def queue_length() -> int:
+    return db.session.execute(select(func.count()).select_from(Visit).where(_queued())).scalar()
+
+def queue_position(visit: Visit) -> int:
+    """
+    就诊记录在队列中的位置（从1开始），不在队列中时返回None
+    只数排在它前面的条目（索引范围扫描）
+    """
+    if visit.status not in QUEUED_STATUSES:
+        return None
+
+    earlier = db.tuple_(Visit.visit_date, Visit.id) < db.tuple_(visit.visit_date, visit.id)
+    if visit.pain_level is None:
+        # 没有疼痛评分的排在最后
+        ahead = or_(Visit.pain_level.isnot(None), and_(Visit.pain_level.is_(None), earlier))
+    else:
+        ahead = or_(Visit.pain_level > visit.pain_level, and_(Visit.pain_level == visit.pain_level, earlier))
+    return db.session.execute(
+        select(func.count()).select_from(Visit).where(_queued(), ahead)
+    ).scalar() + 1
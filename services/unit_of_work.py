@@ -0,0 +1,55 @@
+from flask import has_request_context, jsonify
+from models import db
+
+# 请求级unit-of-work：
+# 请求内的helper只暂存（add/flush），请求结束时统一提交一次，
+# 审计日志和业务数据在同一个事务里。请求外（脚本、CLI、测试）立即提交。
+
+# 异步审计模式下等待提交的审计记录（security/audit.py）
+PENDING_AUDIT_KEY = 'pending_audit_rows'
+
+def stage(*objects):
+    """
+    暂存对象，等待请求结束时提交
+    """
+    db.session.add_all(objects)
+    if not has_request_context():
+        db.session.commit()
+
+def commit_now():
+    """
+    立即提交（逃生通道）
+    只用于确实需要在请求结束前落盘的代码路径
+    """
+    db.session.commit()
+
+def init_unit_of_work(app):
+    """
+    注册请求结束时的提交/回滚钩子
+    """
+    @app.after_request
+    def _commit_unit_of_work(response):
+        session = db.session()
+        if not session.in_transaction() and not session.info.get(PENDING_AUDIT_KEY):
+            return response
+
+        # 错误响应不提交暂存的修改
+        if response.status_code >= 400:
+            db.session.rollback()
+            session.info.pop(PENDING_AUDIT_KEY, None)
+            return response
+
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Unit of work commit failed: {e}")
+            error_response = jsonify({'error': 'Internal server error'})
+            error_response.status_code = 500
+            return error_response
+        return response
+
+    @app.teardown_request
+    def _rollback_unit_of_work(exc):
+        if exc is not None:
+            db.session.rollback()
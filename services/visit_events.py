@@ -0,0 +1,264 @@
+"""
+就诊记录变更推送（staff看板的SSE）
+
+写入:
+- Visit插入、status变化时，在同一个flush里写一条visit_events，并pg_notify('visit_events')；
+  通知在提交后才送达，回滚的写入不会产生事件
+
+读取:
+- 每个进程一个后台线程（VisitEventBroadcaster）LISTEN，收到通知后查一次新事件，
+  放进内存环形缓冲区，再唤醒所有SSE连接；连接数再多，每次变更也只查一次库
+- 事件按(txid, id)排序，只读取txid小于当前快照xmin（已结束事务）的事件，
+  先分配id、后提交的事件不会被跳过
+- 事件位置"txid-id"就是SSE的id；断线重连带上Last-Event-ID，
+  缓冲区里还有的直接补发，更早的从表里补读，超过上限时发reset让客户端重新加载
+"""
+from sqlalchemy import event, select, insert, delete, func, tuple_, literal_column
+from models import db, Visit, Patient, VisitEvent
+from collections import deque
+from datetime import datetime, timedelta
+import atexit
+import json
+import logging
+import select as select_module
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'visit_events'
+# 当前快照里最早的未结束事务id，txid小于它的事务都已结束
+_WATERMARK = literal_column('(pg_snapshot_xmin(pg_current_snapshot())::text)::bigint')
+
+def format_position(position: tuple) -> str:
+    return f'{position[0]}-{position[1]}'
+
+def parse_position(value: str) -> tuple:
+    """
+    解析Last-Event-ID，格式不对时抛出ValueError
+    """
+    try:
+        txid, event_id = value.split('-')
+        return int(txid), int(event_id)
+    except (AttributeError, ValueError):
+        raise ValueError('Invalid Last-Event-ID')
+
+# ============ 写入 ============
+
+def record_visit_events(connection, rows: list):
+    """
+    写入事件并通知监听者（和就诊记录的修改在同一个事务里）
+    rows: [{'visit_id', 'patient_id', 'event', 'status'}]
+    批量UPDATE等不经过ORM flush的写入路径直接调用
+    """
+    if not rows:
+        return
+    now = datetime.utcnow()
+    connection.execute(insert(VisitEvent.__table__), [dict(row, created_at=now) for row in rows])
+    connection.execute(select(func.pg_notify(CHANNEL, '')))
+
+@event.listens_for(Visit, 'after_insert')
+def _visit_created(mapper, connection, target):
+    record_visit_events(connection, [{
+        'visit_id': target.id, 'patient_id': target.patient_id, 'event': 'created', 'status': target.status
+    }])
+
+@event.listens_for(Visit, 'after_update')
+def _visit_updated(mapper, connection, target):
+    if db.inspect(target).attrs.status.history.has_changes():
+        record_visit_events(connection, [{
+            'visit_id': target.id, 'patient_id': target.patient_id, 'event': 'status_changed', 'status': target.status
+        }])
+
+# ============ 读取 ============
+
+def fetch_events(connection, after: tuple, limit: int) -> tuple:
+    """
+    读取after之后、已结束事务写入的事件（附带就诊记录当前的内容）
+    返回 (events, more)，more表示还有事件（未到水位线或超过limit）
+    """
+    events_table, visits, patients = VisitEvent.__table__, Visit.__table__, Patient.__table__
+    rows = connection.execute(
+        select(
+            events_table.c.id, events_table.c.txid, events_table.c.event, events_table.c.status,
+            events_table.c.visit_id, events_table.c.patient_id, events_table.c.created_at,
+            visits.c.visit_date, visits.c.visit_reason, visits.c.symptoms, visits.c.pain_level,
+            patients.c.full_name, _WATERMARK.label('watermark')
+        )
+        .select_from(events_table)
+        .outerjoin(visits, visits.c.id == events_table.c.visit_id)
+        .outerjoin(patients, patients.c.id == events_table.c.patient_id)
+        .where(tuple_(events_table.c.txid, events_table.c.id) > tuple_(*after))
+        .order_by(events_table.c.txid, events_table.c.id)
+        .limit(limit + 1)
+    ).all()
+
+    events = []
+    for row in rows[:limit]:
+        if row.txid >= row.watermark:
+            # 写入它的事务（或更早的事务）还没结束，下次再读
+            return events, True
+        events.append(((row.txid, row.id), json.dumps({
+            'event': row.event,
+            'status': row.status,
+            'visit': {
+                'id': row.visit_id,
+                'patient_id': row.patient_id,
+                'patient_name': row.full_name,
+                'visit_date': row.visit_date.isoformat() if row.visit_date else None,
+                'visit_reason': row.visit_reason,
+                'symptoms': row.symptoms,
+                'pain_level': row.pain_level
+            },
+            'created_at': row.created_at.isoformat()
+        })))
+    return events, len(rows) > limit
+
+def current_position(connection) -> tuple:
+    """
+    当前位置：所有已结束事务的事件都在它之前
+    """
+    watermark = connection.execute(select(_WATERMARK)).scalar()
+    return watermark - 1, 2 ** 62
+
+class VisitEventBroadcaster:
+    """
+    进程内的事件广播
+    - 后台线程LISTEN，收到通知（或有未到水位线的事件时短间隔轮询）后读取新事件
+    - 最近的事件保存在环形缓冲区，SSE连接从缓冲区按位置读取
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._events = deque()
+        self._stopping = False
+
+    def start(self, app):
+        """
+        启动监听线程（第一个订阅者连接时调用，保证在gunicorn fork之后）
+        """
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._app = app
+            self.buffer_size = app.config['VISIT_EVENTS_BUFFER']
+            self.poll_interval = app.config['VISIT_EVENTS_POLL_INTERVAL']
+            with app.app_context(), db.engine.connect() as connection:
+                # 缓冲区之前的位置，更早的事件需要从表里读
+                self.floor = self.position = current_position(connection)
+            self._events.clear()
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='visit-events', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._thread.join()
+        self._thread = None
+
+    def wait_for_events(self, after: tuple, timeout: float) -> list:
+        """
+        返回缓冲区里after之后的事件，没有时最多等待timeout秒
+        after早于缓冲区时由调用方先从表里补读
+        """
+        with self._condition:
+            if self.position <= after:
+                self._condition.wait(timeout)
+            return [item for item in self._events if item[0] > after]
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception('Visit event listener failed, reconnecting')
+                time.sleep(1)
+
+    def _listen(self):
+        with self._app.app_context():
+            raw = db.engine.raw_connection()
+        # 专用连接，不还给连接池
+        connection = raw.driver_connection
+        raw.detach()
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+            more = True  # 连接（重连）后先读一次，补上断开期间的事件
+            while not self._stopping:
+                if not more:
+                    # 只在有新通知时读库；最多等poll_interval检查一次是否要退出
+                    if select_module.select([connection], [], [], self.poll_interval) == ([], [], []):
+                        continue
+                connection.poll()
+                connection.notifies.clear()
+                more = self._read_new_events()
+                if more:
+                    time.sleep(0.1)
+        finally:
+            connection.close()
+
+    def _read_new_events(self) -> bool:
+        with self._app.app_context(), db.engine.connect() as connection:
+            events, more = fetch_events(connection, self.position, self.buffer_size)
+        if events:
+            with self._condition:
+                self._events.extend(events)
+                while len(self._events) > self.buffer_size:
+                    self.floor = self._events.popleft()[0]
+                self.position = events[-1][0]
+                self._condition.notify_all()
+        return more
+
+broadcaster = VisitEventBroadcaster()
+
+def stream_events(app, after: tuple = None, max_seconds: float = None):
+    """
+    SSE消息的生成器
+    after: 客户端最后收到的位置（Last-Event-ID），None表示只接收新事件
+    """
+    broadcaster.start(app)
+    heartbeat = app.config['VISIT_EVENTS_HEARTBEAT']
+    resume_max = app.config['VISIT_EVENTS_RESUME_MAX']
+    deadline = time.monotonic() + (max_seconds or app.config['VISIT_EVENTS_STREAM_SECONDS'])
+
+    position = broadcaster.position if after is None else after
+    yield f"retry: {app.config['VISIT_EVENTS_RETRY_MS']}\n\n"
+
+    if position < broadcaster.floor:
+        # 缓冲区之前的事件从表里补读（短连接，不长时间占用快照）
+        with app.app_context(), db.engine.connect() as connection:
+            missed, more = fetch_events(connection, position, resume_max)
+        if more and len(missed) >= resume_max:
+            # 错过的太多，让客户端重新加载列表
+            position = broadcaster.position
+            yield f"id: {format_position(position)}\nevent: reset\ndata: {{}}\n\n"
+        else:
+            for event_position, data in missed:
+                position = event_position
+                yield f"id: {format_position(position)}\ndata: {data}\n\n"
+
+    while time.monotonic() < deadline:
+        events = broadcaster.wait_for_events(position, min(heartbeat, max(0, deadline - time.monotonic())))
+        if not events:
+            yield ': keepalive\n\n'
+            continue
+        for event_position, data in events:
+            position = event_position
+            yield f"id: {format_position(position)}\ndata: {data}\n\n"
+
+# ============ 清理 ============
+
+def prune_events(retain_days: int) -> int:
+    """
+    删除超过保留期的事件，返回删除的行数
+    """
+    cutoff = datetime.utcnow() - timedelta(days=retain_days)
+    result = db.session.execute(delete(VisitEvent).where(VisitEvent.created_at < cutoff))
+    db.session.commit()
+    return result.rowcount
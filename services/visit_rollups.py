@@ -0,0 +1,243 @@
+"""
+就诊统计的每日汇总表（visit_daily_counts / visit_daily_waits）
+
+- Visit的插入、修改（状态、疼痛评分、持续时间、visit_date、confirmed_at）、删除时，
+  在同一个flush里算出旧值和新值对汇总行的增减，合并后一条UPSERT写入，和就诊记录一起提交
+- 批量修改状态（services/visit_status.py）不经过ORM，直接调用apply_rollup_changes
+- 报表只读汇总表，行数只和天数有关，与就诊记录数无关
+- `flask visits rebuild-rollups`按天重算（锁住汇总表，期间的写入等重算提交后再累加）
+"""
+from sqlalchemy import event, select, delete, func, case, cast, literal_column, Date, BigInteger
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session as OrmSession, object_session
+from models import db, Visit, VisitDailyCount, VisitDailyWait
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+# 疼痛评估页面的选项，其他值归为other
+DURATIONS = ('hours', 'day', 'days', 'weeks', 'months')
+# 影响汇总行的列
+ROLLUP_COLUMNS = ('visit_date', 'status', 'pain_level', 'pain_duration', 'confirmed_at')
+
+_visits, _counts, _waits = Visit.__table__, VisitDailyCount.__table__, VisitDailyWait.__table__
+
+def duration_bucket(value):
+    if value is None:
+        return None
+    return value if value in DURATIONS else 'other'
+
+def wait_seconds(visit_date, confirmed_at):
+    """
+    从到达到确认的秒数（向零取整，和重算时的SQL一致）
+    """
+    if visit_date is None or confirmed_at is None:
+        return None
+    return int((confirmed_at - visit_date).total_seconds())
+
+# ============ 增量维护 ============
+
+def _new_deltas():
+    # (按(day, status, pain_level, duration)的就诊数, {day: [确认数, 等待秒数]})
+    return Counter(), {}
+
+def _add(deltas, values: dict, sign: int):
+    """
+    把一条就诊记录（ROLLUP_COLUMNS的值）计入（sign=1）或移出（sign=-1）汇总
+    """
+    if values is None or values['visit_date'] is None:
+        return
+    counts, waits = deltas
+    day = values['visit_date'].date()
+    counts[(day, values['status'], values['pain_level'], duration_bucket(values['pain_duration']))] += sign
+    wait = wait_seconds(values['visit_date'], values['confirmed_at'])
+    if wait is not None:
+        entry = waits.setdefault(day, [0, 0])
+        entry[0] += sign
+        entry[1] += sign * wait
+
+def _sort_key(key):
+    # 按固定顺序写入汇总行，并发事务不会互相死锁（None排在最后）
+    return tuple((value is None, value) for value in key)
+
+def apply_deltas(connection, deltas):
+    counts, waits = deltas
+    rows = [
+        {'day': key[0], 'status': key[1], 'pain_level': key[2], 'duration': key[3], 'visits': change}
+        for key, change in sorted(counts.items(), key=lambda item: _sort_key(item[0])) if change
+    ]
+    if rows:
+        statement = insert(_counts).values(rows)
+        connection.execute(statement.on_conflict_do_update(
+            constraint='uq_visit_daily_counts_key',
+            set_={'visits': _counts.c.visits + statement.excluded.visits}
+        ))
+
+    rows = [
+        {'day': day, 'confirmed': confirmed, 'wait_seconds': seconds}
+        for day, (confirmed, seconds) in sorted(waits.items()) if confirmed or seconds
+    ]
+    if rows:
+        statement = insert(_waits).values(rows)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[_waits.c.day],
+            set_={
+                'confirmed': _waits.c.confirmed + statement.excluded.confirmed,
+                'wait_seconds': _waits.c.wait_seconds + statement.excluded.wait_seconds
+            }
+        ))
+
+def apply_rollup_changes(connection, changes: list):
+    """
+    changes: [(旧值, 新值)]，值是ROLLUP_COLUMNS的dict，插入时旧值为None、删除时新值为None
+    """
+    deltas = _new_deltas()
+    for old, new in changes:
+        _add(deltas, old, -1)
+        _add(deltas, new, 1)
+    apply_deltas(connection, deltas)
+
+def _current(target) -> dict:
+    return {name: getattr(target, name) for name in ROLLUP_COLUMNS}
+
+def _previous(target) -> dict:
+    # 本次flush之前的值（旧值在赋值时已加载，见下面的active_history）
+    state = db.inspect(target)
+    values = {}
+    for name in ROLLUP_COLUMNS:
+        history = state.attrs[name].history
+        values[name] = history.deleted[0] if history.deleted else getattr(target, name)
+    return values
+
+def _stage(target, old, new):
+    deltas = object_session(target).info.setdefault('visit_rollup_deltas', _new_deltas())
+    _add(deltas, old, -1)
+    _add(deltas, new, 1)
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    return value
+
+for _name in ROLLUP_COLUMNS:
+    # 赋值前先加载没加载的旧值（例如批量修改后被expire的status），增量才能减掉旧的汇总行
+    event.listen(getattr(Visit, _name), 'set', _keep_old_value, active_history=True, retval=True)
+
+@event.listens_for(Visit.status, 'set')
+def _stamp_confirmed(target, value, oldvalue, initiator):
+    if value == 'confirmed' and target.confirmed_at is None:
+        target.confirmed_at = datetime.utcnow()
+
+@event.listens_for(Visit, 'after_insert')
+def _visit_inserted(mapper, connection, target):
+    _stage(target, None, _current(target))
+
+@event.listens_for(Visit, 'after_update')
+def _visit_updated(mapper, connection, target):
+    old, new = _previous(target), _current(target)
+    if old != new:
+        _stage(target, old, new)
+
+@event.listens_for(Visit, 'after_delete')
+def _visit_deleted(mapper, connection, target):
+    _stage(target, _previous(target), None)
+
+@event.listens_for(OrmSession, 'after_flush')
+def _apply_staged(session, flush_context):
+    deltas = session.info.pop('visit_rollup_deltas', None)
+    if deltas is not None:
+        apply_deltas(session.connection(), deltas)
+
+# ============ 重算 ============
+
+def _rollup_selects(start: date, end: date):
+    """
+    按visits重算[start, end)的汇总行（和增量维护的取值规则一致）
+    """
+    day = cast(_visits.c.visit_date, Date)
+    duration = case(
+        (_visits.c.pain_duration.is_(None), None),
+        (_visits.c.pain_duration.in_(DURATIONS), _visits.c.pain_duration),
+        else_=literal_column("'other'")
+    )
+    in_range = (_visits.c.visit_date >= datetime.combine(start, datetime.min.time()),
+                _visits.c.visit_date < datetime.combine(end, datetime.min.time()))
+    counts = select(day, _visits.c.status, _visits.c.pain_level, duration, func.count())\
+        .where(*in_range)\
+        .group_by(day, _visits.c.status, _visits.c.pain_level, duration)
+
+    seconds = cast(func.trunc(func.extract('epoch', _visits.c.confirmed_at - _visits.c.visit_date)), BigInteger)
+    waits = select(day, func.count(), func.sum(seconds))\
+        .where(*in_range, _visits.c.confirmed_at.isnot(None))\
+        .group_by(day)
+    return counts, waits
+
+def rebuild_rollups(since: date = None, until: date = None, batch_days: int = 31, log=print) -> int:
+    """
+    重算[since, until)每天的汇总行，默认覆盖所有有就诊或汇总的日期
+    每batch_days天一个事务，返回重算的天数
+    """
+    if since is None or until is None:
+        first, last = db.session.execute(
+            select(func.min(cast(_visits.c.visit_date, Date)), func.max(cast(_visits.c.visit_date, Date)))
+        ).one()
+        first_rollup, last_rollup = db.session.execute(select(func.min(_counts.c.day), func.max(_counts.c.day))).one()
+        days = [value for value in (first, last, first_rollup, last_rollup) if value is not None]
+        if not days:
+            return 0
+        since = since or min(days)
+        until = until or max(days) + timedelta(days=1)
+
+    done = 0
+    start = since
+    while start < until:
+        end = min(start + timedelta(days=batch_days), until)
+        # 写入方在提交前一直持有汇总表的ROW EXCLUSIVE锁：等它们提交后再读visits，
+        # 重算期间新来的写入等重算提交后再把增量加上去
+        db.session.execute(db.text('LOCK TABLE visit_daily_counts, visit_daily_waits IN EXCLUSIVE MODE'))
+        db.session.execute(delete(_counts).where(_counts.c.day >= start, _counts.c.day < end))
+        db.session.execute(delete(_waits).where(_waits.c.day >= start, _waits.c.day < end))
+        counts, waits = _rollup_selects(start, end)
+        db.session.execute(insert(_counts).from_select(['day', 'status', 'pain_level', 'duration', 'visits'], counts))
+        db.session.execute(insert(_waits).from_select(['day', 'confirmed', 'wait_seconds'], waits))
+        db.session.commit()
+
+        done += (end - start).days
+        start = end
+        log(f"Rebuilt {done} day(s)")
+    return done
+
+# ============ 读取 ============
+
+def daily_stats(start: date, end: date) -> list:
+    """
+    [start, end)每天的统计，只读汇总表
+    没有就诊的日期也返回（全为0），未填写的疼痛评分/持续时间记为unknown
+    """
+    days = {}
+    day = start
+    while day < end:
+        days[day] = {
+            'day': day.isoformat(), 'visits': 0,
+            'by_status': {}, 'by_pain_level': {}, 'by_duration': {},
+            'confirmed': 0, 'avg_wait_minutes': None
+        }
+        day += timedelta(days=1)
+
+    rows = db.session.execute(
+        select(_counts.c.day, _counts.c.status, _counts.c.pain_level, _counts.c.duration, _counts.c.visits)
+        .where(_counts.c.day >= start, _counts.c.day < end, _counts.c.visits != 0)
+    ).all()
+    for row in rows:
+        item = days[row.day]
+        item['visits'] += row.visits
+        for name, value in (('by_status', row.status), ('by_pain_level', row.pain_level), ('by_duration', row.duration)):
+            key = 'unknown' if value is None else str(value)
+            item[name][key] = item[name].get(key, 0) + row.visits
+
+    rows = db.session.execute(
+        select(_waits).where(_waits.c.day >= start, _waits.c.day < end, _waits.c.confirmed > 0)
+    ).all()
+    for row in rows:
+        item = days[row.day]
+        item['confirmed'] = row.confirmed
+        item['avg_wait_minutes'] = round(row.wait_seconds / row.confirmed / 60, 1)
+
+    return list(days.values())
@@ -0,0 +1,84 @@
+"""
+就诊状态流转
+
+pending -> confirmed / completed / cancelled
+confirmed -> completed / cancelled
+completed、cancelled是终态
+"""
+from sqlalchemy import select, update, func
+from models import db, Visit
+from services.visit_events import record_visit_events
+from services.visit_rollups import apply_rollup_changes
+from datetime import datetime
+
+TRANSITIONS = {
+    'pending': ('confirmed', 'completed', 'cancelled'),
+    'confirmed': ('completed', 'cancelled'),
+    'completed': (),
+    'cancelled': (),
+}
+
+def allowed_from(status: str) -> list:
+    """
+    可以流转到status的原状态
+    """
+    return [source for source, targets in TRANSITIONS.items() if status in targets]
+
+# 批量修改时可以指定的目标状态（没有任何原状态能流转到pending）
+TARGET_STATUSES = tuple(status for status in TRANSITIONS if allowed_from(status))
+
+def bulk_transition(visit_ids: list, status: str) -> tuple:
+    """
+    一条UPDATE ... RETURNING把一批就诊改为status，原状态不允许流转的跳过
+    改为confirmed时记下第一次确认的时间，同时更新每日汇总
+    返回 (updated, skipped)
+        updated: [{'id', 'patient_id', 'from'}]
+        skipped: [{'id', 'status'}]，status为None表示就诊记录不存在
+    """
+    visits = Visit.__table__
+    # 先锁定并记下原来的值，UPDATE ... FROM 里返回
+    current = select(visits.c.id, visits.c.status.label('old_status'), visits.c.confirmed_at.label('old_confirmed_at'))\
+        .where(visits.c.id.in_(visit_ids), visits.c.status.in_(allowed_from(status)))\
+        .with_for_update()\
+        .subquery()
+    values = {'status': status}
+    if status == 'confirmed':
+        values['confirmed_at'] = func.coalesce(visits.c.confirmed_at, datetime.utcnow())
+    rows = db.session.execute(
+        update(visits)
+        .where(visits.c.id == current.c.id)
+        .values(**values)
+        .returning(visits.c.id, visits.c.patient_id, visits.c.visit_date, visits.c.pain_level,
+                   visits.c.pain_duration, visits.c.confirmed_at, current.c.old_status, current.c.old_confirmed_at)
+    ).all()
+
+    # 会话里已加载的Visit对象重新读取status
+    mapper = db.inspect(Visit)
+    for row in rows:
+        visit = db.session.identity_map.get(mapper.identity_key_from_primary_key([row.id]))
+        if visit is not None:
+            db.session.expire(visit, ['status', 'confirmed_at'])
+
+    record_visit_events(db.session.connection(), [
+        {'visit_id': row.id, 'patient_id': row.patient_id, 'event': 'status_changed', 'status': status}
+        for row in rows
+    ])
+    apply_rollup_changes(db.session.connection(), [
+        (
+            {'visit_date': row.visit_date, 'status': row.old_status, 'pain_level': row.pain_level,
+             'pain_duration': row.pain_duration, 'confirmed_at': row.old_confirmed_at},
+            {'visit_date': row.visit_date, 'status': status, 'pain_level': row.pain_level,
+             'pain_duration': row.pain_duration, 'confirmed_at': row.confirmed_at}
+        )
+        for row in rows
+    ])
+
+    updated = [{'id': row.id, 'patient_id': row.patient_id, 'from': row.old_status} for row in rows]
+    skipped = []
+    remaining = sorted(set(visit_ids) - {row.id for row in rows})
+    if remaining:
+        statuses = dict(db.session.execute(
+            select(visits.c.id, visits.c.status).where(visits.c.id.in_(remaining))
+        ).all())
+        skipped = [{'id': visit_id, 'status': statuses.get(visit_id)} for visit_id in remaining]
+    return sorted(updated, key=lambda item: item['id']), skipped
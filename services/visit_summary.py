@@ -0,0 +1,96 @@
+"""
+患者就诊汇总列（patients.last_visit_at / visit_count）
+
+- Visit的插入、修改visit_date/patient_id、删除都会在同一个flush里更新对应患者，
+  和就诊记录在同一个事务里提交
+- 插入只做增量更新；修改和删除按(patient_id, visit_date)索引重算该患者
+- `flask patients repair-summaries`按批全量重算
+"""
+from sqlalchemy import event, select, update, func, and_
+from sqlalchemy.orm import Session as OrmSession, object_session
+from models import db, Patient, Visit
+
+_patients = Patient.__table__
+_visits = Visit.__table__
+
+def _remember(target, patient_id):
+    # flush结束后让会话里的Patient对象重新加载这两列
+    object_session(target).info.setdefault('visit_summary_patients', set()).add(patient_id)
+
+def _recompute(connection, target, patient_id):
+    summary = select(func.count(), func.max(_visits.c.visit_date))\
+        .where(_visits.c.patient_id == patient_id)
+    count, last_visit_at = connection.execute(summary).one()
+    connection.execute(
+        update(_patients)
+        .where(_patients.c.id == patient_id)
+        .values(visit_count=count, last_visit_at=last_visit_at)
+    )
+    _remember(target, patient_id)
+
+@event.listens_for(Visit, 'after_insert')
+def _visit_inserted(mapper, connection, target):
+    connection.execute(
+        update(_patients)
+        .where(_patients.c.id == target.patient_id)
+        .values(
+            visit_count=_patients.c.visit_count + 1,
+            # GREATEST忽略NULL
+            last_visit_at=func.greatest(_patients.c.last_visit_at, target.visit_date)
+        )
+    )
+    _remember(target, target.patient_id)
+
+@event.listens_for(Visit, 'after_update')
+def _visit_updated(mapper, connection, target):
+    state = db.inspect(target)
+    patient_history = state.attrs.patient_id.history
+    if not (patient_history.has_changes() or state.attrs.visit_date.history.has_changes()):
+        return
+
+    for patient_id in {target.patient_id, *patient_history.deleted}:
+        if patient_id is not None:
+            _recompute(connection, target, patient_id)
+
+@event.listens_for(Visit, 'after_delete')
+def _visit_deleted(mapper, connection, target):
+    _recompute(connection, target, target.patient_id)
+
+@event.listens_for(OrmSession, 'after_flush_postexec')
+def _expire_patients(session, flush_context):
+    for patient_id in session.info.pop('visit_summary_patients', ()):
+        patient = session.identity_map.get(db.inspect(Patient).identity_key_from_primary_key([patient_id]))
+        if patient is not None:
+            session.expire(patient, ['last_visit_at', 'visit_count'])
+
+def repair_summaries(batch_size: int = 1000, log=print) -> int:
+    """
+    按患者id分批重算所有汇总列，返回处理的患者数
+    """
+    last_id, done = 0, 0
+    while True:
+        ids = db.session.execute(
+            select(_patients.c.id).where(_patients.c.id > last_id).order_by(_patients.c.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return done
+
+        low, high = ids[0], ids[-1]
+        in_batch = and_(_patients.c.id >= low, _patients.c.id <= high)
+        summary = select(
+            _visits.c.patient_id,
+            func.count().label('visit_count'),
+            func.max(_visits.c.visit_date).label('last_visit_at')
+        ).where(_visits.c.patient_id.between(low, high)).group_by(_visits.c.patient_id).subquery()
+
+        # 先清零，再用聚合结果覆盖有就诊记录的患者
+        db.session.execute(update(_patients).where(in_batch).values(visit_count=0, last_visit_at=None))
+        db.session.execute(
+            update(_patients)
+            .where(in_batch, _patients.c.id == summary.c.patient_id)
+            .values(visit_count=summary.c.visit_count, last_visit_at=summary.c.last_visit_at)
+        )
+        db.session.commit()
+
+        last_id, done = high, done + len(ids)
+        log(f"Repaired {done} patients")
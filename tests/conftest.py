@@ -1,7 +1,15 @@
+import os
 import pytest
+
+# 测试用固定的低cost，不在导入时校准
+os.environ.setdefault('BCRYPT_ROUNDS', '5')
+os.environ.setdefault('BLIND_INDEX_KEY', 'test-blind-index-key')
+
 from app import app as flask_app
 from models import db, User, Patient
 from auth.password_utils import hash_password
+from services.cache import clear_caches
+from security.audit_archive import ensure_partitions
 from datetime import datetime
 
 @pytest.fixture
@@ -12,12 +20,21 @@ def app():
         'SQLALCHEMY_DATABASE_URI': 'postgresql://harper@localhost:5432/healthcare_test_db',
         'JWT_SECRET_KEY': 'test-secret-key-for-testing',
         'ENCRYPTION_KEY': 'test-encryption-key-32bytes!!',
+        'ENCRYPTION_OLD_KEYS': [],
+        'BLIND_INDEX_KEY': 'test-blind-index-key',
         'WTF_CSRF_ENABLED': False,
+        'AUDIT_ASYNC': False,
+        # 语音分析任务由测试自己执行（run_next_job或手动启动线程池）
+        'AUDIO_JOB_WORKERS': 0,
         'SQLALCHEMY_TRACK_MODIFICATIONS': False
     })
     
+    clear_caches()
+    
     with flask_app.app_context():
         db.create_all()
+        with db.engine.begin() as connection:
+            ensure_partitions(connection)
         
         # Create test patient user
         test_patient = User(
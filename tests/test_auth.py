@@ -1,6 +1,11 @@
 import pytest
-from auth.password_utils import hash_password, verify_password
-from auth.auth_utils import generate_token, verify_token
+import bcrypt
+import threading
+from auth import password_utils
+from auth.password_utils import hash_password, verify_password, needs_rehash, calibrate_rounds
+from auth.auth_utils import generate_token, verify_token, revoke_token, token_cache, hash_token
+from auth.principal import principal_cache
+from models import db, User
 
 class TestPasswordUtils:
     """Test password encryption utilities"""
@@ -38,6 +43,69 @@ class TestPasswordUtils:
         assert verify_password(password, hash1) == True
         assert verify_password(password, hash2) == True
 
+class TestPasswordHasher:
+    """Test bcrypt pool, cost calibration and rehash"""
+    
+    def test_calibrate_rounds_respects_bounds(self):
+        """Test that calibration stays inside the configured range"""
+        assert calibrate_rounds(0, min_rounds=4, max_rounds=8) == 4
+        assert 4 <= calibrate_rounds(10 ** 6, min_rounds=4, max_rounds=8) <= 8
+    
+    def test_calibration_deferred_until_first_hash(self, app, monkeypatch):
+        """Test that BCRYPT_ROUNDS=0 calibrates on first use, not at startup"""
+        calls = []
+        monkeypatch.setattr(password_utils, 'calibrate_rounds',
+                            lambda target_ms, min_rounds: calls.append(target_ms) or 5)
+        app.config.update({'BCRYPT_ROUNDS': 0, 'BCRYPT_TARGET_MS': 1})
+        try:
+            password_utils.init_password_hasher(app)
+            assert calls == []
+            
+            hashed = hash_password('test123')
+            assert calls == [1]
+            assert hashed.startswith('$2b$05$')
+        finally:
+            app.config['BCRYPT_ROUNDS'] = 5
+            password_utils.init_password_hasher(app)
+    
+    def test_needs_rehash_for_outdated_cost(self):
+        """Test detection of hashes created with a lower cost"""
+        old_hash = bcrypt.hashpw(b'test123', bcrypt.gensalt(4)).decode()
+        
+        assert needs_rehash(old_hash) == True
+        assert needs_rehash(hash_password('test123')) == False
+    
+    def test_login_rehashes_outdated_hash(self, client, app):
+        """Test transparent rehash on successful login"""
+        with app.app_context():
+            user = User.query.filter_by(username='test_patient').first()
+            user.password_hash = bcrypt.hashpw(b'test123', bcrypt.gensalt(4)).decode()
+            db.session.commit()
+        
+        response = client.post('/api/auth/login', json={
+            'username': 'test_patient',
+            'password': 'test123'
+        })
+        assert response.status_code == 200
+        
+        with app.app_context():
+            user = User.query.filter_by(username='test_patient').first()
+            assert needs_rehash(user.password_hash) == False
+            assert verify_password('test123', user.password_hash) == True
+    
+    def test_login_rejected_when_queue_full(self, client, monkeypatch):
+        """Test fast 503 when the hashing queue is saturated"""
+        monkeypatch.setattr(password_utils, '_slots', threading.BoundedSemaphore(1))
+        password_utils._slots.acquire()
+        
+        response = client.post('/api/auth/login', json={
+            'username': 'test_patient',
+            'password': 'test123'
+        })
+        
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+
 class TestAuthAPI:
     """Test authentication API endpoints"""
     
@@ -161,6 +229,91 @@ class TestJWTToken:
             payload = verify_token('not-a-real-token')
             assert payload is None
 
+class TestTokenCache:
+    """Test verified-token cache"""
+    
+    def test_second_verify_hits_cache(self, app):
+        """Test that verifying the same token twice is served from cache"""
+        with app.app_context():
+            token = generate_token(user_id=1, role='patient')
+            
+            verify_token(token)
+            hits = token_cache.hits
+            payload = verify_token(token)
+            
+            assert payload['user_id'] == 1
+            assert token_cache.hits == hits + 1
+    
+    def test_revoke_invalidates_cache(self, app):
+        """Test that a revoked token is rejected immediately"""
+        with app.app_context():
+            token = generate_token(user_id=1, role='patient')
+            assert verify_token(token) is not None
+            
+            assert revoke_token(token) == True
+            assert verify_token(token) is None
+    
+    def test_revoke_invalidates_again_after_commit(self, app):
+        """Test that a token re-cached before the revoke commits is dropped on commit"""
+        with app.app_context():
+            token = generate_token(user_id=1, role='patient')
+            assert verify_token(token) is not None
+            
+            with app.test_request_context():
+                revoke_token(token)
+                db.session.flush()
+                # 并发请求在提交前读到旧行并重新缓存
+                token_cache.set(hash_token(token), {'user_id': 1, 'role': 'patient'})
+                db.session.commit()
+            
+            assert verify_token(token) is None
+    
+    def test_invalid_token_not_cached(self, app):
+        """Test that invalid tokens are never cached"""
+        with app.app_context():
+            verify_token('invalid.token.string')
+            assert token_cache.stats()['size'] == 0
+
+class TestPrincipalCache:
+    """Test principal cache used by require_auth"""
+    
+    def test_principal_served_from_cache(self, client, patient_token):
+        """Test that repeated requests reuse the cached principal"""
+        headers = {'Authorization': f'Bearer {patient_token}'}
+        client.get('/api/patient/me', headers=headers)
+        hits = principal_cache.hits
+        
+        response = client.get('/api/patient/me', headers=headers)
+        
+        assert response.status_code == 200
+        assert principal_cache.hits == hits + 1
+    
+    def test_deactivation_invalidates_principal(self, client, app, patient_token):
+        """Test that a deactivated user is rejected right away"""
+        headers = {'Authorization': f'Bearer {patient_token}'}
+        assert client.get('/api/patient/me', headers=headers).status_code == 200
+        
+        with app.app_context():
+            user = User.query.filter_by(username='test_patient').first()
+            user.is_active = False
+            db.session.commit()
+        
+        response = client.get('/api/patient/me', headers=headers)
+        assert response.status_code == 401
+    
+    def test_role_change_invalidates_principal(self, client, app, patient_token):
+        """Test that a role change takes effect right away"""
+        headers = {'Authorization': f'Bearer {patient_token}'}
+        assert client.get('/api/patient/all', headers=headers).status_code == 403
+        
+        with app.app_context():
+            user = User.query.filter_by(username='test_patient').first()
+            user.role = 'staff'
+            db.session.commit()
+        
+        response = client.get('/api/patient/all', headers=headers)
+        assert response.status_code == 200
+
 class TestAuthenticatedEndpoints:
     """Test endpoints requiring authentication"""
     
@@ -186,4 +339,14 @@ class TestAuthenticatedEndpoints:
             'Authorization': 'Bearer invalid.token'
         })
         
-        assert response.status_code == 401
\ No newline at end of file
+        assert response.status_code == 401
+    
+    def test_staff_can_view_cache_stats(self, client, staff_token):
+        """Test cache statistics endpoint for staff"""
+        response = client.get('/api/auth/cache-stats', headers={
+            'Authorization': f'Bearer {staff_token}'
+        })
+        
+        assert response.status_code == 200
+        assert 'token' in response.json['caches']
+        assert 'hits' in response.json['caches']['token']
@@ -1,4 +1,29 @@
+import os
 import pytest
+from models import db, User, Patient, Visit
+from datetime import datetime
+
+def create_visit(app, username='test_patient', **fields):
+    """Create a visit for the given user's patient record"""
+    with app.app_context():
+        patient = Patient.query.join(User).filter(User.username == username).first()
+        visit = Visit(patient_id=patient.id, visit_reason='Headache', **fields)
+        db.session.add(visit)
+        db.session.commit()
+        return visit.id
+
+def create_patient(app, username, full_name='Other Patient', date_of_birth='1985-05-05'):
+    """Create another patient user"""
+    with app.app_context():
+        user = User(username=username, email=f'{username}@test.com',
+                    password_hash='x', role='patient', is_active=True)
+        db.session.add(user)
+        db.session.flush()
+        patient = Patient(user_id=user.id, full_name=full_name,
+                          date_of_birth=datetime.strptime(date_of_birth, '%Y-%m-%d').date())
+        db.session.add(patient)
+        db.session.commit()
+        return patient.id
 
 class TestPatientAPI:
     """Test patient-related API endpoints"""
@@ -48,6 +73,48 @@ class TestPatientAPI:
         assert isinstance(response.json['patients'], list)
         assert len(response.json['patients']) > 0
     
+    def test_patient_list_pages_with_cursor(self, client, app, staff_token):
+        """Test keyset pagination, total count and last visit in the patient list"""
+        for i in range(4):
+            create_patient(app, f'page_patient_{i}')
+        create_visit(app, visit_date=datetime(2025, 3, 1, 9, 30))
+        create_visit(app, visit_date=datetime(2025, 1, 1, 9, 30))
+        
+        headers = {'Authorization': f'Bearer {staff_token}'}
+        response = client.get('/api/patient/all?limit=2&count=true', headers=headers)
+        assert response.status_code == 200
+        assert response.json['total'] == 5
+        
+        patients, cursor = response.json['patients'], response.json['next_cursor']
+        while cursor:
+            response = client.get(f'/api/patient/all?limit=2&cursor={cursor}', headers=headers)
+            patients += response.json['patients']
+            cursor = response.json['next_cursor']
+        
+        assert len({p['id'] for p in patients}) == 5
+        by_name = {p['full_name']: p for p in patients}
+        assert by_name['Test Patient']['last_visit'] == '2025-03-01T09:30:00'
+    
+    def test_patient_list_uses_constant_queries(self, client, app, staff_token):
+        """Test that the list does not issue a query per patient"""
+        from sqlalchemy import event
+        
+        for i in range(5):
+            create_patient(app, f'n_plus_one_{i}')
+        
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            try:
+                response = client.get('/api/patient/all', headers={'Authorization': f'Bearer {staff_token}'})
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', listener)
+        
+        assert response.status_code == 200
+        # last_visit来自patients上的汇总列，不再查询visits
+        assert not any('FROM visits' in s for s in statements)
+
     def test_staff_can_view_specific_patient(self, client, staff_token):
         """Test that staff can view specific patient details"""
         response = client.get('/api/patient/1', headers={
@@ -66,6 +133,357 @@ class TestPatientAPI:
         
         assert response.status_code in [403, 404]
 
+class TestPatientDetail:
+    """Test the projected, paginated patient detail and its ETag"""
+    
+    def get(self, client, token, patient_id, query='', etag=None):
+        headers = {'Authorization': f'Bearer {token}'}
+        if etag:
+            headers['If-None-Match'] = etag
+        return client.get(f'/api/patient/{patient_id}{query}', headers=headers)
+    
+    def patient_id(self, app, username='test_patient'):
+        with app.app_context():
+            return Patient.query.join(User).filter(User.username == username).first().id
+    
+    def test_repeat_open_returns_304_until_data_changes(self, client, app, staff_token):
+        """Test If-None-Match returns 304 and any write changes the ETag"""
+        patient_id = self.patient_id(app)
+        first = self.get(client, staff_token, patient_id)
+        assert first.status_code == 200
+        etag = first.headers['ETag']
+        
+        again = self.get(client, staff_token, patient_id, etag=etag)
+        assert again.status_code == 304
+        assert again.headers['ETag'] == etag
+        
+        create_visit(app, visit_date=datetime(2025, 4, 1))
+        changed = self.get(client, staff_token, patient_id, etag=etag)
+        assert changed.status_code == 200
+        assert len(changed.json['visits']) == 1
+        
+        etag = changed.headers['ETag']
+        with app.app_context():
+            db.session.get(Patient, patient_id).phone = '555-0000'
+            db.session.commit()
+        assert self.get(client, staff_token, patient_id, etag=etag).status_code == 200
+    
+    def test_fields_projection(self, client, app, staff_token):
+        """Test that fields= limits the response and rejects unknown fields"""
+        patient_id = self.patient_id(app)
+        response = self.get(client, staff_token, patient_id, '?fields=full_name,visit_count')
+        assert response.status_code == 200
+        assert response.json == {'full_name': 'Test Patient', 'visit_count': 0}
+        
+        assert self.get(client, staff_token, patient_id, '?fields=full_name,ssn').status_code == 400
+    
+    def test_visits_are_paginated(self, client, app, staff_token):
+        """Test keyset pagination of the embedded visits"""
+        patient_id = self.patient_id(app)
+        for day in range(1, 6):
+            create_visit(app, visit_date=datetime(2025, 1, day))
+        
+        seen, cursor = [], None
+        while True:
+            query = '?fields=visits&visits_limit=2' + (f'&visits_cursor={cursor}' if cursor else '')
+            response = self.get(client, staff_token, patient_id, query)
+            assert response.status_code == 200
+            seen.extend(visit['visit_date'] for visit in response.json['visits'])
+            cursor = response.json['visits_next_cursor']
+            if not cursor:
+                break
+        
+        assert seen == [f'2025-01-0{day}T00:00:00' for day in range(5, 0, -1)]
+    
+    def test_detail_query_count(self, client, app, staff_token):
+        """Test that user and insurance are joined in and visits cost one query"""
+        from sqlalchemy import event
+        
+        patient_id = self.patient_id(app)
+        for day in range(1, 4):
+            create_visit(app, visit_date=datetime(2025, 2, day))
+        
+        def count_selects(query):
+            statements = []
+            listener = lambda conn, cursor, statement, *args: statements.append(statement)
+            with app.app_context():
+                event.listen(db.engine, 'before_cursor_execute', listener)
+                try:
+                    response = self.get(client, staff_token, patient_id, query)
+                finally:
+                    event.remove(db.engine, 'before_cursor_execute', listener)
+            assert response.status_code == 200
+            return len([s for s in statements if s.lstrip().upper().startswith('SELECT')])
+        
+        # 先请求一次，让token进入缓存
+        count_selects('?fields=id')
+        # email/insurance来自同一次join，就诊记录只多一次分页查询
+        assert count_selects('') == count_selects('?fields=id') + 1
+    
+    def test_patient_only_sees_self(self, client, app, patient_token):
+        """Test that a patient is refused another patient's detail"""
+        other_id = create_patient(app, 'detail_other')
+        assert self.get(client, patient_token, other_id).status_code == 403
+        assert self.get(client, patient_token, self.patient_id(app)).status_code == 200
+
+class TestResponseCache:
+    """Test the write-invalidated cache on the staff dashboard endpoints"""
+    
+    def get(self, client, token, path):
+        return client.get(path, headers={'Authorization': f'Bearer {token}'})
+    
+    def test_repeat_request_hits_until_write(self, client, app, staff_token):
+        """Test that a repeated list is served from cache until a visit is written"""
+        from services.response_cache import patient_list_cache
+        
+        first = self.get(client, staff_token, '/api/patient/all')
+        hits = patient_list_cache.hits
+        assert self.get(client, staff_token, '/api/patient/all').json == first.json
+        assert patient_list_cache.hits == hits + 1
+        
+        create_visit(app, visit_date=datetime(2025, 6, 1))
+        changed = self.get(client, staff_token, '/api/patient/all')
+        assert patient_list_cache.hits == hits + 1
+        assert changed.json['patients'][0]['visit_count'] == 1
+    
+    def test_keyed_by_query_parameters(self, client, app, staff_token):
+        """Test that different parameters are cached separately"""
+        create_visit(app, visit_date=datetime(2025, 6, 1))
+        create_visit(app, visit_date=datetime(2025, 6, 2))
+        
+        assert len(self.get(client, staff_token, '/api/visit/recent?limit=1').json['visits']) == 1
+        assert len(self.get(client, staff_token, '/api/visit/recent?limit=5').json['visits']) == 2
+    
+    def test_bulk_update_and_rollback(self, app):
+        """Test that Core UPDATEs bump the version and rolled back writes do not"""
+        from services.response_cache import data_version
+        
+        with app.app_context():
+            version = data_version()
+            patient = Patient.query.first()
+            patient.phone = '555-1111'
+            db.session.flush()
+            db.session.rollback()
+            assert data_version() == version
+            
+            db.session.execute(db.update(Visit).values(status='completed'))
+            db.session.commit()
+            assert data_version() == version + 1
+    
+    def test_large_results_not_cached(self, client, app, staff_token, monkeypatch):
+        """Test that results above the entry size limit are not stored"""
+        import services.response_cache as response_cache
+        
+        monkeypatch.setattr(response_cache, '_max_entry_bytes', 10)
+        self.get(client, staff_token, '/api/patient/all')
+        assert response_cache.patient_list_cache.stats()['size'] == 0
+    
+    def test_hit_ratio_reported_per_endpoint(self, client, staff_token):
+        """Test that cache stats list each endpoint separately"""
+        from services.response_cache import recent_visits_cache
+        
+        before = recent_visits_cache.stats()
+        self.get(client, staff_token, '/api/visit/recent')
+        self.get(client, staff_token, '/api/visit/recent')
+        caches = self.get(client, staff_token, '/api/auth/cache-stats').json['caches']
+        assert caches['response:recent_visits']['hits'] == before['hits'] + 1
+        assert caches['response:recent_visits']['misses'] == before['misses'] + 1
+        assert 'hit_ratio' in caches['response:patient_list']
+
+class TestVisitSummary:
+    """Test denormalized last_visit_at / visit_count on patients"""
+    
+    def get_patient(self, username='test_patient'):
+        return Patient.query.join(User).filter(User.username == username).first()
+    
+    def test_insert_update_delete_maintain_summary(self, app):
+        """Test that every visit write keeps the summary columns in sync"""
+        first = create_visit(app, visit_date=datetime(2025, 1, 1))
+        second = create_visit(app, visit_date=datetime(2025, 2, 1))
+        
+        with app.app_context():
+            patient = self.get_patient()
+            assert patient.visit_count == 2
+            assert patient.last_visit_at == datetime(2025, 2, 1)
+            
+            db.session.get(Visit, first).visit_date = datetime(2025, 3, 1)
+            db.session.commit()
+            assert patient.last_visit_at == datetime(2025, 3, 1)
+            
+            db.session.delete(db.session.get(Visit, first))
+            db.session.commit()
+            assert patient.visit_count == 1
+            assert patient.last_visit_at == datetime(2025, 2, 1)
+    
+    def test_repair_recomputes_from_visits(self, app):
+        """Test bulk repair after the columns drift"""
+        from services.visit_summary import repair_summaries
+        
+        create_visit(app, visit_date=datetime(2025, 1, 1))
+        with app.app_context():
+            db.session.execute(db.update(Patient).values(visit_count=99, last_visit_at=None))
+            db.session.commit()
+            
+            repair_summaries(batch_size=1, log=lambda msg: None)
+            
+            db.session.expire_all()
+            patient = self.get_patient()
+            assert patient.visit_count == 1
+            assert patient.last_visit_at == datetime(2025, 1, 1)
+    
+    def test_list_sorted_by_last_visit(self, client, app, staff_token):
+        """Test last_visit ordering and paging across patients without visits"""
+        create_patient(app, 'recent_patient')
+        create_patient(app, 'never_visited')
+        create_visit(app, visit_date=datetime(2025, 1, 1))
+        create_visit(app, username='recent_patient', visit_date=datetime(2025, 6, 1))
+        
+        headers = {'Authorization': f'Bearer {staff_token}'}
+        names, cursor = [], None
+        while True:
+            url = '/api/patient/all?sort=last_visit&limit=1' + (f'&cursor={cursor}' if cursor else '')
+            response = client.get(url, headers=headers)
+            assert response.status_code == 200
+            names += [p['full_name'] for p in response.json['patients']]
+            cursor = response.json['next_cursor']
+            if cursor is None:
+                break
+        
+        assert names[:2] == ['Other Patient', 'Test Patient']
+        assert len(names) == 3
+
+class TestPatientSearch:
+    """Test returning-patient search by name and date of birth"""
+    
+    def search(self, client, token, query):
+        return client.get(f'/api/patient/search?{query}', headers={'Authorization': f'Bearer {token}'})
+    
+    def test_typo_tolerant_name_search(self, client, app, staff_token):
+        """Test that vowel typos and transposed letters still match"""
+        create_patient(app, 'jsmith', full_name='John Smith', date_of_birth='1970-02-03')
+        create_patient(app, 'jsmythe', full_name='Joan Smythe', date_of_birth='1980-04-05')
+        
+        for query in ('jhon smith', 'Jonh Smiht', 'JOHN SMITH'):
+            response = self.search(client, staff_token, f'name={query}')
+            assert response.status_code == 200
+            assert response.json['patients'][0]['full_name'] == 'John Smith', query
+        
+        response = self.search(client, staff_token, 'name=Jon Smyth')
+        assert {p['full_name'] for p in response.json['patients']} == {'John Smith', 'Joan Smythe'}
+    
+    def test_prefix_and_dob_search(self, client, app, staff_token):
+        """Test prefix typing and date-of-birth narrowing"""
+        create_patient(app, 'jsmith', full_name='John Smith', date_of_birth='1970-02-03')
+        create_patient(app, 'jsmith2', full_name='John Smith', date_of_birth='1990-02-03')
+        
+        response = self.search(client, staff_token, 'name=john sm')
+        assert len(response.json['patients']) == 2
+        
+        response = self.search(client, staff_token, 'name=jhn smth&dob=1990-02-03')
+        assert [p['date_of_birth'] for p in response.json['patients']] == ['1990-02-03']
+    
+    def test_exact_match_survives_candidate_limit(self, app):
+        """Test that candidates are ordered in SQL before the candidate limit"""
+        from models import Patient
+        from services.patient_search import search_patients
+        
+        with app.app_context():
+            dob = datetime(1975, 6, 7).date()
+            for name in ('Jon Smith', 'Joan Smyth', 'Jhon Smith', 'Jahn Smith', 'Jean Smith'):
+                db.session.add(Patient(full_name=name, date_of_birth=dob))
+            exact = Patient(full_name='John Smith', date_of_birth=dob)
+            db.session.add(exact)
+            db.session.commit()
+            
+            matches = search_patients(name='john smith', candidate_limit=2)
+            assert matches[0][0].id == exact.id
+            
+            matches = search_patients(name='john smith', date_of_birth=dob, candidate_limit=1)
+            assert [row.id for row, _ in matches] == [exact.id]
+    
+    def test_search_requires_staff_and_criteria(self, client, patient_token, staff_token):
+        """Test access control and input validation"""
+        assert self.search(client, patient_token, 'name=john').status_code == 403
+        assert self.search(client, staff_token, '').status_code == 400
+        assert self.search(client, staff_token, 'dob=03-02-1970').status_code == 400
+
+@pytest.mark.skipif(not os.getenv('PATIENT_SEARCH_BENCH_ROWS'),
+                    reason='set PATIENT_SEARCH_BENCH_ROWS (e.g. 1000000) to run the search benchmark')
+class TestPatientSearchBenchmark:
+    """Benchmark: p99 of returning-patient search under 20 ms"""
+    
+    def test_search_p99(self, app):
+        """Seed synthetic patients with COPY, then time typo'd searches and check the target is found"""
+        import io
+        import random
+        import time
+        from datetime import date, timedelta
+        from models import Patient
+        from services.patient_search import normalize_name, name_keys, search_patients
+        
+        rows = int(os.environ['PATIENT_SEARCH_BENCH_ROWS'])
+        rng = random.Random(42)
+        first = ['james', 'mary', 'john', 'patricia', 'robert', 'jennifer', 'michael', 'linda', 'william',
+                 'elizabeth', 'david', 'barbara', 'richard', 'susan', 'joseph', 'jessica', 'thomas', 'sarah',
+                 'charles', 'karen', 'maria', 'wei', 'fatima', 'ahmed', 'olga', 'hiroshi', 'priya', 'carlos']
+        first += [f'{name}{suffix}' for name in first for suffix in ('a', 'o', 'en', 'ine')]
+        last = [f'{a}{b}' for a in ('smi', 'john', 'wil', 'bro', 'jon', 'gar', 'mil', 'dav', 'rod', 'mar',
+                                     'her', 'lop', 'gon', 'and', 'tho', 'tay', 'moo', 'jac', 'mart', 'lee')
+                for b in ('th', 'son', 'liams', 'wn', 'es', 'cia', 'ler', 'is', 'riguez', 'tinez', 'nandez',
+                          'ez', 'zalez', 'erson', 'mas', 'lor', 're', 'kson', 'in', 'berg')]
+        
+        people = []
+        buffer = io.StringIO()
+        for i in range(rows):
+            name = f'{rng.choice(first).title()} {rng.choice(last).title()}'
+            target = i % max(1, rows // 200) == 0
+            if target:
+                # 被查找的患者用双姓，只按姓名查时也能唯一确定是不是找到了本人
+                name = f'{name} {rng.choice(last).title()}'
+            dob = date(1940, 1, 1) + timedelta(days=rng.randrange(80 * 365))
+            normalized = normalize_name(name)
+            keys = '{' + ','.join(name_keys(normalized)) + '}'
+            buffer.write(f'{name}\t{dob.isoformat()}\t{normalized}\t{keys}\t0\n')
+            if target:
+                people.append((name, dob))
+        buffer.seek(0)
+        
+        with app.app_context():
+            raw = db.engine.raw_connection()
+            try:
+                raw.cursor().copy_from(buffer, 'patients',
+                                       columns=('full_name', 'date_of_birth', 'search_name', 'name_keys', 'visit_count'))
+                raw.commit()
+                # 把GIN的pending list合并进索引，和长期运行的表一致
+                raw.driver_connection.autocommit = True
+                raw.cursor().execute('VACUUM ANALYZE patients')
+            finally:
+                raw.close()
+            
+            def typo(name):
+                # 交换词内相邻的两个字母
+                chars = list(name)
+                i = rng.choice([i for i in range(1, len(chars) - 1) if chars[i] != ' ' and chars[i + 1] != ' '])
+                chars[i], chars[i + 1] = chars[i + 1], chars[i]
+                return ''.join(chars)
+            
+            timings = []
+            for name, dob in people:
+                target_ids = set(db.session.execute(
+                    db.select(Patient.id).where(Patient.full_name == name, Patient.date_of_birth == dob)
+                ).scalars())
+                misspelled = typo(name)
+                for kwargs in ({'name': misspelled, 'date_of_birth': dob}, {'name': misspelled}, {'name': name}):
+                    start = time.perf_counter()
+                    matches = search_patients(limit=10, **kwargs)
+                    timings.append((time.perf_counter() - start) * 1000)
+                    db.session.rollback()
+                    assert target_ids & {row.id for row, _ in matches}, kwargs
+        
+        timings.sort()
+        p50, p99 = timings[len(timings) // 2], timings[int(len(timings) * 0.99) - 1]
+        assert p99 < 20, f'patient search over {rows} rows: p50={p50:.2f}ms p99={p99:.2f}ms'
+
 class TestVisitAPI:
     """Test visit-related API endpoints"""
     
@@ -88,10 +506,1003 @@ class TestVisitAPI:
         assert response.status_code == 200
         assert 'visits' in response.json
     
+    def test_recent_visits_keyset_pages_and_filters(self, client, app, staff_token):
+        """Test cursor paging, the limit cap and status/date filters on recent visits"""
+        create_patient(app, 'recent_other', full_name='Recent Other')
+        for day in range(1, 6):
+            create_visit(app, visit_date=datetime(2025, 9, day), status='pending' if day % 2 else 'completed')
+        create_visit(app, username='recent_other', visit_date=datetime(2025, 9, 3), status='pending')
+        headers = {'Authorization': f'Bearer {staff_token}'}
+        
+        seen, cursor = [], None
+        while True:
+            response = client.get('/api/visit/recent?limit=2' + (f'&cursor={cursor}' if cursor else ''), headers=headers)
+            assert response.status_code == 200
+            seen.extend((v['visit_date'][:10], v['patient_name']) for v in response.json['visits'])
+            cursor = response.json['next_cursor']
+            if not cursor:
+                break
+        assert [date for date, _ in seen] == ['2025-09-05', '2025-09-04', '2025-09-03', '2025-09-03',
+                                              '2025-09-02', '2025-09-01']
+        assert ('2025-09-03', 'Recent Other') in seen
+        
+        response = client.get('/api/visit/recent?status=pending&since=2025-09-02&until=2025-09-05', headers=headers)
+        assert [(v['visit_date'][:10], v['status']) for v in response.json['visits']] == \
+            [('2025-09-03', 'pending'), ('2025-09-03', 'pending')]
+        
+        app.config['VISIT_RECENT_MAX_PAGE_SIZE'] = 3
+        try:
+            response = client.get('/api/visit/recent?limit=1000', headers=headers)
+        finally:
+            app.config['VISIT_RECENT_MAX_PAGE_SIZE'] = 100
+        assert len(response.json['visits']) == 3
+        
+        assert client.get('/api/visit/recent?cursor=bogus', headers=headers).status_code == 400
+    
+    def test_recent_visits_single_query_from_index(self, client, app, staff_token):
+        """Test names come from the join and the page is read in index order"""
+        from sqlalchemy import event
+        
+        for i in range(3):
+            create_patient(app, f'recent_{i}')
+            create_visit(app, username=f'recent_{i}')
+        
+        headers = {'Authorization': f'Bearer {staff_token}'}
+        client.get('/api/auth/cache-stats', headers=headers)  # token进入缓存
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            try:
+                response = client.get('/api/visit/recent', headers=headers)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', listener)
+            
+            db.session.execute(db.text('SET LOCAL enable_seqscan = off'))
+            plan = '\n'.join(db.session.execute(db.text(
+                "EXPLAIN SELECT visits.id FROM visits JOIN patients ON patients.id = visits.patient_id "
+                "WHERE (visits.visit_date, visits.id) < ('2025-01-01', 100) "
+                "ORDER BY visits.visit_date DESC, visits.id DESC LIMIT 10"
+            )).scalars().all())
+            db.session.rollback()
+        
+        assert response.status_code == 200
+        assert len([s for s in statements if 'FROM patients' in s or 'JOIN patients' in s]) == 1
+        assert 'ix_visits_visit_date_id' in plan
+        assert '->  Sort' not in plan
+    
     def test_patient_cannot_view_recent_visits(self, client, patient_token):
         """Test that patient cannot view all recent visits"""
         response = client.get('/api/visit/recent', headers={
             'Authorization': f'Bearer {patient_token}'
         })
         
-        assert response.status_code == 403
\ No newline at end of file
+        assert response.status_code == 403
+    
+    def test_patient_can_view_own_visit(self, client, app, patient_token):
+        """Test patient viewing a visit of their own"""
+        visit_id = create_visit(app)
+        
+        response = client.get(f'/api/visit/{visit_id}', headers={
+            'Authorization': f'Bearer {patient_token}'
+        })
+        
+        assert response.status_code == 200
+        assert response.json['patient_name'] == 'Test Patient'
+    
+    def test_patient_cannot_view_other_visit(self, client, app, patient_token):
+        """Test patient cannot view another patient's visit"""
+        create_patient(app, 'other_patient')
+        visit_id = create_visit(app, username='other_patient')
+        
+        response = client.get(f'/api/visit/{visit_id}', headers={
+            'Authorization': f'Bearer {patient_token}'
+        })
+        
+        assert response.status_code == 403
+        with app.app_context():
+            from models import AuditLog
+            assert AuditLog.query.filter_by(action='access_denied', resource_id=visit_id).count() == 1
+    
+    def test_staff_without_patient_record_cannot_process_audio(self, client, staff_token):
+        """Test that audio processing is rejected before any AI call for non-patients"""
+        response = client.post('/api/process_audio', headers={
+            'Authorization': f'Bearer {staff_token}'
+        })
+        
+        assert response.status_code == 404
+
+class TestVisitEvents:
+    """Test the visit change feed and its SSE stream"""
+    
+    @pytest.fixture(autouse=True)
+    def fast_stream(self, app):
+        from services.visit_events import broadcaster
+        
+        app.config.update({
+            'VISIT_EVENTS_POLL_INTERVAL': 0.1,
+            'VISIT_EVENTS_HEARTBEAT': 1,
+            'VISIT_EVENTS_STREAM_SECONDS': 5
+        })
+        yield
+        broadcaster.stop()
+    
+    def open_stream(self, client, token, last_event_id=None):
+        headers = {'Authorization': f'Bearer {token}'}
+        if last_event_id:
+            headers['Last-Event-ID'] = last_event_id
+        response = client.get('/api/visit/events', headers=headers, buffered=False)
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        chunks = iter(response.response)
+        assert next(chunks).startswith(b'retry:')
+        return chunks
+    
+    def read_events(self, chunks, count):
+        """Collect (id, event name, data) tuples, skipping keepalives"""
+        import json
+        
+        events = []
+        for chunk in chunks:
+            fields = dict(
+                line.split(': ', 1) for line in chunk.decode().strip().split('\n') if not line.startswith(':')
+            )
+            if fields:
+                events.append((fields['id'], fields.get('event', 'message'), json.loads(fields['data'])))
+            if len(events) == count:
+                break
+        return events
+    
+    def test_events_written_with_the_visit(self, app):
+        """Test that creates and status changes are recorded, rolled back writes are not"""
+        from models import VisitEvent
+        
+        visit_id = create_visit(app)
+        with app.app_context():
+            visit = db.session.get(Visit, visit_id)
+            visit.status = 'confirmed'
+            db.session.commit()
+            
+            visit.status = 'cancelled'
+            db.session.flush()
+            db.session.rollback()
+            
+            events = VisitEvent.query.filter_by(visit_id=visit_id).order_by(VisitEvent.id).all()
+            assert [(e.event, e.status) for e in events] == [('created', 'pending'), ('status_changed', 'confirmed')]
+    
+    def test_unfinished_transactions_hold_back_later_events(self, app):
+        """Test that an event is not read past an older transaction that is still open"""
+        from services.visit_events import fetch_events, current_position
+        
+        with app.app_context():
+            with db.engine.connect() as connection:
+                start = current_position(connection)
+            
+            # 先开始的事务还没提交
+            older = db.engine.connect()
+            older_tx = older.begin()
+            older.execute(db.text("SELECT pg_current_xact_id()"))
+            create_visit(app)
+            
+            with db.engine.connect() as connection:
+                events, more = fetch_events(connection, start, 100)
+            assert events == [] and more
+            
+            older_tx.commit()
+            older.close()
+            with db.engine.connect() as connection:
+                events, more = fetch_events(connection, start, 100)
+            assert len(events) == 1 and not more
+    
+    def test_stream_pushes_new_visits(self, client, app, staff_token):
+        """Test that a connected client receives a visit created after it subscribed"""
+        chunks = self.open_stream(client, staff_token)
+        visit_id = create_visit(app, visit_date=datetime(2025, 7, 1))
+        
+        [(_, name, data)] = self.read_events(chunks, 1)
+        assert name == 'message'
+        assert data['event'] == 'created'
+        assert data['visit']['id'] == visit_id
+        assert data['visit']['patient_name'] == 'Test Patient'
+    
+    def test_resume_from_last_event_id(self, client, app, staff_token):
+        """Test that reconnecting with Last-Event-ID replays only missed events"""
+        from services.visit_events import broadcaster
+        
+        chunks = self.open_stream(client, staff_token)
+        create_visit(app)
+        [(last_id, _, _)] = self.read_events(chunks, 1)
+        
+        # 断开期间的事件（重启监听线程后缓冲区里没有，需要从表里补读）
+        broadcaster.stop()
+        missed = [create_visit(app), create_visit(app)]
+        
+        resumed = self.read_events(self.open_stream(client, staff_token, last_id), 2)
+        assert [data['visit']['id'] for _, _, data in resumed] == missed
+    
+    def test_resume_too_far_behind_sends_reset(self, client, app, staff_token):
+        """Test that a client missing more than the resume limit is told to reload"""
+        from services.visit_events import broadcaster, current_position, format_position
+        
+        with app.app_context(), db.engine.connect() as connection:
+            start = format_position(current_position(connection))
+        app.config['VISIT_EVENTS_RESUME_MAX'] = 1
+        for _ in range(3):
+            create_visit(app)
+        
+        [(_, name, _)] = self.read_events(self.open_stream(client, staff_token, start), 1)
+        assert name == 'reset'
+    
+    def test_stream_requires_staff(self, client, patient_token, staff_token):
+        """Test access control and Last-Event-ID validation"""
+        response = client.get('/api/visit/events', headers={'Authorization': f'Bearer {patient_token}'})
+        assert response.status_code == 403
+        response = client.get('/api/visit/events', headers={
+            'Authorization': f'Bearer {staff_token}', 'Last-Event-ID': 'garbage'
+        })
+        assert response.status_code == 400
+
+class TestExport:
+    """Test the streaming patient/visit/symptom export"""
+    
+    def export(self, client, token, path):
+        return client.get(f'/api/export/{path}', headers={'Authorization': f'Bearer {token}'})
+    
+    def set_ssn(self, app, ssn='123-45-6789'):
+        from security.encryption import encrypt_data
+        
+        with app.app_context():
+            patient = Patient.query.first()
+            patient.encrypted_ssn = encrypt_data(ssn)
+            db.session.commit()
+    
+    def test_patients_csv_without_encrypted_fields(self, client, app, staff_token):
+        """Test CSV export of patients leaves out SSN unless asked for"""
+        import csv
+        import io
+        
+        self.set_ssn(app)
+        response = self.export(client, staff_token, 'patients')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/csv'
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        assert [row['full_name'] for row in rows] == ['Test Patient']
+        assert rows[0]['email'] == 'patient@test.com'
+        assert 'ssn' not in rows[0]
+    
+    def test_decrypt_requires_explicit_role(self, client, app, staff_token):
+        """Test decrypted fields need the role listed in EXPORT_DECRYPT_ROLES"""
+        import json
+        
+        self.set_ssn(app)
+        assert self.export(client, staff_token, 'patients?decrypt=true').status_code == 403
+        
+        app.config['EXPORT_DECRYPT_ROLES'] = ['staff']
+        try:
+            response = self.export(client, staff_token, 'patients?decrypt=true&format=ndjson')
+        finally:
+            app.config['EXPORT_DECRYPT_ROLES'] = []
+        assert response.status_code == 200
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert rows[0]['ssn'] == '123-45-6789'
+    
+    def test_gzip_ndjson_visits_stream_in_batches(self, client, app, staff_token):
+        """Test gzip NDJSON output arrives incrementally and filters by date"""
+        import gzip
+        import json
+        
+        for day in range(1, 6):
+            create_visit(app, visit_date=datetime(2025, 8, day), symptoms=['cough', 'fever'])
+        
+        app.config['EXPORT_BATCH_SIZE'] = 2
+        try:
+            response = client.get('/api/export/visits?format=ndjson&gzip=true&since=2025-08-02',
+                                  headers={'Authorization': f'Bearer {staff_token}'}, buffered=False)
+            chunks = list(response.response)
+        finally:
+            app.config['EXPORT_BATCH_SIZE'] = 1000
+        
+        assert response.mimetype == 'application/gzip'
+        assert len(chunks) > 1
+        rows = [json.loads(line) for line in gzip.decompress(b''.join(chunks)).splitlines()]
+        assert [row['visit_date'][:10] for row in rows] == [f'2025-08-0{day}' for day in range(2, 6)]
+        assert rows[0]['symptoms'] == ['cough', 'fever']
+    
+    def test_symptoms_one_row_per_symptom(self, client, app, staff_token):
+        """Test the symptoms dataset unnests the JSON array"""
+        import json
+        
+        create_visit(app, symptoms=['cough', 'fever'])
+        create_visit(app, symptoms={'unexpected': 'shape'})
+        
+        response = self.export(client, staff_token, 'symptoms?format=ndjson')
+        assert response.status_code == 200
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert sorted(row['symptom'] for row in rows) == ['cough', 'fever']
+    
+    def test_patient_cannot_export(self, client, patient_token):
+        """Test that patients have no export permission"""
+        assert self.export(client, patient_token, 'visits').status_code == 403
+    
+    def test_cli_export(self, app, tmp_path):
+        """Test the CLI writes the same export to a file and audits it"""
+        from models import AuditLog
+        
+        create_visit(app)
+        output = tmp_path / 'visits.csv'
+        result = app.test_cli_runner().invoke(args=['export', 'run', 'visits', '-o', str(output)])
+        assert result.exit_code == 0, result.output
+        assert output.read_text().splitlines()[0].startswith('id,patient_id,visit_date')
+        assert len(output.read_text().splitlines()) == 2
+        with app.app_context():
+            assert AuditLog.query.filter_by(action='export', resource_type='visits').count() == 1
+
+class TestTriageQueue:
+    """Test the triage queue of waiting visits"""
+    
+    def queue(self, client, token, query=''):
+        return client.get(f'/api/visit/triage{query}', headers={'Authorization': f'Bearer {token}'})
+    
+    def test_ordered_by_pain_then_wait(self, client, app, staff_token):
+        """Test higher pain first, then earlier arrival; finished visits drop out"""
+        low = create_visit(app, visit_date=datetime(2025, 10, 1, 8), pain_level=3)
+        high_late = create_visit(app, visit_date=datetime(2025, 10, 1, 10), pain_level=8)
+        high_early = create_visit(app, visit_date=datetime(2025, 10, 1, 9), pain_level=8, status='confirmed')
+        unscored = create_visit(app, visit_date=datetime(2025, 10, 1, 7))
+        done = create_visit(app, visit_date=datetime(2025, 10, 1, 6), pain_level=10, status='completed')
+        
+        response = self.queue(client, staff_token)
+        assert response.status_code == 200
+        assert [entry['id'] for entry in response.json['queue']] == [high_early, high_late, low, unscored]
+        assert response.json['queue'][0]['position'] == 1
+        assert response.json['waiting'] == 4
+        assert done not in [entry['id'] for entry in response.json['queue']]
+        
+        with app.app_context():
+            db.session.get(Visit, high_early).status = 'completed'
+            db.session.commit()
+        response = self.queue(client, staff_token, '?limit=2')
+        assert [entry['id'] for entry in response.json['queue']] == [high_late, low]
+        assert response.json['waiting'] == 3
+    
+    def test_served_from_partial_index(self, app):
+        """Test that the top-K query reads the partial index without sorting"""
+        from services.triage import _queued, _queue_order
+        
+        with app.app_context():
+            # 空表上规划器倾向位图扫描，这里只验证索引能直接给出有序结果
+            db.session.execute(db.text('SET LOCAL enable_seqscan = off'))
+            db.session.execute(db.text('SET LOCAL enable_bitmapscan = off'))
+            query = db.select(Visit.id).where(_queued()).order_by(*_queue_order()).limit(10)
+            compiled = query.compile(db.engine, compile_kwargs={'literal_binds': True})
+            plan = '\n'.join(db.session.execute(db.text(f'EXPLAIN {compiled}')).scalars().all())
+            db.session.rollback()
+        
+        assert 'ix_visits_triage_queue' in plan
+        assert '->  Sort' not in plan
+    
+    def test_confirmation_reports_queue_position(self, client, app, patient_token):
+        """Test submit_confirmation confirms the visit and records its place in the queue"""
+        create_visit(app, visit_date=datetime(2025, 10, 1, 8), pain_level=9)
+        visit_id = create_visit(app, visit_date=datetime(2025, 10, 1, 9), pain_level=5)
+        with client.session_transaction() as flask_session:
+            flask_session['current_visit_id'] = visit_id
+        
+        response = client.post('/submit_confirmation', headers={'Authorization': f'Bearer {patient_token}'})
+        assert response.status_code == 302
+        with client.session_transaction() as flask_session:
+            assert flask_session['queue_position'] == 2
+        with app.app_context():
+            assert db.session.get(Visit, visit_id).status == 'confirmed'
+        
+        page = client.get('/appointment_confirmation')
+        assert b'1 ahead of you' in page.data
+    
+    def test_cannot_confirm_another_patients_visit(self, client, app, patient_token):
+        """Test the confirmation only applies to the caller's own visit"""
+        create_patient(app, 'triage_other')
+        visit_id = create_visit(app, username='triage_other')
+        with client.session_transaction() as flask_session:
+            flask_session['current_visit_id'] = visit_id
+        
+        client.post('/submit_confirmation', headers={'Authorization': f'Bearer {patient_token}'})
+        with app.app_context():
+            assert db.session.get(Visit, visit_id).status == 'pending'
+    
+    def test_patient_cannot_view_queue(self, client, patient_token):
+        """Test the queue is staff only"""
+        assert self.queue(client, patient_token).status_code == 403
+
+class TestBulkStatus:
+    """Test bulk visit status transitions"""
+    
+    def post(self, client, token, body):
+        return client.post('/api/visit/status', json=body, headers={'Authorization': f'Bearer {token}'})
+    
+    def test_single_update_with_one_audit_record(self, client, app, staff_token):
+        """Test valid transitions apply in one UPDATE, invalid ones are skipped, audit is batched"""
+        from sqlalchemy import event
+        from models import AuditLog, VisitEvent
+        
+        pending = create_visit(app)
+        confirmed = create_visit(app, status='confirmed')
+        cancelled = create_visit(app, status='cancelled')
+        
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            try:
+                response = self.post(client, staff_token, {
+                    'visit_ids': [pending, confirmed, cancelled, 99999], 'status': 'completed'
+                })
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', listener)
+        
+        assert response.status_code == 200
+        assert [(item['id'], item['from']) for item in response.json['updated']] == \
+            [(pending, 'pending'), (confirmed, 'confirmed')]
+        assert response.json['skipped'] == [{'id': cancelled, 'status': 'cancelled'}, {'id': 99999, 'status': None}]
+        assert len([s for s in statements if s.lstrip().startswith('UPDATE visits')]) == 1
+        
+        with app.app_context():
+            assert {v.id: v.status for v in Visit.query.all()} == {
+                pending: 'completed', confirmed: 'completed', cancelled: 'cancelled'
+            }
+            logs = AuditLog.query.filter_by(action='bulk_update').all()
+            assert len(logs) == 1
+            assert logs[0].details['updated'] == [pending, confirmed]
+            # SSE订阅者同样收到状态变化
+            assert VisitEvent.query.filter_by(event='status_changed', status='completed').count() == 2
+    
+    def test_rejects_bad_requests(self, client, staff_token, patient_token):
+        """Test validation and access control"""
+        assert self.post(client, staff_token, {'visit_ids': [1], 'status': 'done'}).status_code == 400
+        assert self.post(client, staff_token, {'visit_ids': [1], 'status': ['completed']}).status_code == 400
+        assert self.post(client, staff_token, {'visit_ids': [1], 'status': {'a': 1}}).status_code == 400
+        # 没有任何状态能流转到pending
+        response = self.post(client, staff_token, {'visit_ids': [1], 'status': 'pending'})
+        assert response.status_code == 400
+        assert 'confirmed, completed, cancelled' in response.json['error']
+        assert self.post(client, staff_token, {'visit_ids': [], 'status': 'completed'}).status_code == 400
+        assert self.post(client, staff_token, {'visit_ids': ['1'], 'status': 'completed'}).status_code == 400
+        assert self.post(client, patient_token, {'visit_ids': [1], 'status': 'completed'}).status_code == 403
+    
+    def test_invalidates_dashboard_cache(self, client, app, staff_token):
+        """Test the recent visits cache reflects a bulk transition"""
+        visit_id = create_visit(app)
+        headers = {'Authorization': f'Bearer {staff_token}'}
+        assert client.get('/api/visit/recent', headers=headers).json['visits'][0]['status'] == 'pending'
+        
+        self.post(client, staff_token, {'visit_ids': [visit_id], 'status': 'confirmed'})
+        assert client.get('/api/visit/recent', headers=headers).json['visits'][0]['status'] == 'confirmed'
+
+class TestSymptomSearch:
+    """Test symptom containment search and per-bucket symptom counts"""
+    
+    def get(self, client, token, path, query=''):
+        return client.get(f'/api/visit/symptoms/{path}{query}', headers={'Authorization': f'Bearer {token}'})
+    
+    def test_search_is_case_insensitive_and_paginated(self, client, app, staff_token):
+        """Test every given symptom must be present, in any case, across keyset pages"""
+        first = create_visit(app, visit_date=datetime(2025, 10, 1, 8), symptoms=['Headache', 'Nausea'])
+        second = create_visit(app, visit_date=datetime(2025, 10, 1, 9), symptoms=['headache', 'nausea', 'fever'])
+        create_visit(app, visit_date=datetime(2025, 10, 1, 10), symptoms=['headache'])
+        create_visit(app, visit_date=datetime(2025, 10, 1, 11), possible_causes=['Migraine'])
+        
+        response = self.get(client, staff_token, 'search', '?symptom=HEADACHE&symptom=nausea&limit=1')
+        assert response.status_code == 200
+        assert [visit['id'] for visit in response.json['visits']] == [second]
+        
+        cursor = response.json['next_cursor']
+        response = self.get(client, staff_token, 'search', f'?symptom=HEADACHE&symptom=nausea&limit=1&cursor={cursor}')
+        assert [visit['id'] for visit in response.json['visits']] == [first]
+        assert response.json['next_cursor'] is None
+        
+        response = self.get(client, staff_token, 'search', '?symptom=migraine&field=possible_causes')
+        assert len(response.json['visits']) == 1
+        # 只匹配整项，不做子串匹配
+        assert self.get(client, staff_token, 'search', '?symptom=head').json['visits'] == []
+    
+    def test_search_uses_gin_index(self, app):
+        """Test the containment query matches the expression index"""
+        from services.symptoms import lowered
+        
+        with app.app_context():
+            db.session.execute(db.text('SET LOCAL enable_seqscan = off'))
+            query = db.select(Visit.id).where(lowered('symptoms').op('@>')(db.func.jsonb_build_array('fever')))
+            compiled = query.compile(db.engine, compile_kwargs={'literal_binds': True})
+            plan = '\n'.join(db.session.execute(db.text(f'EXPLAIN {compiled}')).scalars().all())
+            db.session.rollback()
+        
+        assert 'ix_visits_symptoms_lower' in plan
+    
+    def test_top_symptoms_per_bucket(self, client, app, staff_token):
+        """Test counts are per day, case-folded, and limited per bucket"""
+        create_visit(app, visit_date=datetime(2025, 10, 1, 8), symptoms=['Fever', 'Cough'])
+        create_visit(app, visit_date=datetime(2025, 10, 1, 9), symptoms=['fever', ' fever '])
+        create_visit(app, visit_date=datetime(2025, 10, 2, 9), symptoms=['Rash'])
+        create_visit(app, visit_date=datetime(2025, 10, 2, 10), symptoms='not a list')
+        
+        response = self.get(client, staff_token, 'top', '?since=2025-10-01T12:00:00&until=2025-10-03&limit=1')
+        assert response.status_code == 200
+        assert response.json['buckets'] == [
+            {'start': '2025-10-01T00:00:00', 'symptoms': [{'symptom': 'fever', 'visits': 2}]},
+            {'start': '2025-10-02T00:00:00', 'symptoms': [{'symptom': 'rash', 'visits': 1}]},
+        ]
+        
+        response = self.get(client, staff_token, 'top', '?since=2025-10-01&until=2025-10-03&bucket=week')
+        assert response.json['buckets'] == [
+            {'start': '2025-09-29T00:00:00', 'symptoms': [
+                {'symptom': 'fever', 'visits': 2}, {'symptom': 'cough', 'visits': 1}, {'symptom': 'rash', 'visits': 1}
+            ]}
+        ]
+    
+    def test_closed_buckets_are_cached(self, app):
+        """Test finished buckets are served from the cache and the open bucket is recomputed"""
+        from services.symptoms import top_symptoms, symptom_stats_cache
+        
+        create_visit(app, visit_date=datetime(2025, 10, 1, 8), symptoms=['fever'])
+        now = datetime(2025, 10, 2, 12)
+        with app.app_context():
+            top_symptoms(datetime(2025, 10, 1), now, now=now)
+            hits = symptom_stats_cache.stats()['hits']
+            
+            db.session.add(Visit(patient_id=Patient.query.first().id, visit_reason='Cough',
+                                 visit_date=datetime(2025, 10, 2, 9), symptoms=['cough']))
+            db.session.commit()
+            buckets = top_symptoms(datetime(2025, 10, 1), now, now=now)
+        
+        assert symptom_stats_cache.stats()['hits'] == hits + 1
+        assert [item['symptoms'] for item in buckets] == [
+            [{'symptom': 'fever', 'visits': 1}], [{'symptom': 'cough', 'visits': 1}]
+        ]
+    
+    def test_rejects_bad_requests(self, client, staff_token, patient_token):
+        """Test validation and access control"""
+        assert self.get(client, staff_token, 'search').status_code == 400
+        assert self.get(client, staff_token, 'search', '?symptom=fever&field=visit_reason').status_code == 400
+        assert self.get(client, staff_token, 'top', '?bucket=month').status_code == 400
+        assert self.get(client, staff_token, 'top', '?since=2025-10-02&until=2025-10-01').status_code == 400
+        assert self.get(client, staff_token, 'top', '?since=2020-01-01&until=2025-01-01').status_code == 400
+        assert self.get(client, patient_token, 'search', '?symptom=fever').status_code == 403
+        assert self.get(client, patient_token, 'top').status_code == 403
+
+class TestVisitRollups:
+    """Test incrementally maintained daily visit rollups"""
+    
+    def rollups(self):
+        from models import VisitDailyCount, VisitDailyWait
+        
+        counts = {(row.day, row.status, row.pain_level, row.duration): row.visits
+                  for row in VisitDailyCount.query.all() if row.visits}
+        waits = {row.day: (row.confirmed, row.wait_seconds) for row in VisitDailyWait.query.all() if row.confirmed}
+        return counts, waits
+    
+    def test_incremental_updates_match_rebuild(self, client, app, staff_token):
+        """Test creates, edits, bulk transitions and deletes keep the rollups equal to a full rebuild"""
+        from services.visit_rollups import rebuild_rollups
+        
+        first = create_visit(app, visit_date=datetime(2025, 10, 1, 8), pain_level=7, pain_duration='days')
+        second = create_visit(app, visit_date=datetime(2025, 10, 1, 9))
+        third = create_visit(app, visit_date=datetime(2025, 10, 2, 9), pain_level=3, pain_duration='a while')
+        gone = create_visit(app, visit_date=datetime(2025, 10, 2, 10))
+        
+        with app.app_context():
+            visit = db.session.get(Visit, second)
+            visit.pain_level, visit.pain_duration = 5, 'hours'
+            visit.status = 'confirmed'
+            visit.confirmed_at = datetime(2025, 10, 1, 9, 30)
+            db.session.delete(db.session.get(Visit, gone))
+            db.session.commit()
+        
+        client.post('/api/visit/status', json={'visit_ids': [first, third], 'status': 'confirmed'},
+                    headers={'Authorization': f'Bearer {staff_token}'})
+        with app.app_context():
+            # 批量修改后被expire的status再次修改，旧值仍然从汇总里减掉
+            visit = db.session.get(Visit, first)
+            db.session.expire(visit, ['status'])
+            visit.status = 'completed'
+            db.session.commit()
+            
+            counts, waits = self.rollups()
+            assert counts == {
+                (datetime(2025, 10, 1).date(), 'completed', 7, 'days'): 1,
+                (datetime(2025, 10, 1).date(), 'confirmed', 5, 'hours'): 1,
+                (datetime(2025, 10, 2).date(), 'confirmed', 3, 'other'): 1,
+            }
+            assert waits[datetime(2025, 10, 1).date()][0] == 2
+            assert db.session.get(Visit, first).confirmed_at is not None
+            
+            rebuild_rollups(log=lambda msg: None)
+            assert self.rollups() == (counts, waits)
+    
+    def test_daily_stats_read_rollups_only(self, client, app, staff_token):
+        """Test the chart endpoint answers from the rollup tables without touching visits"""
+        from sqlalchemy import event
+        
+        create_visit(app, visit_date=datetime(2025, 10, 1, 8), pain_level=6, pain_duration='day',
+                     status='confirmed', confirmed_at=datetime(2025, 10, 1, 8, 30))
+        create_visit(app, visit_date=datetime(2025, 10, 1, 9), status='confirmed', confirmed_at=datetime(2025, 10, 1, 10))
+        create_visit(app, visit_date=datetime(2025, 10, 3, 9), pain_level=6)
+        
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            try:
+                response = client.get('/api/visit/stats/daily?days=3&until=2025-10-04',
+                                      headers={'Authorization': f'Bearer {staff_token}'})
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', listener)
+        
+        assert response.status_code == 200
+        assert not any('FROM visits' in s for s in statements)
+        first, empty, last = response.json['days']
+        assert first == {
+            'day': '2025-10-01', 'visits': 2,
+            'by_status': {'confirmed': 2}, 'by_pain_level': {'6': 1, 'unknown': 1}, 'by_duration': {'day': 1, 'unknown': 1},
+            'confirmed': 2, 'avg_wait_minutes': 45.0
+        }
+        assert empty['day'] == '2025-10-02' and empty['visits'] == 0 and empty['avg_wait_minutes'] is None
+        assert last['by_status'] == {'pending': 1}
+    
+    def test_rebuild_command_repairs_drift(self, app):
+        """Test the CLI recomputes rollups from visits"""
+        from models import VisitDailyCount
+        
+        create_visit(app, visit_date=datetime(2025, 10, 1, 8))
+        with app.app_context():
+            expected = self.rollups()
+            db.session.execute(db.update(VisitDailyCount).values(visits=42))
+            db.session.commit()
+        
+        result = app.test_cli_runner().invoke(args=['visits', 'rebuild-rollups', '--batch-days', '1'])
+        assert result.exit_code == 0, result.output
+        with app.app_context():
+            assert self.rollups() == expected
+    
+    def test_rejects_bad_requests(self, client, staff_token, patient_token):
+        """Test validation and access control"""
+        assert client.get('/api/visit/stats/daily?until=tomorrow',
+                          headers={'Authorization': f'Bearer {staff_token}'}).status_code == 400
+        assert client.get('/api/visit/stats/daily',
+                          headers={'Authorization': f'Bearer {patient_token}'}).status_code == 403
+
+class FakeSpeechProvider:
+    """Local stand-in for AssemblyAI + Perplexity that can fail a number of times first"""
+    
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = []
+    
+    def __call__(self, audio_path, content_hash=None):
+        self.calls.append(audio_path)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('provider unavailable')
+        return {
+            'text': 'I have had a fever since yesterday',
+            'analysis': {'symptoms': ['Fever'], 'possible causes': ['Flu']},
+            'analysis_filename': 'analysis_test.txt'
+        }
+
+class TestAudioJobs:
+    """Test the asynchronous /api/process_audio job pipeline"""
+    
+    @pytest.fixture(autouse=True)
+    def provider(self, app, monkeypatch):
+        from services import ai_service
+        from services.audio_jobs import audio_workers
+        
+        provider = FakeSpeechProvider()
+        monkeypatch.setattr(ai_service, 'process_audio_file', provider)
+        app.config.update({'AUDIO_JOB_RETRY_BASE_SECONDS': 30, 'AUDIO_JOB_MAX_ATTEMPTS': 2,
+                           'AUDIO_JOB_POLL_INTERVAL': 0.05})
+        self.uploaded = []
+        yield provider
+        
+        audio_workers.stop()
+        for filename in self.uploaded:
+            path = os.path.join(app.config['AUDIO_FOLDER'], filename)
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def upload(self, client, token):
+        import io
+        
+        response = client.post('/api/process_audio', data={'audio': (io.BytesIO(b'RIFF....WAVE'), 'recording.wav')},
+                               headers={'Authorization': f'Bearer {token}'}, content_type='multipart/form-data')
+        if response.status_code == 202:
+            from models import AudioJob
+            with client.application.app_context():
+                self.uploaded.append(db.session.get(AudioJob, response.json['job_id']).audio_file_path)
+        return response
+    
+    def status(self, client, token, job_id):
+        return client.get(f'/api/process_audio/{job_id}', headers={'Authorization': f'Bearer {token}'})
+    
+    def test_upload_returns_job_and_worker_creates_visit(self, client, app, patient_token, provider):
+        """Test the upload answers 202 immediately and the job later creates the visit"""
+        import hashlib
+        from services.audio_jobs import run_next_job
+        from models import AuditLog, AudioJob
+        
+        response = self.upload(client, patient_token)
+        assert response.status_code == 202
+        assert response.headers['Location'] == response.json['status_url']
+        assert response.json['status'] == 'queued'
+        assert provider.calls == []
+        job_id = response.json['job_id']
+        
+        assert self.status(client, patient_token, job_id).json['status'] == 'queued'
+        with app.app_context():
+            # 上传时已经算好内容哈希，交给转录缓存
+            assert db.session.get(AudioJob, job_id).audio_sha256 == hashlib.sha256(b'RIFF....WAVE').hexdigest()
+            assert run_next_job() is True
+            assert run_next_job() is False
+        
+        response = self.status(client, patient_token, job_id)
+        assert response.json['success'] is True
+        assert response.json['analysis']['symptoms'] == ['Fever']
+        with client.session_transaction() as flask_session:
+            assert flask_session['current_visit_id'] == response.json['visit_id']
+            assert flask_session['symptoms'] == 'Fever'
+        with app.app_context():
+            visit = db.session.get(Visit, response.json['visit_id'])
+            assert visit.voice_transcription == 'I have had a fever since yesterday'
+            assert AuditLog.query.filter_by(action='create', resource_type='visit', resource_id=visit.id).count() == 1
+    
+    def test_failures_retry_with_backoff_then_fail(self, client, app, patient_token, provider):
+        """Test a failed attempt is re-queued after a delay and gives up after the attempt limit"""
+        from services.audio_jobs import run_next_job
+        from models import AudioJob
+        
+        provider.failures = 5
+        job_id = self.upload(client, patient_token).json['job_id']
+        with app.app_context():
+            run_next_job()
+            job = db.session.get(AudioJob, job_id)
+            assert (job.status, job.attempts) == ('queued', 1)
+            assert job.next_attempt_at > datetime.utcnow()
+            assert 'provider unavailable' in job.last_error
+            # 还没到重试时间
+            assert run_next_job() is False
+            
+            job.next_attempt_at = datetime.utcnow()
+            db.session.commit()
+            run_next_job()
+        
+        response = self.status(client, patient_token, job_id)
+        assert (response.json['status'], response.json['attempts']) == ('failed', 2)
+        assert 'provider' not in response.json['error']
+        assert len(provider.calls) == 2
+    
+    def test_expired_lease_is_reclaimed_once(self, client, app, patient_token):
+        """Test a job abandoned by a crashed worker is retried and the stale attempt cannot commit"""
+        from services.audio_jobs import claim_next_job, run_next_job, _complete
+        from models import AudioJob
+        
+        job_id = self.upload(client, patient_token).json['job_id']
+        with app.app_context():
+            assert claim_next_job()[:2] == (job_id, 1)
+            # 租约未到期时不会被再次领取
+            assert run_next_job() is False
+            
+            db.session.execute(db.update(AudioJob).values(next_attempt_at=datetime.utcnow()))
+            db.session.commit()
+            assert run_next_job() is True
+            
+            _complete(job_id, 1, FakeSpeechProvider()(None))
+            job = db.session.get(AudioJob, job_id)
+            assert (job.status, job.attempts) == ('succeeded', 2)
+            assert Visit.query.count() == 1
+    
+    def test_background_workers_and_event_stream(self, client, app, patient_token):
+        """Test the thread pool picks up a new job and the SSE stream ends on completion"""
+        from services.audio_jobs import audio_workers
+        
+        audio_workers.start(app, workers=2)
+        job_id = self.upload(client, patient_token).json['job_id']
+        
+        response = client.get(f'/api/process_audio/{job_id}/events', headers={'Authorization': f'Bearer {patient_token}'})
+        assert response.mimetype == 'text/event-stream'
+        body = response.get_data(as_text=True)
+        assert '"status": "succeeded"' in body.split('event: status')[-1]
+    
+    def test_only_owner_can_read_job(self, client, app, patient_token, staff_token):
+        """Test jobs are private to the uploading patient"""
+        job_id = self.upload(client, patient_token).json['job_id']
+        
+        assert self.status(client, staff_token, job_id).status_code == 403
+        assert self.status(client, patient_token, job_id + 1000).status_code == 404
+        assert client.get(f'/api/process_audio/{job_id}/events',
+                          headers={'Authorization': f'Bearer {staff_token}'}).status_code == 403
+
+class TestTranscriptionCache:
+    """Test the content-hash transcription cache"""
+    
+    @pytest.fixture(autouse=True)
+    def transcriber(self, app, monkeypatch):
+        from services import ai_service
+        
+        class FakeTranscriber:
+            calls = []
+            
+            def __init__(self, config=None):
+                self.config = config
+            
+            def transcribe(self, audio_path):
+                FakeTranscriber.calls.append((audio_path, self.config))
+                text = None if open(audio_path, 'rb').read() == b'broken' else f'transcript {len(FakeTranscriber.calls)}'
+                return type('Transcript', (), {'text': text})()
+        
+        monkeypatch.setattr(ai_service.aai, 'Transcriber', FakeTranscriber)
+        monkeypatch.setitem(app.config, 'ASSEMBLYAI_LANGUAGE_CODE', None)
+        return FakeTranscriber
+    
+    def recording(self, tmp_path, name, data):
+        path = tmp_path / name
+        path.write_bytes(data)
+        return str(path)
+    
+    def test_identical_audio_is_transcribed_once(self, app, tmp_path, transcriber):
+        """Test a re-uploaded recording is answered from the cache without a provider call"""
+        from services.ai_service import transcribe_audio
+        from services.transcription_cache import save_and_hash
+        from models import Transcription
+        import hashlib
+        import io
+        
+        first = self.recording(tmp_path, 'first.wav', b'RIFF-same-audio')
+        content_hash, size = save_and_hash(io.BytesIO(b'RIFF-same-audio'), str(tmp_path / 'retry.wav'))
+        assert content_hash == hashlib.sha256(b'RIFF-same-audio').hexdigest() and size == 15
+        
+        with app.app_context():
+            assert transcribe_audio(first) == 'transcript 1'
+            assert transcribe_audio(str(tmp_path / 'retry.wav'), content_hash) == 'transcript 1'
+            assert len(transcriber.calls) == 1
+            assert Transcription.query.filter_by(content_hash=content_hash).one().hits == 1
+    
+    def test_settings_and_content_are_part_of_the_key(self, app, tmp_path, transcriber):
+        """Test different audio or provider settings miss, and failed transcriptions are not cached"""
+        from services.ai_service import transcribe_audio
+        
+        audio = self.recording(tmp_path, 'a.wav', b'audio-a')
+        with app.app_context():
+            transcribe_audio(audio)
+            transcribe_audio(self.recording(tmp_path, 'b.wav', b'audio-b'))
+            app.config['ASSEMBLYAI_LANGUAGE_CODE'] = 'es'
+            transcribe_audio(audio)
+            assert transcriber.calls[-1][1].language_code == 'es'
+            
+            broken = self.recording(tmp_path, 'broken.wav', b'broken')
+            assert transcribe_audio(broken) is None
+            transcribe_audio(broken)
+        
+        assert len(transcriber.calls) == 5
+    
+    def test_prune_removes_unused_entries(self, app, tmp_path):
+        """Test entries not used within the retention window are deleted"""
+        from services.ai_service import transcribe_audio
+        from models import Transcription
+        
+        with app.app_context():
+            transcribe_audio(self.recording(tmp_path, 'old.wav', b'old'))
+            transcribe_audio(self.recording(tmp_path, 'new.wav', b'new'))
+            db.session.execute(db.update(Transcription).where(Transcription.text == 'transcript 1')
+                               .values(last_used_at=datetime(2020, 1, 1)))
+            db.session.commit()
+        
+        result = app.test_cli_runner().invoke(args=['audio-jobs', 'prune-transcriptions', '--retain-days', '30'])
+        assert 'Deleted 1 transcription(s)' in result.output
+        with app.app_context():
+            assert [row.text for row in Transcription.query.all()] == ['transcript 2']
+
+class TestAnalysisCache:
+    """Test memoization of analyze_symptoms results"""
+    
+    @pytest.fixture(autouse=True)
+    def model(self, app, monkeypatch):
+        from services import ai_service
+        
+        class FakeCompletions:
+            calls = []
+            reply = '{"symptoms": ["Headache"], "possible causes": ["Tension"]}'
+            
+            def create(self, model, messages):
+                FakeCompletions.calls.append((model, messages[-1]['content']))
+                message = type('Message', (), {'content': FakeCompletions.reply})()
+                return type('Response', (), {'choices': [type('Choice', (), {'message': message})()]})()
+        
+        class FakeClient:
+            def __init__(self, api_key=None, base_url=None):
+                self.chat = type('Chat', (), {'completions': FakeCompletions()})()
+        
+        monkeypatch.setattr(ai_service, 'OpenAI', FakeClient)
+        return FakeCompletions
+    
+    def test_near_identical_transcripts_share_an_entry(self, app, model):
+        """Test case, punctuation and spacing differences hit the in-process layer"""
+        from services.ai_service import analyze_symptoms
+        from services.analysis_cache import analysis_cache_stats
+        
+        with app.app_context():
+            before = analysis_cache_stats()
+            first = analyze_symptoms('I have a headache.')
+            first['symptoms'].append('mutated by caller')
+            assert analyze_symptoms('i have a   HEADACHE') == {'symptoms': ['Headache'], 'possible causes': ['Tension']}
+            analyze_symptoms('I have a fever')
+            after = analysis_cache_stats()
+        
+        assert len(model.calls) == 2
+        assert after['memory']['hits'] - before['memory']['hits'] == 1
+        assert after['provider_calls'] - before['provider_calls'] == 2
+    
+    def test_database_layer_is_shared(self, app, model):
+        """Test a cold in-process cache is refilled from the table without a model call"""
+        from services.ai_service import analyze_symptoms
+        from services.analysis_cache import analysis_cache_stats
+        from services.cache import clear_caches
+        from models import SymptomAnalysis
+        
+        with app.app_context():
+            analyze_symptoms('My knee hurts')
+            clear_caches()
+            before = analysis_cache_stats()['db']['hits']
+            assert analyze_symptoms('my knee hurts!') == {'symptoms': ['Headache'], 'possible causes': ['Tension']}
+            assert analysis_cache_stats()['db']['hits'] == before + 1
+            assert SymptomAnalysis.query.one().hits == 1
+            
+            # 过期的条目不再命中
+            db.session.execute(db.update(SymptomAnalysis).values(expires_at=datetime(2020, 1, 1)))
+            db.session.commit()
+            clear_caches()
+            analyze_symptoms('My knee hurts')
+        
+        assert len(model.calls) == 2
+    
+    def test_prompt_version_bump_invalidates(self, app, model, monkeypatch):
+        """Test a new prompt version misses and pruning drops the old version's rows"""
+        from services import ai_service
+        from services.analysis_cache import prune_analyses
+        from models import SymptomAnalysis
+        
+        with app.app_context():
+            ai_service.analyze_symptoms('I have a headache')
+            monkeypatch.setattr(ai_service, 'ANALYSIS_PROMPT_VERSION', 2)
+            ai_service.analyze_symptoms('I have a headache')
+            assert len(model.calls) == 2
+            
+            assert prune_analyses(2, max_entries=10) == 1
+            assert [row.prompt_version for row in SymptomAnalysis.query.all()] == [2]
+    
+    def test_prune_keeps_most_recently_used(self, app, model):
+        """Test LRU trimming of the shared table"""
+        from services.ai_service import analyze_symptoms, ANALYSIS_PROMPT_VERSION
+        from services.analysis_cache import prune_analyses
+        from models import SymptomAnalysis
+        
+        with app.app_context():
+            for text in ('cough', 'fever', 'rash'):
+                analyze_symptoms(text)
+            db.session.execute(db.update(SymptomAnalysis).values(last_used_at=datetime(2025, 1, 1)))
+            db.session.commit()
+            analyze_symptoms('sore throat')
+            
+            assert prune_analyses(ANALYSIS_PROMPT_VERSION, max_entries=1) == 3
+            assert SymptomAnalysis.query.count() == 1
+    
+    def test_unparseable_reply_is_not_cached(self, client, app, model, staff_token):
+        """Test fallback results are recomputed and stats are exposed"""
+        from services.ai_service import analyze_symptoms
+        
+        model.reply = 'Sorry, I cannot help with that.'
+        with app.app_context():
+            analyze_symptoms('I feel dizzy')
+            analyze_symptoms('I feel dizzy')
+        assert len(model.calls) == 2
+        
+        response = client.get('/api/auth/cache-stats', headers={'Authorization': f'Bearer {staff_token}'})
+        assert 'hit_ratio' in response.json['symptom_analysis']
+        assert 'symptom_analysis' in response.json['caches']
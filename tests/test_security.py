@@ -2,6 +2,7 @@ import pytest
 from security.encryption import encrypt_data, decrypt_data
 from security.rbac import check_permission
 from flask import g
+from datetime import datetime
 
 class TestEncryption:
     """Test data encryption functionality"""
@@ -54,6 +55,153 @@ class TestEncryption:
             assert decrypt_data(encrypted1) == data
             assert decrypt_data(encrypted2) == data
 
+class TestKeyRotation:
+    """Test cached cipher, MultiFernet rotation and batched re-encryption"""
+    
+    def test_cipher_is_cached_per_key(self, app):
+        """Test that the cipher is built once per key"""
+        from security.encryption import get_cipher
+        with app.app_context():
+            assert get_cipher() is get_cipher()
+            app.config['ENCRYPTION_KEY'] = 'another-key'
+            assert get_cipher() is not None
+    
+    def test_old_key_still_decrypts(self, app):
+        """Test that data encrypted with a retired key stays readable"""
+        with app.app_context():
+            encrypted = encrypt_data('123-45-6789')
+            app.config.update({'ENCRYPTION_KEY': 'new-key', 'ENCRYPTION_OLD_KEYS': ['test-encryption-key-32bytes!!']})
+            assert decrypt_data(encrypted) == '123-45-6789'
+    
+    def test_reencrypt_is_resumable(self, app, tmp_path):
+        """Test that an interrupted re-encryption continues where it stopped"""
+        from models import db, Patient
+        from security import key_rotation
+        
+        state_path = str(tmp_path / 'state.json')
+        with app.app_context():
+            patient = Patient.query.first()
+            for i in range(4):
+                db.session.add(Patient(full_name=f'Rotate {i}', date_of_birth=patient.date_of_birth,
+                                       encrypted_ssn=encrypt_data(f'000-00-000{i}')))
+            db.session.commit()
+            
+            app.config.update({'ENCRYPTION_KEY': 'new-key', 'ENCRYPTION_OLD_KEYS': ['test-encryption-key-32bytes!!']})
+            
+            # 第一次运行在处理完第一批后中断
+            def interrupt(message):
+                if '2/4' in message:
+                    raise KeyboardInterrupt
+            with pytest.raises(KeyboardInterrupt):
+                key_rotation.reencrypt_all('new-key', state_path, batch_size=2, log=interrupt)
+            
+            processed = key_rotation.reencrypt_all('new-key', state_path, batch_size=2, log=lambda m: None)
+            assert processed['patients.encrypted_ssn'] == 2
+            
+            # 旧key去掉之后所有数据仍然可以解密
+            app.config['ENCRYPTION_OLD_KEYS'] = []
+            db.session.expire_all()
+            values = sorted(decrypt_data(p.encrypted_ssn) for p in Patient.query.filter(Patient.encrypted_ssn.isnot(None)))
+            assert values == [f'000-00-000{i}' for i in range(4)]
+
+class TestBlindIndex:
+    """Test HMAC blind index for encrypted SSN and insurance ID"""
+    
+    def test_index_maintained_on_assignment(self, app):
+        """Test that assigning ciphertext updates the blind index column"""
+        from models import Patient
+        from security.blind_index import blind_index
+        
+        with app.app_context():
+            patient = Patient(full_name='Index Test', date_of_birth=datetime(1990, 1, 1).date())
+            patient.encrypted_ssn = encrypt_data('123-45-6789')
+            
+            assert patient.ssn_bidx == blind_index('ssn', '123456789')
+            assert patient.ssn_bidx != blind_index('insurance_id', '123456789')
+    
+    def test_staff_lookup_by_insurance_id(self, client, app, patient_token, staff_token):
+        """Test exact-match lookup after the patient submits insurance"""
+        response = client.post('/submit_insurance', data={
+            'insurance_name': 'Acme',
+            'insurance_id': 'ins-555 123'
+        }, headers={'Authorization': f'Bearer {patient_token}'})
+        assert response.status_code == 200
+        
+        response = client.post('/api/patient/lookup', json={'insurance_id': 'INS555123'}, headers={
+            'Authorization': f'Bearer {staff_token}'
+        })
+        
+        assert response.status_code == 200
+        assert [p['full_name'] for p in response.json['patients']] == ['Test Patient']
+    
+    def test_backfill_populates_existing_rows(self, app):
+        """Test backfill for rows written before the index existed"""
+        from models import db, Patient
+        from security.blind_index import backfill_blind_indexes, find_patients
+        
+        with app.app_context():
+            patient = Patient.query.first()
+            db.session.execute(db.update(Patient).where(Patient.id == patient.id).values(
+                encrypted_ssn=encrypt_data('987-65-4321'), ssn_bidx=None))
+            db.session.commit()
+            assert find_patients(ssn='987654321') == []
+            
+            backfill_blind_indexes(log=lambda msg: None)
+            
+            assert [p.id for p in find_patients(ssn='987-65-4321')] == [patient.id]
+
+    def test_lookup_after_key_rotation(self, client, app, staff_token, tmp_path):
+        """Test that rotating ENCRYPTION_KEY keeps exact-match lookup working"""
+        from models import db, Patient
+        from security.key_rotation import reencrypt_all
+        
+        with app.app_context():
+            patient = Patient.query.first()
+            patient.encrypted_ssn = encrypt_data('555-12-3456')
+            db.session.commit()
+            
+            app.config.update({'ENCRYPTION_KEY': 'new-key', 'ENCRYPTION_OLD_KEYS': ['test-encryption-key-32bytes!!']})
+            reencrypt_all('new-key', str(tmp_path / 'state.json'), log=lambda msg: None)
+            app.config['ENCRYPTION_OLD_KEYS'] = []
+            patient_id = patient.id
+        
+        response = client.post('/api/patient/lookup', json={'ssn': '555123456'}, headers={
+            'Authorization': f'Bearer {staff_token}'
+        })
+        
+        assert response.status_code == 200
+        assert [p['id'] for p in response.json['patients']] == [patient_id]
+    
+    def test_recompute_all_after_index_key_change(self, app):
+        """Test that --recompute-all rewrites indexes built with a previous BLIND_INDEX_KEY"""
+        from models import db, Patient
+        from security.blind_index import backfill_blind_indexes, find_patients
+        
+        with app.app_context():
+            patient = Patient.query.first()
+            patient.encrypted_ssn = encrypt_data('222-33-4444')
+            db.session.commit()
+            
+            app.config['BLIND_INDEX_KEY'] = 'replacement-blind-index-key'
+            assert find_patients(ssn='222334444') == []
+            backfill_blind_indexes(log=lambda msg: None)
+            assert find_patients(ssn='222334444') == []
+            
+            backfill_blind_indexes(recompute_all=True, log=lambda msg: None)
+            assert [p.id for p in find_patients(ssn='222334444')] == [patient.id]
+    
+    def test_startup_requires_dedicated_key(self, app):
+        """Test that a missing or shared BLIND_INDEX_KEY is rejected"""
+        from security.blind_index import init_blind_index
+        
+        app.config['BLIND_INDEX_KEY'] = None
+        with pytest.raises(RuntimeError):
+            init_blind_index(app)
+        
+        app.config['BLIND_INDEX_KEY'] = app.config['ENCRYPTION_KEY']
+        with pytest.raises(RuntimeError):
+            init_blind_index(app)
+
 class TestRBAC:
     """Test Role-Based Access Control"""
     
@@ -129,6 +277,258 @@ class TestAuditLog:
             log = AuditLog.query.filter_by(action='login').first()
             assert log.user_agent is not None
 
+class TestAuditWriter:
+    """Test asynchronous batched audit writer"""
+    
+    def make_row(self, resource_id):
+        from datetime import datetime
+        return {
+            'user_id': None,
+            'action': 'view',
+            'resource_type': 'patient',
+            'resource_id': resource_id,
+            'ip_address': '127.0.0.1',
+            'user_agent': 'pytest',
+            'timestamp': datetime.utcnow(),
+            'details': {'source': 'test'}
+        }
+    
+    def test_writer_flushes_batches(self, app, tmp_path):
+        """Test that queued records are written in batches"""
+        from models import AuditLog
+        from security.audit import AuditWriter
+        
+        app.config.update({'AUDIT_BATCH_SIZE': 3, 'AUDIT_SPOOL_PATH': str(tmp_path / 'spool.jsonl')})
+        writer = AuditWriter()
+        for i in range(7):
+            writer.enqueue(app, self.make_row(i))
+        writer.stop()
+        
+        with app.app_context():
+            assert AuditLog.query.filter_by(resource_type='patient').count() == 7
+    
+    def test_writer_spools_and_replays_on_db_failure(self, app, tmp_path, monkeypatch):
+        """Test that records survive a database outage through the spool file"""
+        from models import AuditLog, db
+        from security.audit import AuditWriter
+        
+        spool_path = tmp_path / 'spool.jsonl'
+        app.config.update({'AUDIT_SPOOL_PATH': str(spool_path)})
+        writer = AuditWriter()
+        
+        def broken_execute(*args, **kwargs):
+            raise RuntimeError('database unavailable')
+        
+        with monkeypatch.context() as m:
+            m.setattr(db.session, 'execute', broken_execute)
+            writer.enqueue(app, self.make_row(1))
+            writer.flush()
+        
+        assert spool_path.exists()
+        
+        writer.enqueue(app, self.make_row(2))
+        writer.stop()
+        
+        assert not spool_path.exists()
+        with app.app_context():
+            assert AuditLog.query.filter_by(resource_type='patient').count() == 2
+    
+    def test_async_log_action_does_not_block_request(self, client, app, tmp_path):
+        """Test login audit goes through the background writer"""
+        from models import AuditLog
+        from security.audit import audit_writer
+        
+        app.config.update({'AUDIT_ASYNC': True, 'AUDIT_SPOOL_PATH': str(tmp_path / 'spool.jsonl')})
+        response = client.post('/api/auth/login', json={
+            'username': 'test_patient',
+            'password': 'test123'
+        })
+        audit_writer.stop()
+        
+        assert response.status_code == 200
+        with app.app_context():
+            assert AuditLog.query.filter_by(action='login').count() == 1
+
+    def test_async_rows_discarded_on_rollback(self, app, tmp_path):
+        """Test that audit rows of a rolled back transaction never reach the writer"""
+        from models import db
+        from security.audit import log_action
+        from services.unit_of_work import PENDING_AUDIT_KEY
+        
+        app.config.update({'AUDIT_ASYNC': True, 'AUDIT_SPOOL_PATH': str(tmp_path / 'spool.jsonl')})
+        with app.test_request_context('/'):
+            db.session.execute(db.text('SELECT 1'))
+            log_action('view', 'patient', 1)
+            assert len(db.session().info[PENDING_AUDIT_KEY]) == 1
+            db.session.rollback()
+            assert PENDING_AUDIT_KEY not in db.session().info
+    
+    def test_replay_quarantines_rejected_rows(self, app, tmp_path):
+        """Test that a row the database rejects does not block the rest of the spool"""
+        import json
+        from models import AuditLog
+        from security.audit import AuditWriter
+        
+        spool_path = tmp_path / 'spool.jsonl'
+        app.config.update({'AUDIT_SPOOL_PATH': str(spool_path)})
+        writer = AuditWriter()
+        
+        bad_row = self.make_row(2)
+        bad_row['action'] = None
+        writer.start(app)
+        writer._spool([self.make_row(1), bad_row, self.make_row(3)])
+        
+        writer.enqueue(app, self.make_row(4))
+        writer.stop()
+        
+        assert not spool_path.exists()
+        quarantined = [json.loads(line) for line in open(str(spool_path) + '.quarantine')]
+        assert [item['row']['resource_id'] for item in quarantined] == [2]
+        with app.app_context():
+            assert AuditLog.query.filter_by(resource_type='patient').count() == 3
+    
+    def test_replay_claims_files_of_dead_workers(self, app, tmp_path):
+        """Test that a replay file left by an exited worker is picked up"""
+        import json
+        from models import AuditLog
+        from security.audit import AuditWriter
+        
+        spool_path = tmp_path / 'spool.jsonl'
+        app.config.update({'AUDIT_SPOOL_PATH': str(spool_path)})
+        writer = AuditWriter()
+        
+        # 一个不存在的PID留下的replaying文件
+        orphan = tmp_path / 'spool.jsonl.replaying.999999999.1'
+        orphan.write_text(json.dumps(self.make_row(1), default=lambda v: v.isoformat()) + '\n')
+        
+        writer.enqueue(app, self.make_row(2))
+        writer.stop()
+        
+        assert not orphan.exists()
+        with app.app_context():
+            assert AuditLog.query.filter_by(resource_type='patient').count() == 2
+
+class TestAuditPartitions:
+    """Test audit_logs partitioning, archival and restore"""
+    
+    def insert_old_logs(self, count):
+        from datetime import datetime
+        from models import db, AuditLog
+        
+        for i in range(count):
+            db.session.add(AuditLog(action='view', resource_type='patient', resource_id=i,
+                                    timestamp=datetime(2020, 1, 15, 12, 0, i)))
+        db.session.commit()
+    
+    def test_current_month_partition_created(self, app):
+        """Test that create_all creates the default and upcoming partitions"""
+        from datetime import datetime
+        from models import db
+        from security.audit_archive import list_partitions, month_start
+        
+        with app.app_context():
+            with db.engine.connect() as connection:
+                partitions = list_partitions(connection)
+        
+        assert month_start(datetime.utcnow()) in partitions
+    
+    def test_archive_and_restore_round_trip(self, app, tmp_path):
+        """Test that old partitions are exported, dropped and restored intact"""
+        import json
+        from datetime import date
+        from models import db, AuditLog
+        from security.audit_archive import (archive_partitions, restore_partitions,
+                                            create_partition, list_partitions)
+        
+        with app.app_context():
+            self.insert_old_logs(5)
+            with db.engine.begin() as connection:
+                create_partition(connection, date(2020, 1, 1))
+            
+            archived = archive_partitions(str(tmp_path), retain_months=12, log=lambda msg: None)
+            assert archived == [date(2020, 1, 1)]
+            assert AuditLog.query.count() == 0
+            db.session.rollback()
+            
+            manifest = json.loads((tmp_path / 'manifest.json').read_text())
+            assert manifest['segments'][0]['rows'] == 5
+            
+            restored = restore_partitions(str(tmp_path), date(2020, 1, 1), date(2020, 1, 1),
+                                          log=lambda msg: None)
+            assert restored == [date(2020, 1, 1)]
+            assert AuditLog.query.count() == 5
+            with db.engine.connect() as connection:
+                assert date(2020, 1, 1) in list_partitions(connection)
+    
+    def test_archive_picks_up_rows_in_default_partition(self, app, tmp_path):
+        """Test that expired rows in the default partition are archived too"""
+        from datetime import date
+        from models import AuditLog
+        from security.audit_archive import archive_partitions
+        
+        with app.app_context():
+            self.insert_old_logs(3)
+            
+            archived = archive_partitions(str(tmp_path), retain_months=12, log=lambda msg: None)
+            
+            assert archived == [date(2020, 1, 1)]
+            assert AuditLog.query.count() == 0
+    
+    def test_failed_export_keeps_partition_attached(self, app, tmp_path, monkeypatch):
+        """Test that a failing export leaves the month queryable"""
+        from models import db, AuditLog
+        from security import audit_archive
+        
+        def broken_export(*args, **kwargs):
+            raise IOError('disk full')
+        
+        with app.app_context():
+            self.insert_old_logs(2)
+            monkeypatch.setattr(audit_archive, '_export_table', broken_export)
+            
+            with pytest.raises(IOError):
+                audit_archive.archive_partitions(str(tmp_path), retain_months=12, log=lambda msg: None)
+            
+            assert AuditLog.query.count() == 2
+    
+    def test_restored_month_not_rearchived(self, app, tmp_path):
+        """Test that a month restored on demand survives the next archive run"""
+        from datetime import date
+        from models import db, AuditLog
+        from security.audit_archive import archive_partitions, restore_partitions
+        
+        with app.app_context():
+            self.insert_old_logs(2)
+            archive_partitions(str(tmp_path), retain_months=12, log=lambda msg: None)
+            restore_partitions(str(tmp_path), date(2020, 1, 1), date(2020, 1, 1), log=lambda msg: None)
+            
+            assert archive_partitions(str(tmp_path), retain_months=12, log=lambda msg: None) == []
+            assert AuditLog.query.count() == 2
+            db.session.rollback()
+            
+            archived = archive_partitions(str(tmp_path), retain_months=12,
+                                          include_restored=True, log=lambda msg: None)
+            assert archived == [date(2020, 1, 1)]
+    
+    def test_restore_rejects_corrupted_segment(self, app, tmp_path):
+        """Test checksum verification on restore"""
+        from datetime import date
+        from models import db
+        from security.audit_archive import archive_partitions, restore_partitions, create_partition
+        
+        with app.app_context():
+            self.insert_old_logs(1)
+            with db.engine.begin() as connection:
+                create_partition(connection, date(2020, 1, 1))
+            archive_partitions(str(tmp_path), retain_months=12, log=lambda msg: None)
+            
+            segment = next(tmp_path.glob('*.jsonl.gz'))
+            segment.write_bytes(segment.read_bytes() + b'corrupt')
+            
+            with pytest.raises(ValueError):
+                restore_partitions(str(tmp_path), date(2020, 1, 1), date(2020, 1, 1),
+                                   log=lambda msg: None)
+
 class TestSessionManagement:
     """Test session token management"""
     
@@ -155,4 +555,157 @@ class TestSessionManagement:
             'Authorization': f'Bearer {patient_token}'
         })
         
-        assert response.status_code == 200
\ No newline at end of file
+        assert response.status_code == 200
+
+class TestUnitOfWork:
+    """Test request-scoped unit of work"""
+    
+    def test_login_commits_once(self, client, app):
+        """Test that login, session row and audit row share one commit"""
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session as OrmSession
+        
+        commits = []
+        listener = lambda session: commits.append(session)
+        event.listen(OrmSession, 'after_commit', listener)
+        try:
+            response = client.post('/api/auth/login', json={
+                'username': 'test_patient',
+                'password': 'test123'
+            })
+        finally:
+            event.remove(OrmSession, 'after_commit', listener)
+        
+        assert response.status_code == 200
+        assert len(commits) == 1
+    
+    def test_error_response_discards_staged_rows(self, client, app):
+        """Test that staged rows are rolled back when the request fails"""
+        from models import AuditLog
+        from security.audit import log_action
+        
+        with app.test_request_context():
+            log_action('view', 'patient', 1)
+            response = app.process_response(app.response_class(status=400))
+        
+        assert response.status_code == 400
+        with app.app_context():
+            assert AuditLog.query.filter_by(resource_type='patient').count() == 0
+    
+    def test_immediate_audit_survives_error_response(self, client, app):
+        """Test that immediate audit rows are kept when the request is rolled back"""
+        from models import AuditLog
+        
+        response = client.post('/api/auth/login', json={
+            'username': 'test_patient',
+            'password': 'wrong'
+        })
+        
+        assert response.status_code == 401
+        with app.app_context():
+            assert AuditLog.query.filter_by(action='login_failed').count() == 1
+    
+    def test_commit_now_escape_hatch(self, app):
+        """Test immediate commit inside a request"""
+        from models import AuditLog
+        from security.audit import log_action
+        from services.unit_of_work import commit_now
+        
+        with app.test_request_context():
+            log_action('view', 'patient', 1)
+            commit_now()
+            db_rows = AuditLog.query.filter_by(resource_type='patient').count()
+        
+        assert db_rows == 1
+
+class TestAuditQuery:
+    """Test keyset-paginated audit query API"""
+    
+    def insert_logs(self, count, resource_id=7):
+        from datetime import datetime, timedelta
+        from models import db, AuditLog
+        
+        start = datetime.utcnow() - timedelta(hours=1)
+        for i in range(count):
+            db.session.add(AuditLog(action='view', resource_type='patient', resource_id=resource_id,
+                                    timestamp=start + timedelta(seconds=i)))
+        db.session.add(AuditLog(action='view', resource_type='patient', resource_id=resource_id + 1,
+                                timestamp=start))
+        db.session.commit()
+    
+    def test_pages_cover_all_rows_newest_first(self, client, app, staff_token):
+        """Test that following next_cursor returns every match exactly once"""
+        with app.app_context():
+            self.insert_logs(5)
+        
+        headers = {'Authorization': f'Bearer {staff_token}'}
+        seen, cursor = [], None
+        while True:
+            url = '/api/audit/logs?resource_type=patient&resource_id=7&limit=2'
+            response = client.get(url + (f'&cursor={cursor}' if cursor else ''), headers=headers)
+            assert response.status_code == 200
+            seen += response.json['logs']
+            cursor = response.json['next_cursor']
+            if cursor is None:
+                break
+        
+        timestamps = [log['timestamp'] for log in seen]
+        assert len(seen) == 5
+        assert len({log['id'] for log in seen}) == 5
+        assert timestamps == sorted(timestamps, reverse=True)
+    
+    def test_export_streams_ndjson(self, client, app, staff_token):
+        """Test NDJSON export of all matching rows"""
+        import json
+        with app.app_context():
+            self.insert_logs(3)
+        
+        response = client.get('/api/audit/logs/export?resource_id=7', headers={
+            'Authorization': f'Bearer {staff_token}'
+        })
+        
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert len(lines) == 3
+    
+    def test_invalid_cursor_rejected(self, client, staff_token):
+        """Test that a malformed cursor is a 400"""
+        response = client.get('/api/audit/logs?cursor=not-a-cursor', headers={
+            'Authorization': f'Bearer {staff_token}'
+        })
+        assert response.status_code == 400
+    
+    def test_malformed_filters_rejected(self, client, staff_token):
+        """Test that malformed filters are a 400 instead of being dropped"""
+        for query in ('user_id=abc', 'resource_id=7x', 'since=yesterday', 'until=2026-13-01'):
+            for path in ('/api/audit/logs', '/api/audit/logs/export'):
+                response = client.get(f'{path}?{query}', headers={
+                    'Authorization': f'Bearer {staff_token}'
+                })
+                assert response.status_code == 400, (path, query)
+                assert query.split('=')[0] in response.json['error']
+    
+    def test_patient_cannot_query_audit_logs(self, client, patient_token):
+        """Test that patients are denied"""
+        response = client.get('/api/audit/logs', headers={
+            'Authorization': f'Bearer {patient_token}'
+        })
+        assert response.status_code == 403
+    
+    def test_query_uses_composite_index(self, app):
+        """Test that the planner can serve a filtered page from the composite index"""
+        from models import db
+        
+        with app.app_context():
+            db.session.execute(db.text('SET LOCAL enable_seqscan = off'))
+            plan = db.session.execute(db.text(
+                "EXPLAIN SELECT * FROM audit_logs WHERE resource_type = 'patient' AND resource_id = 7 "
+                "ORDER BY timestamp DESC, id DESC LIMIT 100"
+            )).scalars().all()
+            db.session.rollback()
+        
+        # 分区上的索引名由Postgres生成；Merge Append直接合并各分区的有序索引扫描，不需要排序
+        plan = '\n'.join(plan)
+        assert 'resource_type_resource_id_timestamp_id_idx' in plan
+        assert '->  Sort' not in plan